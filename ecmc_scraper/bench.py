@@ -0,0 +1,180 @@
+'''
+End-to-end benchmark of the production summaries pipeline, run by
+`ecmc-scraper bench`.
+
+Synthetic zips are served by a local stand-in for the ECMC website (see
+standin.py) and read by synthetic.read_standin_table instead of the Access
+driver, so the whole pipeline, scrape -> convert -> transform -> export, runs
+on any machine without internet access. Each stage's result is the time from
+the start of its first item to the end of its last, its throughput over that
+time and the largest peak memory increase of any of its items. Results use the
+same format as `python -m ecmc_scraper.benchmark`, so the two can share a
+baseline file.
+'''
+
+
+import logging
+import pathlib
+import tempfile
+import time
+from typing import Optional
+
+from . import benchmark
+from . import catalog as ctlg
+from . import config as cfg
+from . import const
+from . import memory
+from . import pipeline
+from . import production_summaries
+from . import standin
+from . import synthetic
+from . import telemetry
+
+
+STAGES = ['scrape', 'convert', 'transform']
+
+# the span whose bytes are each stage's throughput
+STAGE_BYTES_SPANS = {
+    'scrape': 'download',
+    'convert': 'parquet_write',
+    'transform': 'csv_write',
+}
+
+
+def run(
+    years: list[int],
+    rows: int,
+    logger: logging.Logger,
+    repeat: int = 1,
+    download_workers: int = 4,
+    convert_workers: int = 2,
+    transform_workers: int = 2,
+    latency: float = 0.0,
+    bandwidth: Optional[float] = None,
+    failure_rate: float = 0.0,
+    seed: int = 0,
+    scratch_dir: Optional[pathlib.Path] = None,
+) -> list[benchmark.Result]:
+    '''
+    Runs the pipeline from scratch repeat times and keeps the fastest run of
+    each stage.
+    '''
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+            work_dir = pathlib.Path(tmp)
+            url_config = cfg.ProductionSummariesUrlConfig.from_dict(
+                const.DEFAULT_URL_CONFIG)
+            for year in years:
+                # roughly the size of an Access database holding this many rows
+                synthetic.write_zip(
+                    work_dir / 'server', year, rows, url_config,
+                    seed=seed, mdb_size=rows * 200,
+                )
+
+            with standin.StandinServer(
+                work_dir / 'server',
+                latency=latency,
+                bandwidth=bandwidth,
+                failure_rate=failure_rate,
+                seed=seed,
+                logger=logger,
+            ) as server:
+                config = _config(
+                    work_dir,
+                    years,
+                    server.base_url,
+                    download_workers,
+                    convert_workers,
+                    transform_workers,
+                )
+                runs.append(_run_once(config, rows, logger))
+            logger.info(
+                f'the stand-in server failed {server.failures} of '
+                f'{server.requests} requests'
+            )
+
+    return [
+        min((r[i] for r in runs), key=lambda r: r.seconds)
+        for i in range(len(runs[0]))
+    ]
+
+
+def _run_once(
+    config: cfg.ProductionSummariesConfig,
+    rows: int,
+    logger: logging.Logger,
+) -> list[benchmark.Result]:
+    with memory.PeakRss() as rss:
+        start = time.perf_counter()
+        pipeline.production_summaries(
+            config, logger, read_table=synthetic.read_standin_table)
+        seconds = time.perf_counter() - start
+
+    total_rows = rows * len(config.years)
+    summary = telemetry.summary()
+    catalog = ctlg.Catalog(config.catalog_file)
+    results = []
+    for stage in STAGES:
+        total = summary.get(f'stage.{stage}', telemetry.SpanTotal())
+        n_bytes = summary.get(STAGE_BYTES_SPANS[stage], telemetry.SpanTotal()).bytes
+        peaks = [peak for _, _, peak in catalog.memory_usage(stage)]
+        results.append(_result(
+            f'pipeline_{stage}',
+            total_rows,
+            total.elapsed_seconds,
+            n_bytes,
+            max(peaks) if peaks else None,
+        ))
+
+    results.append(_result(
+        'pipeline',
+        total_rows,
+        seconds,
+        sum(summary.get(s, telemetry.SpanTotal()).bytes for s in STAGE_BYTES_SPANS.values()),
+        rss.increase,
+    ))
+    return results
+
+
+def _result(
+    name: str,
+    rows: int,
+    seconds: float,
+    n_bytes: int,
+    peak_rss_increase: Optional[int],
+) -> benchmark.Result:
+    return benchmark.Result(
+        name=name,
+        rows=rows,
+        repeat=1,
+        seconds=seconds,
+        mean_seconds=seconds,
+        rows_per_second=rows / seconds if seconds > 0 else float('inf'),
+        bytes=n_bytes,
+        bytes_per_second=n_bytes / seconds if seconds > 0 else float('inf'),
+        peak_rss_increase=peak_rss_increase,
+    )
+
+
+def _config(
+    work_dir: pathlib.Path,
+    years: list[int],
+    base_url: str,
+    download_workers: int,
+    convert_workers: int,
+    transform_workers: int,
+) -> cfg.ProductionSummariesConfig:
+    return production_summaries.default_config(
+        access_db_dir=work_dir / 'access-db',
+        catalog_file=work_dir / 'catalog.sqlite',
+        convert_workers=convert_workers,
+        download_workers=download_workers,
+        export_dir=work_dir / 'export',
+        log_dir=work_dir / 'logs',
+        parquet_dir=work_dir / 'parquet',
+        transform_workers=transform_workers,
+        url_config={**const.DEFAULT_URL_CONFIG, 'base_url': base_url},
+        years=years,
+        zip_dir=work_dir / 'zip',
+    )
@@ -0,0 +1,416 @@
+'''
+Micro-benchmarks for the pipeline's hot functions, run on synthetic data.
+
+    python -m ecmc_scraper.benchmark --rows 10000 --rows 1000000 --output baseline.json
+
+Each result records the best wall time over the repeats, rows and bytes per
+second, and the peak increase in resident memory. Passing --baseline compares
+against an earlier results file and exits non-zero if any benchmark got
+slower than the threshold allows.
+
+The time to import the CLI is measured with `python -X importtime` and
+recorded as cli_import. --import-budget-ms fails the run if the import takes
+longer than that, or if it pulls in any of HEAVY_MODULES.
+'''
+
+
+from dataclasses import asdict, dataclass
+import datetime
+import json
+import logging
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+from typing_extensions import Annotated
+
+import polars as pl
+import typer
+
+from . import __version__
+from . import catalog as ctlg
+from . import const
+from . import convert_production_summaries_access_to_parquet as convert_prod
+from . import enum
+from . import memory
+from . import quality
+from . import synthetic
+from . import transform_production_summaries as transform_prod
+from . import utils
+
+
+# a setup function prepares its input in a scratch directory and returns the
+# function to time along with the number of bytes it processes
+Setup = Callable[[pathlib.Path, int], tuple[Callable[[], object], int]]
+
+BENCHMARKS: dict[str, Setup] = {}
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000]
+CLI_MODULE = 'ecmc_scraper.main'
+HEAVY_MODULES = ('polars', 'requests', 'arrow_odbc', 'pyarrow')
+
+app = typer.Typer()
+logger = logging.getLogger('ecmc_scraper.benchmark')
+
+
+@dataclass(frozen=True)
+class Result:
+    name: str
+    rows: int
+    repeat: int
+    seconds: float
+    mean_seconds: float
+    rows_per_second: float
+    bytes: int
+    bytes_per_second: float
+    peak_rss_increase: Optional[int]
+
+
+def benchmark(name: str) -> Callable[[Setup], Setup]:
+    def register(setup: Setup) -> Setup:
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def run(
+    names: list[str],
+    rows: list[int],
+    repeat: int = 3,
+    scratch_dir: Optional[pathlib.Path] = None,
+) -> list[Result]:
+    results = []
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        for n_rows in rows:
+            for name in names:
+                work_dir = pathlib.Path(tmp) / f'{name}_{n_rows}'
+                work_dir.mkdir()
+                func, n_bytes = BENCHMARKS[name](work_dir, n_rows)
+                results.append(_time(name, n_rows, n_bytes, func, repeat))
+    return results
+
+
+def write_results(results: list[Result], path: pathlib.Path) -> None:
+    path.write_text(json.dumps({
+        'created': datetime.datetime.now().isoformat(),
+        'ecmc_scraper': __version__,
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'platform': platform.platform(),
+        'results': [asdict(r) for r in results],
+    }, indent=2))
+
+
+def read_results(path: pathlib.Path) -> list[Result]:
+    return [Result(**r) for r in json.loads(path.read_text())['results']]
+
+
+def compare(
+    results: list[Result],
+    baseline: list[Result],
+    threshold: float,
+) -> list[tuple[Result, Result]]:
+    '''
+    Returns (result, baseline) pairs for every benchmark that is more than
+    threshold (a fraction) slower than its baseline.
+    '''
+    previous = {(r.name, r.rows): r for r in baseline}
+    return [
+        (r, previous[(r.name, r.rows)])
+        for r in results
+        if (r.name, r.rows) in previous
+        and r.seconds > previous[(r.name, r.rows)].seconds * (1 + threshold)
+    ]
+
+
+def import_time(module: str = CLI_MODULE) -> tuple[float, list[str]]:
+    '''
+    Returns the cumulative seconds spent importing module in a fresh
+    interpreter and which of HEAVY_MODULES it imported.
+    '''
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = 0.0
+    imported = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            seconds = int(cumulative) / 1e6
+    return seconds, [m for m in HEAVY_MODULES if m in imported]
+
+
+def cli_import(repeat: int = 3) -> tuple[Result, list[str]]:
+    runs = [import_time() for _ in range(repeat)]
+    times = [seconds for seconds, _ in runs]
+    return Result(
+        name='cli_import',
+        rows=0,
+        repeat=repeat,
+        seconds=min(times),
+        mean_seconds=statistics.mean(times),
+        rows_per_second=0.0,
+        bytes=0,
+        bytes_per_second=0.0,
+        peak_rss_increase=None,
+    ), runs[0][1]
+
+
+def _time(
+    name: str,
+    rows: int,
+    n_bytes: int,
+    func: Callable[[], object],
+    repeat: int,
+) -> Result:
+    times = []
+    peak_increase = None
+    for _ in range(repeat):
+        with memory.PeakRss() as rss:
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        if rss.increase is not None:
+            peak_increase = max(peak_increase or 0, rss.increase)
+
+    best = min(times)
+    return Result(
+        name=name,
+        rows=rows,
+        repeat=repeat,
+        seconds=best,
+        mean_seconds=statistics.mean(times),
+        rows_per_second=rows / best if best > 0 else float('inf'),
+        bytes=n_bytes,
+        bytes_per_second=n_bytes / best if best > 0 else float('inf'),
+        peak_rss_increase=peak_increase,
+    )
+
+
+def _production_parquet(work_dir: pathlib.Path, rows: int) -> dict:
+    return synthetic.write_parquet(work_dir, [2023], rows)[2023]
+
+
+@benchmark('transform_production')
+def _transform_production(work_dir: pathlib.Path, rows: int):
+    parquet_dict = _production_parquet(work_dir, rows)
+    path = parquet_dict['production_path']
+    return lambda: transform_prod._transform_production(
+        path,
+        const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_keep'],
+        const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_fill_null_with_zero'],
+        logger,
+    ), path.stat().st_size
+
+
+@benchmark('transform_production_ipc')
+def _transform_production_ipc(work_dir: pathlib.Path, rows: int):
+    path = work_dir / 'production.arrow'
+    synthetic.production_table(2023, rows).write_ipc(path)
+    return lambda: transform_prod._transform_production(
+        path,
+        const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_keep'],
+        const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_fill_null_with_zero'],
+        logger,
+    ), path.stat().st_size
+
+
+@benchmark('transform_completions')
+def _transform_completions(work_dir: pathlib.Path, rows: int):
+    path = work_dir / 'completions.parquet'
+    synthetic.completions_table(2023, rows).write_parquet(path)
+    return lambda: transform_prod._transform_completions(
+        path,
+        const.DEFAULT_TRANSFORM_CONFIG['completions_columns_to_keep'],
+        const.DEFAULT_TRANSFORM_CONFIG['completions_columns_to_fill_null_with_zero'],
+        logger,
+    ), path.stat().st_size
+
+
+@benchmark('deduplicate')
+def _deduplicate(work_dir: pathlib.Path, rows: int):
+    df = synthetic.production_table(2023, rows)
+    return lambda: convert_prod._deduplicate(
+        {enum.MsAccessTable.production: {2023: df}}, logger,
+    ), df.estimated_size()
+
+
+@benchmark('quality_check')
+def _quality_check(work_dir: pathlib.Path, rows: int):
+    data = {
+        enum.MsAccessTable.production: {2023: synthetic.production_table(2023, rows)},
+        enum.MsAccessTable.completions: {2023: synthetic.completions_table(2023, rows)},
+    }
+    return lambda: quality.check_year(
+        data, 2023, enum.QualityPolicy.report, logger, convert_prod._table_keys,
+    ), sum(d[2023].estimated_size() for d in data.values())
+
+
+@benchmark('write_output_data')
+def _write_output_data(work_dir: pathlib.Path, rows: int):
+    parquet_dict = _production_parquet(work_dir, rows)
+    data = {
+        'production': {2023: transform_prod._transform_production(
+            parquet_dict['production_path'],
+            const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_keep'],
+            const.DEFAULT_TRANSFORM_CONFIG['production_columns_to_fill_null_with_zero'],
+            logger,
+        )},
+        'completions': {2023: transform_prod._transform_completions(
+            parquet_dict['completions_path'],
+            const.DEFAULT_TRANSFORM_CONFIG['completions_columns_to_keep'],
+            const.DEFAULT_TRANSFORM_CONFIG['completions_columns_to_fill_null_with_zero'],
+            logger,
+        )},
+    }
+    out_dir = work_dir / 'export'
+    out_dir.mkdir()
+    return lambda: transform_prod._write_output_data(
+        data, out_dir, True, logger,
+    ), data['production'][2023].estimated_size()
+
+
+@benchmark('hash_file')
+def _hash_file(work_dir: pathlib.Path, rows: int):
+    # roughly the size of an Access database holding this many rows
+    zip_path = synthetic.write_zip(work_dir, 2023, rows, mdb_size=rows * 200)
+    return lambda: utils.hash_file(zip_path), zip_path.stat().st_size
+
+
+@benchmark('hash_file_cached')
+def _hash_file_cached(work_dir: pathlib.Path, rows: int):
+    zip_path = synthetic.write_zip(work_dir, 2023, rows, mdb_size=rows * 200)
+    catalog = ctlg.Catalog(work_dir / 'catalog.sqlite')
+    catalog.hash_file(zip_path)
+    return lambda: catalog.hash_file(zip_path), zip_path.stat().st_size
+
+
+@benchmark('to_json')
+def _to_json(work_dir: pathlib.Path, rows: int):
+    # one metadata entry per hundred rows keeps the sizes comparable
+    metadata = {
+        f'{i:064x}': {
+            'year': 1999 + i % 25,
+            'path': work_dir / f'{i}.mdb',
+            'production_path': work_dir / f'{i}.parquet',
+            'timestamp': datetime.datetime.now().isoformat(),
+        }
+        for i in range(max(rows // 100, 1))
+    }
+    return lambda: utils.to_json(metadata), len(json.dumps(utils.to_json(metadata)))
+
+
+@benchmark('catalog_backup')
+def _catalog_backup(work_dir: pathlib.Path, rows: int):
+    data_dir = work_dir / 'data'
+    catalog = ctlg.Catalog(work_dir / 'catalog.sqlite')
+    years = range(1999, 1999 + max(min(rows // 10_000, 25), 1))
+
+    def backup_all_years():
+        for year in years:
+            f = data_dir / f'{year}.csv'
+            f.write_text('x')
+            catalog.record(enum.CatalogStage.export, year, f'{year}', {'path': f})
+        for year in years:
+            catalog.backup(
+                enum.CatalogStage.export, year, work_dir / 'previous_versions')
+
+    data_dir.mkdir()
+    return backup_all_years, 0
+
+
+@app.command()
+def main(
+    rows: Annotated[
+        List[int],
+        typer.Option(min=1, help='Number of rows in the synthetic tables.'),
+    ] = DEFAULT_ROWS,
+    only: Annotated[
+        Optional[List[str]],
+        typer.Option(help='Only run these benchmarks.', show_default=False),
+    ] = None,
+    repeat: Annotated[int, typer.Option(min=1)] = 3,
+    output: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Write results to this JSON file.', show_default=False),
+    ] = None,
+    baseline: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Compare against this results file.', show_default=False),
+    ] = None,
+    threshold: Annotated[
+        float,
+        typer.Option(help='Allowed slowdown against the baseline, as a fraction.'),
+    ] = 0.2,
+    scratch_dir: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Where to write synthetic data.', show_default=False),
+    ] = None,
+    import_budget_ms: Annotated[
+        Optional[float],
+        typer.Option(
+            help=f'Fail if importing {CLI_MODULE} takes longer than this or imports a heavy dependency.',
+            show_default=False,
+        ),
+    ] = None,
+):
+    names = only if only else list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise typer.BadParameter(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    results = run(names, rows, repeat=repeat, scratch_dir=scratch_dir)
+    import_result, heavy_imports = cli_import(repeat)
+    results.append(import_result)
+    for r in results:
+        rss = 'n/a' if r.peak_rss_increase is None else f'{r.peak_rss_increase / 2**20:.1f} MiB'
+        typer.echo(
+            f'{r.name:<24}{r.rows:>12,} rows{r.seconds:>10.4f} s'
+            f'{r.rows_per_second:>16,.0f} rows/s  peak +{rss}'
+        )
+
+    if output is not None:
+        write_results(results, output)
+
+    failed = False
+    if import_budget_ms is not None:
+        if import_result.seconds * 1000 > import_budget_ms:
+            typer.echo(
+                f'importing {CLI_MODULE} took {import_result.seconds * 1000:.0f} ms, '
+                f'over the {import_budget_ms:.0f} ms budget',
+                err=True,
+            )
+            failed = True
+        if heavy_imports:
+            typer.echo(
+                f'importing {CLI_MODULE} imported {", ".join(heavy_imports)}',
+                err=True,
+            )
+            failed = True
+
+    if baseline is not None:
+        regressions = compare(results, read_results(baseline), threshold)
+        for r, b in regressions:
+            typer.echo(
+                f'REGRESSION {r.name} at {r.rows:,} rows: '
+                f'{r.seconds:.4f} s vs {b.seconds:.4f} s',
+                err=True,
+            )
+        failed = failed or len(regressions) > 0
+
+    if failed:
+        raise typer.Exit(1)
+
+
+if __name__ == '__main__':
+    app()
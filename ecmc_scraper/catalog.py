@@ -0,0 +1,773 @@
+'''
+SQLite catalog of every artifact the pipeline produces: the downloaded zips,
+the extracted Access databases, the parquet files and the exports.
+
+Each artifact is one row per (stage, year, generation) with its hash, files,
+size, timestamp, the fingerprint of the config that produced it and the
+artifact it was made from, so lineage questions are indexed lookups. Only the
+newest generation of a (stage, year) is current; older generations keep
+pointing at their files in previous_versions. Every change is a single
+transaction, so an interrupted run can't leave the catalog half written.
+
+The catalog also caches file hashes keyed by each file's path, size,
+modification time and inode, so unchanged files are never read again to be
+hashed, keeps the memory each stage used for each year so later runs can
+schedule around it, indexes where each well's rows are in the parquet files
+(see query.py) and keeps statistics of every column of every generation of
+the parquet files (see stats.py).
+
+Each run of the pipeline is recorded with a checkpoint for every (stage, year)
+it finished, so a run that failed or was interrupted can be resumed without
+redoing the years and stages it already finished. The ETag, Last-Modified and
+size ECMC last reported for each year's zip are kept too, so `watch` can tell
+whether a zip changed without downloading it.
+'''
+
+
+import contextlib
+from dataclasses import asdict, dataclass, field, is_dataclass
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from typing import Iterable, Iterator, Optional
+
+from . import enum
+from . import utils
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    config_fingerprint TEXT,
+    generation INTEGER NOT NULL,
+    current INTEGER NOT NULL,
+    source_id INTEGER REFERENCES artifacts(id),
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS artifacts_stage_year
+    ON artifacts(stage, year, current);
+CREATE INDEX IF NOT EXISTS artifacts_hash ON artifacts(hash);
+CREATE INDEX IF NOT EXISTS artifacts_source ON artifacts(source_id);
+
+CREATE TABLE IF NOT EXISTS artifact_files (
+    artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (artifact_id, key)
+);
+CREATE INDEX IF NOT EXISTS artifact_files_path ON artifact_files(path);
+
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS memory_usage (
+    stage TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    input_size INTEGER NOT NULL,
+    peak_increase INTEGER NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS memory_usage_stage_year ON memory_usage(stage, year);
+
+CREATE TABLE IF NOT EXISTS api_index (
+    api INTEGER NOT NULL,
+    artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+    file_key TEXT NOT NULL,
+    row_group INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (api, artifact_id, file_key, row_group, offset)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS api_index_artifact ON api_index(artifact_id, file_key);
+
+CREATE TABLE IF NOT EXISTS column_stats (
+    artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+    file_key TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    null_count INTEGER NOT NULL,
+    min_value,
+    max_value,
+    distinct_count INTEGER,
+    sum_value REAL,
+    PRIMARY KEY (artifact_id, file_key, column_name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    finished TEXT,
+    status TEXT NOT NULL,
+    years TEXT NOT NULL,
+    config_fingerprint TEXT
+);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+    finished TEXT NOT NULL,
+    PRIMARY KEY (run_id, stage, year)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS upstream (
+    url TEXT PRIMARY KEY,
+    year INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER,
+    checked TEXT NOT NULL
+);
+'''
+
+
+@dataclass(frozen=True)
+class Artifact:
+    id: int
+    stage: enum.CatalogStage
+    year: int
+    hash: str
+    files: dict[str, pathlib.Path]
+    size: int
+    timestamp: str
+    config_fingerprint: Optional[str]
+    generation: int
+    current: bool
+    source_id: Optional[int]
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.files['path']
+
+    def exists(self) -> bool:
+        return all(f.exists() for f in self.files.values())
+
+
+@dataclass(frozen=True)
+class ColumnStats:
+    column: str
+    rows: int
+    null_count: int
+    min: Optional[object] = None
+    max: Optional[object] = None
+    distinct: Optional[int] = None
+    sum: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class Run:
+    id: int
+    started: str
+    finished: Optional[str]
+    status: enum.RunStatus
+    years: list[int]
+    config_fingerprint: Optional[str]
+
+
+@dataclass(frozen=True)
+class Upstream:
+    url: str
+    year: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    size: Optional[int]
+    checked: str
+
+    def same_file(self, other: 'Upstream') -> bool:
+        '''
+        Whether other describes the same file, comparing the validators both
+        have. Without any validator to compare, the file may have changed.
+        '''
+        pairs = [
+            (a, b) for a, b in (
+                (self.etag, other.etag),
+                (self.last_modified, other.last_modified),
+            )
+            if a is not None and b is not None
+        ]
+        if self.size is not None and other.size is not None \
+                and self.size != other.size:
+            return False
+        return len(pairs) > 0 and all(a == b for a, b in pairs)
+
+
+class Catalog:
+
+    def __init__(self, path: pathlib.Path, journal_mode: str = 'WAL'):
+        self.path = path
+        # WAL needs memory shared between the processes using the catalog,
+        # which hosts sharing it over a network filesystem don't have
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        if not hasattr(self._local, 'db'):
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            db.execute('PRAGMA foreign_keys=ON')
+            self._local.db = db
+        return self._local.db
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def current(
+        self,
+        stage: enum.CatalogStage,
+        year: int,
+    ) -> Optional[Artifact]:
+        row = self.db.execute(
+            'SELECT * FROM artifacts WHERE stage = ? AND year = ? AND current = 1',
+            (str(stage), year),
+        ).fetchone()
+        return None if row is None else self._artifact(row)
+
+    def artifacts(
+        self,
+        stage: enum.CatalogStage,
+        current: bool = True,
+    ) -> list[Artifact]:
+        query = 'SELECT * FROM artifacts WHERE stage = ?'
+        if current:
+            query += ' AND current = 1'
+        rows = self.db.execute(query + ' ORDER BY year, generation', (str(stage),))
+        return [self._artifact(row) for row in rows.fetchall()]
+
+    def get(self, artifact_id: int) -> Optional[Artifact]:
+        row = self.db.execute(
+            'SELECT * FROM artifacts WHERE id = ?', (artifact_id,)).fetchone()
+        return None if row is None else self._artifact(row)
+
+    def find_hash(self, sha_hash: str) -> list[Artifact]:
+        rows = self.db.execute(
+            'SELECT * FROM artifacts WHERE hash = ? ORDER BY id', (sha_hash,))
+        return [self._artifact(row) for row in rows.fetchall()]
+
+    def find_path(self, path: pathlib.Path) -> Optional[Artifact]:
+        row = self.db.execute(
+            'SELECT artifacts.* FROM artifacts '
+            'JOIN artifact_files ON artifact_files.artifact_id = artifacts.id '
+            'WHERE artifact_files.path = ? ORDER BY artifacts.id DESC',
+            (str(path),),
+        ).fetchone()
+        return None if row is None else self._artifact(row)
+
+    def lineage(self, artifact: Artifact) -> list[Artifact]:
+        '''
+        The artifact followed by everything it was made from, newest first,
+        e.g. export -> parquet -> access_db -> zip.
+        '''
+        chain = [artifact]
+        while chain[-1].source_id is not None:
+            source = self.get(chain[-1].source_id)
+            if source is None:
+                break
+            chain.append(source)
+        return chain
+
+    def record(
+        self,
+        stage: enum.CatalogStage,
+        year: int,
+        sha_hash: str,
+        files: dict[str, pathlib.Path],
+        source: Optional[Artifact] = None,
+        config_fingerprint: Optional[str] = None,
+        timestamp: Optional[str] = None,
+        extra: Optional[dict] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> Artifact:
+        size = sum(f.stat().st_size for f in files.values() if f.exists())
+        timestamp = timestamp or datetime.datetime.now().isoformat()
+
+        with self.transaction() as db:
+            generation = db.execute(
+                'SELECT COALESCE(MAX(generation), 0) + 1 FROM artifacts '
+                'WHERE stage = ? AND year = ?',
+                (str(stage), year),
+            ).fetchone()[0]
+            db.execute(
+                'UPDATE artifacts SET current = 0 WHERE stage = ? AND year = ?',
+                (str(stage), year),
+            )
+            artifact_id = db.execute(
+                'INSERT INTO artifacts (stage, year, hash, size, timestamp, '
+                'config_fingerprint, generation, current, source_id, extra) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?)',
+                (
+                    str(stage), year, sha_hash, size, timestamp,
+                    config_fingerprint, generation,
+                    None if source is None else source.id,
+                    json.dumps(utils.to_json(extra or {})),
+                ),
+            ).lastrowid
+            db.executemany(
+                'INSERT INTO artifact_files (artifact_id, key, path) VALUES (?, ?, ?)',
+                [(artifact_id, k, str(f)) for k, f in files.items()],
+            )
+
+        if logger is not None:
+            logger.info(f'cataloged {stage} for {year} (generation {generation})')
+
+        return self.get(artifact_id) # type: ignore
+
+    def update(
+        self,
+        artifact: Artifact,
+        files: dict[str, pathlib.Path],
+        extra: Optional[dict] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> Artifact:
+        '''
+        Replaces the files and extra of an artifact in place, for a change that
+        leaves its data as it was, e.g. another intermediate format next to the
+        same parquet files.
+        '''
+        size = sum(f.stat().st_size for f in files.values() if f.exists())
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE artifacts SET size = ?, extra = ? WHERE id = ?',
+                (size, json.dumps(utils.to_json(extra or {})), artifact.id),
+            )
+            db.execute(
+                'DELETE FROM artifact_files WHERE artifact_id = ?', (artifact.id,))
+            db.executemany(
+                'INSERT INTO artifact_files (artifact_id, key, path) VALUES (?, ?, ?)',
+                [(artifact.id, k, str(f)) for k, f in files.items()],
+            )
+        if logger is not None:
+            logger.info(
+                f'updated {artifact.stage} for {artifact.year} '
+                f'(generation {artifact.generation})')
+
+        return self.get(artifact.id) # type: ignore
+
+    def retire(
+        self,
+        artifact: Artifact,
+        files: dict[str, pathlib.Path],
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        '''
+        Marks an artifact as no longer current and points it at the files it
+        was moved to.
+        '''
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE artifacts SET current = 0 WHERE id = ?', (artifact.id,))
+            db.executemany(
+                'UPDATE artifact_files SET path = ? WHERE artifact_id = ? AND key = ?',
+                [(str(f), artifact.id, k) for k, f in files.items()],
+            )
+        if logger is not None:
+            logger.info(f'retired {artifact.stage} for {artifact.year}')
+
+    def backup(
+        self,
+        stage: enum.CatalogStage,
+        year: int,
+        backup_path: pathlib.Path,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        '''
+        Moves the current files for a stage and year into backup_path.
+        '''
+        artifact = self.current(stage, year)
+        if artifact is None:
+            if logger is not None:
+                logger.info(f'no previous version of {stage} for {year}')
+            return
+
+        backup_path.mkdir(parents=True, exist_ok=True)
+        moved = {}
+        for key, f in artifact.files.items():
+            moved[key] = backup_path / f.name
+            if f.exists():
+                f.rename(moved[key])
+                if logger is not None:
+                    logger.info(f'moved {f} to {moved[key]}')
+
+        self.retire(artifact, moved, logger=logger)
+
+    def import_metadata(
+        self,
+        stage: enum.CatalogStage,
+        metadata_file: pathlib.Path,
+        path_keys: list[str] = ['path'],
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        '''
+        Imports a metadata.json file written by earlier versions, if nothing
+        has been cataloged for the stage yet.
+        '''
+        if not metadata_file.exists() or len(self.artifacts(stage, current=False)) > 0:
+            return
+        with metadata_file.open('r') as f:
+            metadata = json.load(f)
+        for sha_hash, hash_dict in metadata.items():
+            self.record(
+                stage,
+                hash_dict['year'],
+                sha_hash,
+                {k: pathlib.Path(hash_dict[k]) for k in path_keys},
+                timestamp=hash_dict.get('timestamp'),
+                logger=logger,
+            )
+        if logger is not None:
+            logger.info(f'imported {metadata_file} into {self.path}')
+
+    def hash_file(
+        self,
+        f: pathlib.Path,
+        logger: Optional[logging.Logger] = None,
+    ) -> str:
+        '''
+        Returns the sha256 of f, reading the file only if it changed since it
+        was last hashed.
+        '''
+        stat = f.stat()
+        row = self.db.execute(
+            'SELECT hash FROM file_hashes '
+            'WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+            (str(f), *_signature(stat)),
+        ).fetchone()
+        if row is not None:
+            return row['hash']
+
+        # the signature is taken before hashing, so a file modified while it
+        # is read gets hashed again next time
+        sha_hash = utils.hash_file(f, logger=logger)
+        self.remember_hash(f, sha_hash, stat)
+        return sha_hash
+
+    def remember_hash(
+        self,
+        f: pathlib.Path,
+        sha_hash: str,
+        stat: Optional[os.stat_result] = None,
+    ) -> None:
+        '''
+        Caches the hash of a file that was hashed while it was written.
+        '''
+        stat = stat or f.stat()
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO file_hashes '
+                '(path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)',
+                (str(f), *_signature(stat), sha_hash),
+            )
+
+    def record_memory(
+        self,
+        stage: str,
+        year: int,
+        input_size: int,
+        peak_increase: int,
+    ) -> None:
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO memory_usage '
+                '(stage, year, input_size, peak_increase, timestamp) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (stage, year, input_size, peak_increase,
+                    datetime.datetime.now().isoformat()),
+            )
+
+    def memory_usage(
+        self,
+        stage: str,
+        year: Optional[int] = None,
+        limit: int = 20,
+    ) -> list[tuple[int, int, int]]:
+        '''
+        The newest (year, input_size, peak_increase) observations for a
+        stage, optionally only for one year.
+        '''
+        query = 'SELECT year, input_size, peak_increase FROM memory_usage WHERE stage = ?'
+        params: list = [stage]
+        if year is not None:
+            query += ' AND year = ?'
+            params.append(year)
+        rows = self.db.execute(
+            query + ' ORDER BY timestamp DESC LIMIT ?', (*params, limit))
+        return [tuple(row) for row in rows.fetchall()] # type: ignore
+
+    def index_apis(
+        self,
+        artifact: Artifact,
+        file_key: str,
+        entries: Iterable[tuple[int, int, int, int]],
+    ) -> None:
+        '''
+        Replaces the (api, row_group, offset, count) index entries of one
+        file of an artifact, and drops the entries of the artifacts it
+        replaced.
+        '''
+        with self.transaction() as db:
+            db.execute(
+                'DELETE FROM api_index WHERE file_key = ? AND artifact_id IN '
+                '(SELECT id FROM artifacts WHERE stage = ? AND year = ? AND current = 0)',
+                (file_key, str(artifact.stage), artifact.year),
+            )
+            db.execute(
+                'DELETE FROM api_index WHERE artifact_id = ? AND file_key = ?',
+                (artifact.id, file_key),
+            )
+            db.executemany(
+                'INSERT INTO api_index '
+                '(api, artifact_id, file_key, row_group, offset, count) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                ((api, artifact.id, file_key, *rest) for api, *rest in entries),
+            )
+
+    def is_indexed(self, artifact: Artifact, file_key: str) -> bool:
+        row = self.db.execute(
+            'SELECT 1 FROM api_index WHERE artifact_id = ? AND file_key = ? LIMIT 1',
+            (artifact.id, file_key),
+        ).fetchone()
+        return row is not None
+
+    def api_locations(
+        self,
+        low: int,
+        high: int,
+        file_key: str,
+    ) -> list[tuple[int, pathlib.Path, int, int, int]]:
+        '''
+        (year, path, row_group, offset, count) of every run of rows with a
+        packed API number from low to high in the current files.
+        '''
+        rows = self.db.execute(
+            'SELECT artifacts.year, artifact_files.path, api_index.row_group, '
+            'api_index.offset, api_index.count FROM api_index '
+            'JOIN artifacts ON artifacts.id = api_index.artifact_id '
+            'JOIN artifact_files ON artifact_files.artifact_id = api_index.artifact_id '
+            'AND artifact_files.key = api_index.file_key '
+            'WHERE api_index.api BETWEEN ? AND ? AND api_index.file_key = ? '
+            'AND artifacts.current = 1 '
+            'ORDER BY artifacts.year, api_index.row_group, api_index.offset',
+            (low, high, file_key),
+        )
+        return [
+            (year, pathlib.Path(path), row_group, offset, count)
+            for year, path, row_group, offset, count in rows.fetchall()
+        ]
+
+    def generation(
+        self,
+        stage: enum.CatalogStage,
+        year: int,
+        generation: int,
+    ) -> Optional[Artifact]:
+        row = self.db.execute(
+            'SELECT * FROM artifacts WHERE stage = ? AND year = ? AND generation = ?',
+            (str(stage), year, generation),
+        ).fetchone()
+        return None if row is None else self._artifact(row)
+
+    def record_stats(
+        self,
+        artifact: Artifact,
+        file_key: str,
+        column_stats: Iterable[ColumnStats],
+    ) -> None:
+        with self.transaction() as db:
+            db.execute(
+                'DELETE FROM column_stats WHERE artifact_id = ? AND file_key = ?',
+                (artifact.id, file_key),
+            )
+            db.executemany(
+                'INSERT INTO column_stats (artifact_id, file_key, column_name, '
+                'rows, null_count, min_value, max_value, distinct_count, sum_value) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    (artifact.id, file_key, s.column, s.rows, s.null_count,
+                        s.min, s.max, s.distinct, s.sum)
+                    for s in column_stats
+                ),
+            )
+
+    def column_stats(
+        self,
+        artifact: Artifact,
+        file_key: str,
+    ) -> dict[str, ColumnStats]:
+        '''
+        The statistics of each column of one file of an artifact, empty if
+        none were recorded.
+        '''
+        rows = self.db.execute(
+            'SELECT column_name, rows, null_count, min_value, max_value, '
+            'distinct_count, sum_value FROM column_stats '
+            'WHERE artifact_id = ? AND file_key = ?',
+            (artifact.id, file_key),
+        )
+        return {row[0]: ColumnStats(*row) for row in rows.fetchall()}
+
+    def start_run(
+        self,
+        years: list[int],
+        config_fingerprint: Optional[str] = None,
+    ) -> Run:
+        with self.transaction() as db:
+            run_id = db.execute(
+                'INSERT INTO runs (started, status, years, config_fingerprint) '
+                'VALUES (?, ?, ?, ?)',
+                (
+                    datetime.datetime.now().isoformat(),
+                    str(enum.RunStatus.running),
+                    json.dumps(sorted(years)),
+                    config_fingerprint,
+                ),
+            ).lastrowid
+        return self.run(run_id) # type: ignore
+
+    def finish_run(self, run: Run, status: enum.RunStatus) -> None:
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE runs SET finished = ?, status = ? WHERE id = ?',
+                (datetime.datetime.now().isoformat(), str(status), run.id),
+            )
+
+    def run(self, run_id: int) -> Optional[Run]:
+        row = self.db.execute(
+            'SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+        return None if row is None else _run(row)
+
+    def last_run(self) -> Optional[Run]:
+        row = self.db.execute(
+            'SELECT * FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+        return None if row is None else _run(row)
+
+    def checkpoint(self, run: Run, stage: str, artifact: Artifact) -> None:
+        '''
+        Records that run finished stage for the artifact's year.
+        '''
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO checkpoints '
+                '(run_id, stage, year, artifact_id, finished) VALUES (?, ?, ?, ?, ?)',
+                (
+                    run.id, stage, artifact.year, artifact.id,
+                    datetime.datetime.now().isoformat(),
+                ),
+            )
+
+    def checkpoints(self, run: Run) -> dict[tuple[str, int], int]:
+        '''
+        (stage, year) -> id of the artifact of each unit run finished.
+        '''
+        rows = self.db.execute(
+            'SELECT stage, year, artifact_id FROM checkpoints WHERE run_id = ?',
+            (run.id,),
+        )
+        return {(stage, year): a for stage, year, a in rows.fetchall()}
+
+    def finished_since(
+        self,
+        stage: str,
+        year: int,
+        since: str,
+        config_fingerprint: Optional[str],
+    ) -> Optional[int]:
+        '''
+        The id of the artifact of the last (stage, year) any run with the
+        same configuration finished since the given time.
+        '''
+        row = self.db.execute(
+            'SELECT c.artifact_id FROM checkpoints c JOIN runs r ON r.id = c.run_id '
+            'WHERE c.stage = ? AND c.year = ? AND c.finished >= ? '
+            'AND r.config_fingerprint IS ? ORDER BY c.finished DESC LIMIT 1',
+            (stage, year, since, config_fingerprint),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def upstream(self, url: str) -> Optional[Upstream]:
+        row = self.db.execute(
+            'SELECT * FROM upstream WHERE url = ?', (url,)).fetchone()
+        return None if row is None else Upstream(**row)
+
+    def record_upstream(self, upstream: Upstream) -> None:
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO upstream '
+                '(url, year, etag, last_modified, size, checked) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    upstream.url, upstream.year, upstream.etag,
+                    upstream.last_modified, upstream.size, upstream.checked,
+                ),
+            )
+
+    def _artifact(self, row: sqlite3.Row) -> Artifact:
+        files = self.db.execute(
+            'SELECT key, path FROM artifact_files WHERE artifact_id = ?',
+            (row['id'],),
+        ).fetchall()
+        return Artifact(
+            id=row['id'],
+            stage=enum.CatalogStage(row['stage']),
+            year=row['year'],
+            hash=row['hash'],
+            files={f['key']: pathlib.Path(f['path']) for f in files},
+            size=row['size'],
+            timestamp=row['timestamp'],
+            config_fingerprint=row['config_fingerprint'],
+            generation=row['generation'],
+            current=bool(row['current']),
+            source_id=row['source_id'],
+            extra=json.loads(row['extra']),
+        )
+
+
+def _run(row: sqlite3.Row) -> Run:
+    return Run(
+        id=row['id'],
+        started=row['started'],
+        finished=row['finished'],
+        status=enum.RunStatus(row['status']),
+        years=json.loads(row['years']),
+        config_fingerprint=row['config_fingerprint'],
+    )
+
+
+def _signature(stat: os.stat_result) -> tuple[int, int, int]:
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def fingerprint(config) -> str:
+    if is_dataclass(config):
+        config = asdict(config)
+    return hashlib.sha256(
+        json.dumps(utils.to_json(config), sort_keys=True, default=str).encode()
+    ).hexdigest()
@@ -1,8 +1,10 @@
 from dataclasses import dataclass
 import pathlib
 from typing import Optional
+import urllib.parse
 
 from . import enum
+from . import utils
 
 
 @dataclass(frozen=True)
@@ -23,6 +25,7 @@ class ProductionSummariesUrlConfig:
     base_url: str
     default_zip_file_template: str
     yearly_zip_file_templates: dict[int, str]
+    mirror: Optional[str] = None
 
     @classmethod
     def from_dict(cls, args_dict: dict) -> 'ProductionSummariesUrlConfig':
@@ -34,6 +37,7 @@ class ProductionSummariesUrlConfig:
                 for year, template in args_dict['zip_file_template'].items()
                 if year != 'default'
             },
+            mirror = args_dict.get('mirror'),
         )
 
     def zip_file_name(self, year: int) -> str:
@@ -45,20 +49,40 @@ class ProductionSummariesUrlConfig:
     def url(self, year: int) -> str:
         return f'{self.base_url.strip("/")}/{self.zip_file_name(year)}'.replace(" ", "%20")
 
+    def mirror_dir(self) -> Optional[pathlib.Path]:
+        if self.mirror is None:
+            return None
+        if self.mirror.startswith('file://'):
+            return pathlib.Path(urllib.parse.unquote(urllib.parse.urlparse(self.mirror).path))
+        return utils.str_to_path(self.mirror)
+
 
 @dataclass(frozen=True)
 class ProductionSummariesConfig:
     access_db_dir: pathlib.Path
     access_driver: enum.MsAccessDriver
+    catalog_file: pathlib.Path
+    convert_workers: int
+    download_workers: int
+    export_changes: bool
     export_type: enum.OutputType
     export_dir: pathlib.Path
+    intermediate_format: enum.IntermediateFormat
     log_dir: pathlib.Path
     log_level: enum.LogLevel
+    memory_budget: Optional[int]
     parquet_dir: pathlib.Path
+    profile: bool
+    quality_policy: enum.QualityPolicy
+    queue_dir: Optional[pathlib.Path]
+    queue_role: enum.QueueRole
+    queue_workers: int
     quiet: bool
+    resume: bool
     show_config: bool
     transform: bool
     transform_config: ProductionSummariesTransformConfig
+    transform_workers: int
     url_config: ProductionSummariesUrlConfig
     write_config_to_file: Optional[pathlib.Path]
     years: list[int]
@@ -74,4 +98,8 @@ class ProductionSummariesConfig:
             args_dict['url_config'] = ProductionSummariesUrlConfig.from_dict(
                 args_dict['url_config'])
 
+        for k, v in args_dict.items():
+            if k.endswith(('_dir', '_file')) and isinstance(v, str):
+                args_dict[k] = utils.str_to_path(v)
+
         return cls(**args_dict)
\ No newline at end of file
@@ -1,3 +1,6 @@
+import pathlib
+
+
 LOG_RECORD_BUILTIN_ATTRS = {
     "args",
     "asctime",
@@ -31,6 +34,8 @@ DEFAULT_URL_CONFIG = {
         1999: 'co YYYY Annual Production Summary-XP',
         2000: 'co YYYY Annual Production Summary-XP',
     },
+    # a directory or file:// URL synced with `ecmc-scraper sync-mirror`
+    'mirror': None,
 }
 
 DEFAULT_TRANSFORM_CONFIG = {
@@ -89,4 +94,54 @@ NON_CONFIG_OPTIONS = [
     'write_default_config_to_file',
 ]
 
-DEFAULT_YEARS = [2020, 2021, 2022, 2023]
\ No newline at end of file
+DEFAULT_YEARS = [2020, 2021, 2022, 2023]
+
+DEFAULT_DATA_DIR = pathlib.Path.home() / 'Documents/ecmc-data'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+MIRROR_MANIFEST = 'manifest.json'
+
+# downloads are retried after connection errors and these statuses, waiting
+# DOWNLOAD_BACKOFF_SECONDS, then twice that, and so on
+DOWNLOAD_ATTEMPTS = 4
+DOWNLOAD_BACKOFF_SECONDS = 1.0
+DOWNLOAD_RETRY_STATUSES = (429, 500, 502, 503, 504)
+DOWNLOAD_TIMEOUT_SECONDS = 60
+
+# watch polls ECMC every WATCH_INTERVAL_SECONDS, give or take WATCH_JITTER of
+# it, and backs off to at most WATCH_MAX_BACKOFF_SECONDS after failures
+WATCH_INTERVAL_SECONDS = 3600
+WATCH_JITTER = 0.1
+WATCH_MAX_BACKOFF_SECONDS = 6 * 3600
+WATCH_HEALTH_PORT = 8787
+
+QUEUE_LEASE_SECONDS = 60
+QUEUE_POLL_SECONDS = 2
+
+# how often a lock is retried on Windows, where waiting for one can't block
+LOCK_POLL_SECONDS = 0.5
+
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+
+# columns the convert step keeps approximate distinct counts and sums of
+STATS_DISTINCT_COLUMNS = [
+    'operator_num',
+    'name',
+    'api_county_code',
+    'county',
+    'facility_num',
+    'API_num',
+]
+
+STATS_SUM_COLUMNS = ['oil_prod', 'gas_prod', 'water_prod']
+
+# the summary cubes the transform step writes next to the exports
+CUBE_DIMENSIONS = ['year', 'county', 'operator_num', 'well_type']
+CUBE_SUM_COLUMNS = ['oil_prod', 'gas_prod', 'water_prod', 'boe_prod']
+
+# rows of each broken data quality rule kept in the quality report
+QUALITY_SAMPLE_ROWS = 5
+# Colorado with a little room for rounding, in degrees
+COLORADO_LAT = (36.9, 41.1)
+COLORADO_LONG = (-109.1, -102.0)
@@ -11,14 +11,21 @@ Microsoft Windows operating systems.
 '''
 
 
-import json
+from dataclasses import dataclass
 import logging
 import pathlib
+from typing import Any, Callable, Optional
 
 import polars as pl
 
+from . import catalog as ctlg
 from . import config as cfg
+from . import const
 from . import enum
+from . import quality
+from . import query
+from . import stats
+from . import telemetry
 from . import utils
 
 
@@ -27,37 +34,239 @@ access_driver_map = {
     enum.MsAccessDriver.x32: r'{Microsoft Access Driver (*.mdb)}',
 }
 
+ipc_compression_map = {
+    enum.IntermediateFormat.ipc: 'uncompressed',
+    enum.IntermediateFormat.ipc_lz4: 'lz4',
+}
+
+ipc_suffix_map = {
+    enum.IntermediateFormat.ipc: '.arrow',
+    enum.IntermediateFormat.ipc_lz4: '.arrow.lz4',
+}
+
+# reads one table of an Access database, given the ODBC connection to it
+ReadTable = Callable[
+    [enum.MsAccessTable, dict[enum.ODBCKey, str], logging.Logger], pl.DataFrame]
+
+_table_keys = {
+    enum.MsAccessTable.production: 'production',
+    enum.MsAccessTable.completions: 'completions',
+}
+
 
-def convert(
+def convert_year(
+    db_artifact: ctlg.Artifact,
     config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    backup_path: pathlib.Path,
     logger: logging.Logger,
-) -> None:
-    parquet_previous_versions_path = config.parquet_dir / 'previous_versions'
-    parquet_previous_versions_path.mkdir(parents=True, exist_ok=True)
-
-    with (config.access_db_dir / 'metadata.json').open('r') as f:
-        access_db_metadata = json.load(f)
-
-    parquet_metadata = _get_parquet_metadata(
-        access_db_metadata, config.parquet_dir, logger)
-    parquet_metadata_path = config.parquet_dir / 'metadata.json'
-
-    if utils.new_hashes(parquet_metadata, parquet_metadata_path, logger=logger):
-        utils.backup(
-            config.parquet_dir,
-            parquet_previous_versions_path,
-            'parquet',
-            path_keys=['production_path', 'completions_path'],
-            keys_to_delete=['db_path'],
-            logger=logger,
-        )
+    read_table: Optional[ReadTable] = None,
+) -> ctlg.Artifact:
+    '''
+    Converts the Access database of db_artifact to parquet. read_table reads
+    each table, over ODBC unless another reader is given, e.g. by the bench.
+    '''
+    config.parquet_dir.mkdir(parents=True, exist_ok=True)
+    year = db_artifact.year
+    files = _get_parquet_files(
+        config.parquet_dir, year, config.intermediate_format)
+    extra = {
+        'intermediate_format': config.intermediate_format,
+        'quality_policy': config.quality_policy,
+    }
+    previous = catalog.current(enum.CatalogStage.parquet, year)
+    if (
+        previous is not None
+        and previous.hash == db_artifact.hash
+        and previous.exists()
+        # a new quality policy is applied to the rows of the Access database;
+        # the report of a run that failed the policy doesn't count, as it
+        # wrote no parquet files
+        and applied_policy(previous) == config.quality_policy
+    ):
+        previous_format = previous.extra.get(
+            'intermediate_format', enum.IntermediateFormat.parquet)
+        # parquet files converted before the quality checks existed, which
+        # kept every row, get a report once
+        _check_quality(previous, db_artifact, config, catalog, backup_path, logger)
+        if previous_format == config.intermediate_format:
+            logger.info(f'no changes to parquet files for {year}')
+            # parquet files converted before the index and the statistics
+            # existed get them once
+            _index_apis(previous, catalog, logger)
+            _record_stats(previous, None, catalog, logger)
+            return previous
 
-        with parquet_metadata_path.open('w') as f:
-            json.dump(utils.to_json(parquet_metadata, logger=logger), f)
+        # only the intermediate format changed, so it is rebuilt from the
+        # parquet files instead of reading the Access database again
+        return _change_intermediate_format(previous, files, config, catalog, logger)
 
-        data = _mdb_import(
-            access_db_metadata, logger, driver=config.access_driver)
-        _write_parquet(config.parquet_dir, data, logger)
+    read = read_year(
+        db_artifact,
+        config,
+        logger,
+        read_table=read_table,
+        on_fail=lambda report: quality.record(
+            report, db_artifact, _quality_dir(config), catalog, backup_path, logger),
+    )
+    data = read.data
+    extra['duplicates'] = read.duplicates
+    _sort_by_api(data, logger)
+    # the previous generation stays current until the Access database has
+    # been read, which is what usually fails
+    catalog.backup(
+        enum.CatalogStage.parquet, year, backup_path, logger=logger)
+    _write_parquet(config.parquet_dir, data, logger)
+
+    if config.intermediate_format != enum.IntermediateFormat.parquet:
+        _write_ipc(config.parquet_dir, data, config.intermediate_format, logger)
+
+    artifact = catalog.record(
+        enum.CatalogStage.parquet,
+        year,
+        db_artifact.hash,
+        files,
+        source=db_artifact,
+        timestamp=db_artifact.timestamp,
+        extra=extra,
+        logger=logger,
+    )
+    _index_apis(artifact, catalog, logger)
+    _record_stats(artifact, previous, catalog, logger)
+    quality.record(
+        read.report, db_artifact, _quality_dir(config), catalog, backup_path, logger)
+
+    return artifact
+
+
+@dataclass(frozen=True)
+class YearTables:
+    year: int
+    data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]]
+    # table key -> duplicate rows dropped
+    duplicates: dict[str, int]
+    report: quality.Report
+
+    @property
+    def frames(self) -> dict[str, pl.DataFrame]:
+        return {key: self.data[table][self.year] for table, key in _table_keys.items()}
+
+
+def read_year(
+    db_artifact: ctlg.Artifact,
+    config: cfg.ProductionSummariesConfig,
+    logger: logging.Logger,
+    read_table: Optional[ReadTable] = None,
+    on_fail: Optional[Callable[[quality.Report], Any]] = None,
+) -> YearTables:
+    '''
+    Reads the tables of db_artifact's Access database, keeps the first of each
+    set of duplicate rows and applies the quality policy. A year whose rows
+    break a rule under the fail policy raises, after on_fail is given its
+    report.
+    '''
+    year = db_artifact.year
+    data = _mdb_import(
+        {db_artifact.hash: {'year': year, 'path': db_artifact.path}},
+        logger,
+        driver=config.access_driver,
+        read_table=read_table,
+    )
+    duplicates = _deduplicate(data, logger)
+    report = quality.check_year(
+        data, year, config.quality_policy, logger, _table_keys)
+    if config.quality_policy == enum.QualityPolicy.fail and report.violations > 0:
+        if on_fail is not None:
+            on_fail(report)
+        raise RuntimeError(
+            f'{report.violations} rows of {year} break data quality rules')
+
+    return YearTables(
+        year,
+        data,
+        {key: duplicates[table][year] for table, key in _table_keys.items()},
+        report,
+    )
+
+
+def _change_intermediate_format(
+    previous: ctlg.Artifact,
+    files: dict[str, pathlib.Path],
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    logger: logging.Logger,
+) -> ctlg.Artifact:
+    '''
+    Writes the intermediate files of a parquet artifact in another format. Its
+    parquet files don't change, so the artifact is updated in place rather
+    than recorded as a new generation that would share them.
+    '''
+    year = previous.year
+    if config.intermediate_format != enum.IntermediateFormat.parquet:
+        data = {
+            table: {year: pl.read_parquet(previous.files[f'{key}_path'])}
+            for table, key in _table_keys.items()
+        }
+        _write_ipc(config.parquet_dir, data, config.intermediate_format, logger)
+
+    artifact = catalog.update(
+        previous,
+        files,
+        extra={**previous.extra, 'intermediate_format': config.intermediate_format},
+        logger=logger,
+    )
+    # the files of the other format are removed once the catalog no longer
+    # points at them
+    for f in previous.files.values():
+        if f not in files.values():
+            f.unlink(missing_ok=True)
+            logger.info(f'removed {f}')
+    _index_apis(artifact, catalog, logger)
+    _record_stats(artifact, None, catalog, logger)
+    return artifact
+
+
+def _quality_dir(config: cfg.ProductionSummariesConfig) -> pathlib.Path:
+    return config.parquet_dir / 'quality'
+
+
+def applied_policy(parquet_artifact: ctlg.Artifact) -> enum.QualityPolicy:
+    '''
+    The quality policy the rows of a parquet artifact went through. Parquet
+    files converted before the policy was recorded kept every row.
+    '''
+    return enum.QualityPolicy(
+        parquet_artifact.extra.get('quality_policy', enum.QualityPolicy.report))
+
+
+def _check_quality(
+    parquet_artifact: ctlg.Artifact,
+    db_artifact: ctlg.Artifact,
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    backup_path: pathlib.Path,
+    logger: logging.Logger,
+) -> None:
+    '''
+    Checks parquet files that have no current quality report, or whose report
+    is of another policy, e.g. one left by a run that failed the fail policy.
+    Their rows are already written, so only the report is kept.
+    '''
+    year = parquet_artifact.year
+    policy = applied_policy(parquet_artifact)
+    checked = catalog.current(enum.CatalogStage.quality, year)
+    if (
+        quality.is_current(db_artifact, catalog)
+        and checked.extra.get('policy') == policy # type: ignore
+    ):
+        return
+    data = {
+        table: {year: pl.read_parquet(parquet_artifact.files[f'{key}_path'])}
+        for table, key in _table_keys.items()
+    }
+    report = quality.check_year(data, year, policy, logger, _table_keys)
+    quality.record(
+        report, db_artifact, _quality_dir(config), catalog, backup_path, logger)
 
 
 def _odbc_connection_str(
@@ -76,24 +285,22 @@ def _read_odbc_table(
         query, connection=_odbc_connection_str(connection, logger))
 
 
-def _get_parquet_metadata(
-    db_metadata: dict[str, dict],
+def _get_parquet_files(
     parquet_path: pathlib.Path,
-    logger: logging.Logger,
-) -> dict[str, dict]:
-    
-    return {
-        sha_hash: {
-            'year': hash_dict['year'],
-            'db_path': pathlib.Path(hash_dict['path']),
-            'production_path': parquet_path \
-                / f'{enum.MsAccessTable.production}_{hash_dict["year"]}.parquet',
-            'completions_path': parquet_path \
-                / f'{enum.MsAccessTable.completions}_{hash_dict["year"]}.parquet',
-            'timestamp': hash_dict['timestamp']
-        }
-        for sha_hash, hash_dict in db_metadata.items()
+    year: int,
+    intermediate_format: enum.IntermediateFormat = enum.IntermediateFormat.parquet,
+) -> dict[str, pathlib.Path]:
+    files = {
+        f'{key}_path': parquet_path / f'{table}_{year}.parquet'
+        for table, key in _table_keys.items()
     }
+    if intermediate_format != enum.IntermediateFormat.parquet:
+        files.update({
+            f'{key}_ipc_path': parquet_path \
+                / f'{table}_{year}{ipc_suffix_map[intermediate_format]}'
+            for table, key in _table_keys.items()
+        })
+    return files
 
 
 def _mdb_import(
@@ -104,6 +311,7 @@ def _mdb_import(
         enum.MsAccessTable.production,
         enum.MsAccessTable.completions,
     ],
+    read_table: Optional[ReadTable] = None,
 ) -> dict[enum.MsAccessTable, dict[int, pl.DataFrame]]:
     db_data = {table: {} for table in tables}
 
@@ -111,16 +319,124 @@ def _mdb_import(
         enum.ODBCKey.driver: access_driver_map[driver],
         enum.ODBCKey.dbq: '',
     }
+    if read_table is None:
+        read_table = _read_odbc_table
 
     for _, hash_dict in metadata.items():
         connection[enum.ODBCKey.dbq] = hash_dict['path'] # type: ignore
         for table in db_data:
-            db_data[table][hash_dict['year']] = _read_odbc_table( # type: ignore
-                table, connection, logger)
+            with telemetry.span(
+                'odbc_read', logger, year=hash_dict['year'], table=table, # type: ignore
+            ) as s:
+                df = read_table(table, connection, logger)
+                s.record(rows=df.height, bytes=df.estimated_size())
+            db_data[table][hash_dict['year']] = df # type: ignore
 
     return db_data
 
 
+def _deduplicate(
+    data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]],
+    logger: logging.Logger,
+) -> dict[enum.MsAccessTable, dict[int, int]]:
+    '''
+    Keeps the first of each set of duplicate rows, so the transform step only
+    has to find the rows that become duplicates when it drops columns.
+    Returns the number of duplicates dropped.
+    '''
+    duplicates = {table: {} for table in data}
+    for table, year_dfs in data.items():
+        for year, df in year_dfs.items():
+            with telemetry.span(
+                'deduplicate', logger, year=year, table=table) as s:
+                year_dfs[year] = _first_distinct(df)
+                duplicates[table][year] = df.height - year_dfs[year].height
+                s.record(rows=df.height, duplicates=duplicates[table][year])
+            logger.info(
+                f'dropped {duplicates[table][year]} duplicate rows from {table} {year}')
+
+    return duplicates
+
+
+def _first_distinct(df: pl.DataFrame) -> pl.DataFrame:
+    # a 64-bit hash of each row finds the rows that may be duplicates, and
+    # only those are compared column by column, so rows whose hashes collide
+    # are both kept
+    repeated = df.hash_rows().is_duplicated()
+    if not repeated.any():
+        return df
+    rows = repeated.arg_true()
+    first = df[rows].select(pl.struct(pl.all()).is_first_distinct()).to_series()
+    # a mask computed by Polars is chunked like the frame, which a frame read
+    # in batches needs
+    return df.filter(
+        ~pl.int_range(0, df.height, dtype=pl.UInt32).is_in(rows.filter(~first)))
+
+
+def _sort_by_api(
+    data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]],
+    logger: logging.Logger,
+) -> None:
+    '''
+    Sorts each table by API number, so the rows of a well are next to each
+    other in the parquet file and a lookup reads one row group.
+    '''
+    for table, year_dfs in data.items():
+        expr = query.api_expr(enum.LookupTable(_table_keys[table]))
+        for year, df in year_dfs.items():
+            with telemetry.span('sort', logger, year=year, table=table) as s:
+                year_dfs[year] = df.sort(expr, nulls_last=True)
+                s.record(rows=df.height)
+
+
+def _index_apis(
+    artifact: ctlg.Artifact,
+    catalog: ctlg.Catalog,
+    logger: logging.Logger,
+) -> None:
+    for table, file_key in query.table_keys.items():
+        if catalog.is_indexed(artifact, file_key):
+            continue
+        with telemetry.span(
+            'api_index', logger, year=artifact.year, table=table) as s:
+            index = query.build_index(artifact.files[file_key], table)
+            catalog.index_apis(artifact, file_key, index.iter_rows())
+            s.record(rows=index.height)
+
+
+def _record_stats(
+    artifact: ctlg.Artifact,
+    previous: Optional[ctlg.Artifact],
+    catalog: ctlg.Catalog,
+    logger: logging.Logger,
+) -> None:
+    '''
+    Records the column statistics of the artifact's parquet files and logs
+    what changed since the previous generation.
+    '''
+    for table, file_key in query.table_keys.items():
+        column_stats = catalog.column_stats(artifact, file_key)
+        if len(column_stats) == 0:
+            with telemetry.span(
+                'column_stats', logger, year=artifact.year, table=table) as s:
+                computed = stats.compute(artifact.files[file_key])
+                catalog.record_stats(artifact, file_key, computed)
+                column_stats = {c.column: c for c in computed}
+                s.record(rows=computed[0].rows if computed else 0)
+
+        if previous is None:
+            continue
+        previous_stats = catalog.column_stats(previous, file_key)
+        if len(previous_stats) == 0:
+            continue
+        changes = stats.compare(previous_stats, column_stats)
+        logger.info(
+            f'{len(changes)} changes to {table} {artifact.year} '
+            f'since generation {previous.generation}',
+            extra={'year': artifact.year, 'table': table, 'changes': changes},
+        )
+
+
 def _write_parquet(
     out_dir: pathlib.Path,
     data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]],
@@ -128,4 +444,30 @@ def _write_parquet(
 ) -> None:
     for table, year_dfs in data.items():
         for year, df in year_dfs.items():
-            df.write_parquet(out_dir / f'{table}_{year}.parquet')
\ No newline at end of file
+            out_file = out_dir / f'{table}_{year}.parquet'
+            with telemetry.span(
+                'parquet_write', logger, year=year, table=table) as s:
+                with utils.atomic_write(out_file) as temp_file:
+                    df.write_parquet(
+                        temp_file, row_group_size=const.PARQUET_ROW_GROUP_SIZE)
+                s.record(rows=df.height, bytes=out_file.stat().st_size)
+
+
+def _write_ipc(
+    out_dir: pathlib.Path,
+    data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]],
+    intermediate_format: enum.IntermediateFormat,
+    logger: logging.Logger,
+) -> None:
+    for table, year_dfs in data.items():
+        for year, df in year_dfs.items():
+            out_file = out_dir \
+                / f'{table}_{year}{ipc_suffix_map[intermediate_format]}'
+            with telemetry.span(
+                'ipc_write', logger, year=year, table=table) as s:
+                with utils.atomic_write(out_file) as temp_file:
+                    df.write_ipc(
+                        temp_file,
+                        compression=ipc_compression_map[intermediate_format],
+                    )
+                s.record(rows=df.height, bytes=out_file.stat().st_size)
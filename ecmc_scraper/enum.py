@@ -27,11 +27,61 @@ class OutputType(StrEnum):
     # excel = 'excel'
 
 
+class IntermediateFormat(StrEnum):
+    '''
+    Format the transform step reads the converted tables from. Parquet is
+    always written for archiving; the ipc formats add Arrow IPC files that are
+    memory-mapped instead of decoded on every transform.
+    '''
+    parquet = 'parquet'
+    ipc = 'ipc'
+    ipc_lz4 = 'ipc_lz4'
+
+
+class QueueRole(StrEnum):
+    '''
+    With a shared queue directory, the coordinator submits the years and
+    works on them alongside the workers.
+    '''
+    coordinator = 'coordinator'
+    worker = 'worker'
+
+
 class MsAccessTable(StrEnum):
     production = 'Colorado Annual Production'
     completions = 'Colorado Well Completions'
 
 
+class LookupTable(StrEnum):
+    production = 'production'
+    completions = 'completions'
+
+
+class CatalogStage(StrEnum):
+    zip = 'zip'
+    access_db = 'access_db'
+    parquet = 'parquet'
+    quality = 'quality'
+    export = 'export'
+
+
+class QualityPolicy(StrEnum):
+    '''
+    What the convert step does with rows that break a data quality rule:
+    keep them, move them out of the table into a quarantine file, or fail the
+    year.
+    '''
+    report = 'report'
+    quarantine = 'quarantine'
+    fail = 'fail'
+
+
+class RunStatus(StrEnum):
+    running = 'running'
+    failed = 'failed'
+    finished = 'finished'
+
+
 class ODBCKey(StrEnum):
     driver = 'Driver'
     max_buffer_size = 'MAXBUFFERSIZE'
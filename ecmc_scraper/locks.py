@@ -0,0 +1,199 @@
+'''
+Advisory file locks that let several invocations work on the same data
+directories at once, e.g. a nightly refresh of the current year next to a
+backfill of older years.
+
+Each lock is a file in one directory next to the catalog, removed by its
+holder when it releases it. An invocation holds the lock of a (stage, year)
+while it works on it, so overlapping work is waited on and then found done
+instead of done twice, and holds the metadata lock while it merges
+metadata.json files into the catalog. Locks are released
+by the operating system when their process dies, so a crashed invocation never
+leaves one behind. They are flock() locks on POSIX and msvcrt locks on
+Windows, neither of which is reliable on every network filesystem; hosts
+sharing a filesystem should use the work queue instead.
+'''
+
+
+import contextlib
+import errno
+import logging
+import os
+import pathlib
+import socket
+import time
+from typing import IO, Iterator, Optional
+
+from . import const
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+_HELD_ERRNOS = {errno.EACCES, errno.EAGAIN, errno.EWOULDBLOCK, errno.EDEADLK}
+
+
+class FileLock:
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._file: Optional[IO[bytes]] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        '''
+        Takes the lock, waiting for it if blocking. Returns whether it was
+        taken.
+        '''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            f = self.path.open('a+b')
+            try:
+                locked = _lock(f, blocking)
+            except BaseException:
+                f.close()
+                raise
+            if not locked:
+                f.close()
+                return False
+            if _is_current(f, self.path):
+                break
+            # the holder removed the file while this waited for it, and whoever
+            # comes next locks the file now at the path instead
+            _unlock(f)
+            f.close()
+
+        # who holds the lock, for the log of whoever waits for it; written
+        # after the locked first byte, which Windows doesn't let others read
+        f.seek(1)
+        f.truncate()
+        f.write(f'{socket.gethostname()} pid {os.getpid()}'.encode())
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self, remove: bool = False) -> None:
+        '''
+        Releases the lock, first removing its file if remove, so lock files
+        don't pile up. Only the holder may remove it, as one removed after its
+        release could be locked by two invocations at once.
+        '''
+        if self._file is None:
+            return
+        if remove:
+            # Windows can't remove a file another process has open, and a lock
+            # file left behind is harmless
+            with contextlib.suppress(OSError):
+                self.path.unlink(missing_ok=True)
+        _unlock(self._file)
+        self._file.close()
+        self._file = None
+
+    def holder(self) -> str:
+        try:
+            with self.path.open('rb') as f:
+                f.seek(1)
+                return f.read().decode(errors='replace') or 'another process'
+        except OSError:
+            return 'another process'
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class Locks:
+    '''
+    The named locks in a directory shared by every invocation working on the
+    same data.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+
+    def lock(self, name: str) -> FileLock:
+        return FileLock(self.path / f'{name}.lock')
+
+    @contextlib.contextmanager
+    def hold(
+        self,
+        name: str,
+        logger: Optional[logging.Logger] = None,
+    ) -> Iterator[bool]:
+        '''
+        Holds the lock called name for the block, and yields whether another
+        invocation held it first.
+        '''
+        lock = self.lock(name)
+        waited = not lock.acquire(blocking=False)
+        if waited:
+            if logger is not None:
+                logger.info(f'waiting for {name}, locked by {lock.holder()}')
+            start = time.perf_counter()
+            lock.acquire()
+            if logger is not None:
+                logger.info(
+                    f'waited {time.perf_counter() - start:.1f}s for {name}')
+        try:
+            yield waited
+        finally:
+            lock.release(remove=True)
+
+    def unit(
+        self,
+        stage: str,
+        year: int,
+        logger: Optional[logging.Logger] = None,
+    ) -> contextlib.AbstractContextManager[bool]:
+        return self.hold(f'{stage}-{year}', logger)
+
+
+def _lock(f: IO[bytes], blocking: bool) -> bool:
+    while not _try_lock(f):
+        if not blocking:
+            return False
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            return True
+        time.sleep(const.LOCK_POLL_SECONDS)
+    return True
+
+
+def _unlock(f: IO[bytes]) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _is_current(f: IO[bytes], path: pathlib.Path) -> bool:
+    # whether f is still the file at path
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(f.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+def _try_lock(f: IO[bytes]) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError as e:
+        # anything but the lock being held, e.g. a filesystem without locks,
+        # is an error
+        if e.errno not in _HELD_ERRNOS:
+            raise
+        return False
+    return True
@@ -1,10 +1,17 @@
 import atexit
+import copy
 import datetime as dt
+import functools
+import gzip
 import json
 import logging.config
 import logging.handlers
+import os
 import pathlib
-import queue
+from queue import Empty, Full, Queue
+import shutil
+import threading
+import time
 from typing import Optional, Union
 
 import yaml
@@ -12,23 +19,38 @@ import yaml
 from . import const
 
 
+_configured_file: Optional[pathlib.Path] = None
+_configure_lock = threading.Lock()
+
+
 def get_logger(
     logger_name: str,
     log_level: str,
     log_path: pathlib.Path,
 ) -> logging.Logger:
+    global _configured_file
     log_path.mkdir(parents=True, exist_ok=True)
-    logger = logging.getLogger(logger_name)
-    config_file = pathlib.Path(__file__).absolute().parent / 'log_config.yaml'
+    log_file = log_path / f'{logger_name}.jsonl'
 
-    with config_file.open() as f_in:
-        config = yaml.load(f_in, Loader=yaml.Loader)
+    with _configure_lock:
+        if _configured_file != log_file:
+            config = copy.deepcopy(_load_config())
+            config['handlers']['file_json']['filename'] = log_file
+            logging.config.dictConfig(config)
+            _configured_file = log_file
+
+    # records below the level are dropped by isEnabledFor before any work is
+    # done on them
+    logging.getLogger().setLevel(log_level)
 
-    config['handlers']['file_json']['filename'] = log_path / f'{logger_name}.jsonl'
-    logging.config.dictConfig(config)
-    logging.basicConfig(level=log_level)
-    
-    return logger
+    return logging.getLogger(logger_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_config() -> dict:
+    config_file = pathlib.Path(__file__).absolute().parent / 'log_config.yaml'
+    with config_file.open() as f_in:
+        return yaml.load(f_in, Loader=yaml.Loader)
 
 
 def _resolve_handlers(l):
@@ -59,33 +81,248 @@ def _resolve_queue(q):
 
 
 class QueueListenerHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records on a bounded queue and hands them to the wrapped handlers in
+    batches on a listener thread. When the queue is full, overflow decides
+    what happens: 'drop_oldest' discards the oldest queued record,
+    'drop_newest' discards the incoming record and 'block' waits for room.
+    '''
+
+    overflow_policies = ('drop_oldest', 'drop_newest', 'block')
 
     def __init__(
         self,
         handlers,
         respect_handler_level=False,
         auto_run=True,
-        queue=queue.Queue(-1),
+        queue=None,
+        overflow='drop_oldest',
+        batch_size=256,
     ):
-        queue = _resolve_queue(queue)
+        if overflow not in self.overflow_policies:
+            raise ValueError(f'overflow must be one of {self.overflow_policies}')
+
+        queue = _resolve_queue(queue) if queue is not None else Queue(10_000)
         super().__init__(queue)
         handlers = _resolve_handlers(handlers)
-        self._listener = logging.handlers.QueueListener(
+        self.overflow = overflow
+        self.dropped = 0
+        self._unreported_drops = 0
+        self._drop_lock = threading.Lock()
+        self._listener = BatchQueueListener(
             self.queue,
             *handlers,
-            respect_handler_level=respect_handler_level)
+            respect_handler_level=respect_handler_level,
+            batch_size=batch_size,
+        )
+        self._running = False
         if auto_run:
             self.start()
             atexit.register(self.stop)
 
     def start(self):
-        self._listener.start()
+        if not self._running:
+            self._listener.start()
+            self._running = True
 
     def stop(self):
-        self._listener.stop()
+        if self._running:
+            self._running = False
+            self._listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def prepare(self, record):
+        # Only the message is rendered here. JSON formatting and writing
+        # happen on the listener thread.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            if self.overflow == 'drop_newest':
+                self._count_drop()
+                return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self._count_drop()
+                self.queue.put_nowait(record)
+            except (Empty, Full):
+                self._count_drop()
+            return
+
+        if self._unreported_drops > 0:
+            self._report_drops()
+
+    def _count_drop(self):
+        with self._drop_lock:
+            self.dropped += 1
+            self._unreported_drops += 1
+
+    def _report_drops(self):
+        with self._drop_lock:
+            dropped, self._unreported_drops = self._unreported_drops, 0
+        try:
+            self.queue.put_nowait(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f'dropped {dropped} log records because the log queue was full',
+                'dropped_records': dropped,
+            }))
+        except Full:
+            with self._drop_lock:
+                self._unreported_drops += dropped
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    '''
+    Takes up to batch_size records off the queue at a time. Handlers with an
+    emit_batch method get the whole batch at once.
+    '''
+
+    def __init__(self, queue, *handlers, respect_handler_level=False, batch_size=256):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batch_size = batch_size
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def handle_batch(self, records):
+        for handler in self.handlers:
+            if self.respect_handler_level:
+                batch = [r for r in records if r.levelno >= handler.level]
+            else:
+                batch = records
+            if len(batch) == 0:
+                continue
+
+            if hasattr(handler, 'emit_batch'):
+                handler.acquire()
+                try:
+                    handler.emit_batch([r for r in batch if handler.filter(r)])
+                finally:
+                    handler.release()
+            else:
+                for record in batch:
+                    handler.handle(record)
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, 'task_done')
+        done = False
+        while not done:
+            batch = []
+            record = self.dequeue(True)
+            while True:
+                if record is self._sentinel:
+                    done = True
+                    break
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.dequeue(False)
+                except Empty:
+                    break
+
+            if len(batch) > 0:
+                self.handle_batch(batch)
+            if has_task_done:
+                for _ in range(len(batch) + done):
+                    q.task_done()
+
+
+class JSONLFileHandler(logging.FileHandler):
+    '''
+    Appends formatted records to a file, one write per batch. The file is
+    rotated once it grows past max_bytes or is older than rotate_seconds, and
+    rotated files are gzip compressed, keeping the newest backup_count.
+    '''
+
+    def __init__(
+        self,
+        filename,
+        max_bytes=10_000_000,
+        rotate_seconds=None,
+        backup_count=10,
+        compress=True,
+        encoding='utf-8',
+    ):
+        super().__init__(filename, encoding=encoding)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.compress = compress
+        self._size = os.path.getsize(self.baseFilename)
+        self._rotate_at = self._next_rotation(
+            os.path.getmtime(self.baseFilename) if self._size > 0 else time.time())
 
     def emit(self, record):
-        return super().emit(record)
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        try:
+            data = ''.join(self.format(r) + '\n' for r in records)
+            if self._should_rotate(len(data)):
+                self.rotate()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(data)
+            self.stream.flush()
+            self._size += len(data)
+        except Exception:
+            for record in records:
+                self.handleError(record)
+
+    def rotate(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None # type: ignore
+
+        path = pathlib.Path(self.baseFilename)
+        if path.exists() and path.stat().st_size > 0:
+            stamp = dt.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+            rotated = path.with_name(f'{path.stem}.{stamp}{path.suffix}')
+            path.rename(rotated)
+            if self.compress:
+                with rotated.open('rb') as f_in, \
+                        gzip.open(f'{rotated}.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                rotated.unlink()
+            self._remove_old_backups(path)
+
+        self._size = 0
+        self._rotate_at = self._next_rotation(time.time())
+
+    def _should_rotate(self, n_bytes):
+        if self.max_bytes and self._size > 0 and self._size + n_bytes > self.max_bytes:
+            return True
+        return self._rotate_at is not None and time.time() >= self._rotate_at
+
+    def _next_rotation(self, start):
+        if not self.rotate_seconds:
+            return None
+        return start + self.rotate_seconds
+
+    def _remove_old_backups(self, path: pathlib.Path):
+        backups = sorted(path.parent.glob(f'{path.stem}.*{path.suffix}*'))
+        for f in backups[:max(len(backups) - self.backup_count, 0)]:
+            f.unlink()
 
 
 class MyJSONFormatter(logging.Formatter):
@@ -96,10 +333,11 @@ class MyJSONFormatter(logging.Formatter):
     ):
         super().__init__()
         self.fmt_keys = fmt_keys if fmt_keys is not None else {}
+        self._encoder = json.JSONEncoder(default=str)
 
     def format(self, record: logging.LogRecord) -> str:
         message = self._prepare_log_dict(record)
-        return json.dumps(message, default=str)
+        return self._encoder.encode(message)
 
     def _prepare_log_dict(self, record: logging.LogRecord):
         always_fields = {
@@ -110,6 +348,8 @@ class MyJSONFormatter(logging.Formatter):
         }
         if record.exc_info is not None:
             always_fields["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            always_fields["exc_info"] = record.exc_text
 
         if record.stack_info is not None:
             always_fields["stack_info"] = self.formatStack(record.stack_info)
@@ -131,4 +371,4 @@ class MyJSONFormatter(logging.Formatter):
 
 class NonErrorFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> Union[bool, logging.LogRecord]:
-        return record.levelno <= logging.INFO
\ No newline at end of file
+        return record.levelno <= logging.INFO
@@ -1,26 +1,28 @@
 import datetime
 import pathlib
-from typing import List, Optional
+from typing import Any, List, Optional
 from typing_extensions import Annotated
 
 import yaml
 from rich import print
 from rich.console import Console
-from rich.syntax import Syntax
 import typer
 
 from . import __version__, __copyright__, __maintainer__, __email__
 from . import config as cfg
 from . import const
-from . import convert_production_summaries_access_to_parquet as convert_prod
 from . import enum
 from . import logger as lgr
-from . import scrape_production_summaries as scrape_prod
-from . import transform_production_summaries as transform_prod
+from . import telemetry
 from . import utils
 
+# Stage modules pull in polars, requests and arrow-odbc, so they are imported
+# inside the commands that run stages. That keeps --help, --version and the
+# config options fast; `python -m ecmc_scraper.benchmark --import-budget-ms`
+# checks this doesn't regress.
 
-default_dir = pathlib.Path.home() / 'Documents/ecmc-data'
+
+default_dir = const.DEFAULT_DATA_DIR
 app = typer.Typer(no_args_is_help=True)
 url_config_from_global_config_file = None
 transform_config_from_global_config_file = None
@@ -48,6 +50,8 @@ def show_default_config_callback(ctx: typer.Context, value: bool):
     if not value:
         return value
     
+    from rich.syntax import Syntax
+
     config_dict = get_default_config(ctx)
 
     Console().print(Syntax(yaml.dump(config_dict, indent=4),'yaml'))
@@ -82,6 +86,37 @@ def get_default_config(ctx: typer.Context) -> dict:
     return utils.to_json(config_dict) # type: ignore
 
 
+def print_summary(summary: dict[str, telemetry.SpanTotal]) -> None:
+    from rich.table import Table
+
+    table = Table('step', 'count', 'seconds', 'rows', 'rows/s', 'MB', 'peak RSS MB')
+    for name, total in sorted(summary.items()):
+        table.add_row(
+            name,
+            str(total.count),
+            f'{total.wall_seconds:.2f}',
+            f'{total.rows:,}',
+            f'{total.rows / total.wall_seconds:,.0f}'
+            if total.rows > 0 and total.wall_seconds > 0 else '',
+            f'{total.bytes / 1e6:,.1f}',
+            f'{total.peak_rss / 1e6:,.0f}',
+        )
+    Console().print(table)
+
+
+def cli_value(value: Optional[str]) -> Any:
+    # numbers are compared as numbers, so the column statistics of numeric
+    # columns can rule out years
+    if value is None:
+        return None
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
 def config_callback(ctx: typer.Context, value):
     if value is None:
         return value
@@ -97,7 +132,7 @@ def config_callback(ctx: typer.Context, value):
         transform_config_from_global_config_file = conf['transform_config']
 
     for k in conf.keys():
-        if k.endswith('_dir'):
+        if k.endswith(('_dir', '_file')) and conf[k] is not None:
             conf[k] = pathlib.Path(conf[k])
 
     ctx.default_map = ctx.default_map or {}
@@ -188,8 +223,23 @@ def production_summaries(
     parquet_dir: pathlib.Path = default_dir / 'production-summaries/parquet',
     log_dir: pathlib.Path = default_dir / 'production-summaries/logs',
     export_dir: pathlib.Path = default_dir / 'production-summaries/export',
+    catalog_file: Annotated[
+        pathlib.Path,
+        typer.Option(help='SQLite catalog of every downloaded, converted and exported file.'),
+    ] = default_dir / 'production-summaries/catalog.sqlite',
     access_driver: enum.MsAccessDriver = enum.MsAccessDriver.x64,
     export_type: enum.OutputType = enum.OutputType.csv,
+    export_changes: Annotated[
+        bool,
+        typer.Option(
+            '--export-changes',
+            help='Also write the wells inserted, updated and deleted since the previous export of each year.',
+        ),
+    ] = False,
+    intermediate_format: Annotated[
+        enum.IntermediateFormat,
+        typer.Option(help='Format the transform step reads converted tables from. Parquet is always written.'),
+    ] = enum.IntermediateFormat.parquet,
     transform: Annotated[
         bool,
         typer.Option(
@@ -197,6 +247,59 @@ def production_summaries(
             help='Transform data before export (read documentation for more details).',
         ),
     ] = False,
+    download_workers: Annotated[
+        int,
+        typer.Option(min=1, help='Number of years downloaded at the same time.'),
+    ] = 4,
+    convert_workers: Annotated[
+        int,
+        typer.Option(min=1, help='Number of years converted to parquet at the same time.'),
+    ] = 2,
+    transform_workers: Annotated[
+        int,
+        typer.Option(min=1, help='Number of years transformed at the same time.'),
+    ] = 2,
+    memory_budget: Annotated[
+        Optional[int],
+        typer.Option(
+            min=1,
+            help='MiB of memory the years being processed may use at once, estimated from earlier runs. Unlimited by default.',
+            show_default=False,
+        ),
+    ] = None,
+    quality_policy: Annotated[
+        enum.QualityPolicy,
+        typer.Option(help='What to do with rows that break a data quality rule: keep them, move them to a quarantine file next to the quality report, or fail the year.'),
+    ] = enum.QualityPolicy.report,
+    queue_dir: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(
+            help='Shared directory, e.g. on NFS, to spread the years over several hosts through. The data directories and catalog file have to be on the shared filesystem too.',
+            show_default=False,
+        ),
+    ] = None,
+    queue_role: Annotated[
+        enum.QueueRole,
+        typer.Option(help='With --queue-dir, the coordinator submits the years and works on them; workers only work on them.'),
+    ] = enum.QueueRole.coordinator,
+    queue_workers: Annotated[
+        int,
+        typer.Option(min=1, help='Number of tasks this host runs at the same time with --queue-dir.'),
+    ] = 2,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            '--resume',
+            help='Resume the last run if it failed or was interrupted, skipping the years and stages it finished. Queued runs resume on their own.',
+        ),
+    ] = False,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            '--profile',
+            help='Write cProfile data and Polars query profiles to a timestamped directory under the log directory.',
+        ),
+    ] = False,
     url_config: Annotated[
         Optional[typer.FileText],
         typer.Option(
@@ -252,11 +355,17 @@ def production_summaries(
         config.log_dir,
     )
 
-    scrape_prod.scrape(config, logger)
-    convert_prod.convert(config, logger)
+    from . import pipeline
+    from . import profiling
 
-    if transform:
-        transform_prod.transform(config, logger)   
+    if profile:
+        with profiling.session(config.log_dir, logger):
+            pipeline.production_summaries(config, logger)
+    else:
+        pipeline.production_summaries(config, logger)
+
+    if not quiet:
+        print_summary(telemetry.summary())
 
     if show_config or write_config_to_file is not None:
         config_dict = utils.to_json(config_dict)
@@ -265,4 +374,374 @@ def production_summaries(
             yaml.dump(config_dict, write_config_to_file.open('w'), indent=4)
 
         if show_config and not quiet:
-            Console().print(Syntax(yaml.dump(config_dict, indent=4),'yaml'))
\ No newline at end of file
+            from rich.syntax import Syntax
+            Console().print(Syntax(yaml.dump(config_dict, indent=4),'yaml'))
+
+@app.command()
+def bench(
+    years: Annotated[
+        List[int],
+        typer.Option(min=1999, help='Years of synthetic data to run through the pipeline.'),
+    ] = const.DEFAULT_YEARS,
+    rows: Annotated[
+        int,
+        typer.Option(min=1, help='Rows in each year\'s synthetic production table.'),
+    ] = 100_000,
+    repeat: Annotated[int, typer.Option(min=1, help='Runs to keep the fastest of.')] = 1,
+    download_workers: Annotated[int, typer.Option(min=1)] = 4,
+    convert_workers: Annotated[int, typer.Option(min=1)] = 2,
+    transform_workers: Annotated[int, typer.Option(min=1)] = 2,
+    latency_ms: Annotated[
+        float,
+        typer.Option(min=0, help='Delay before each response of the stand-in ECMC server.'),
+    ] = 0.0,
+    bandwidth_mbps: Annotated[
+        Optional[float],
+        typer.Option(min=0.001, help='Bandwidth limit of the stand-in server, in megabytes per second.', show_default=False),
+    ] = None,
+    failure_rate: Annotated[
+        float,
+        typer.Option(min=0, max=1, help='Fraction of requests the stand-in server fails with 503.'),
+    ] = 0.0,
+    seed: int = 0,
+    output: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Write results to this JSON file.', show_default=False),
+    ] = None,
+    baseline: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Compare against this results file.', show_default=False),
+    ] = None,
+    threshold: Annotated[
+        float,
+        typer.Option(help='Allowed slowdown against the baseline, as a fraction.'),
+    ] = 0.2,
+    scratch_dir: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Where to write synthetic data.', show_default=False),
+    ] = None,
+    log_level: enum.LogLevel = enum.LogLevel.INFO,
+    log_dir: pathlib.Path = default_dir / 'production-summaries/logs',
+):
+    """
+    Runs the whole pipeline on synthetic data served by a local stand-in for
+    the ECMC website, and exits non-zero if it got slower than a baseline.
+    """
+    from . import bench as bnch
+    from . import benchmark
+
+    logger = lgr.get_logger('bench', log_level, log_dir)
+    results = bnch.run(
+        years,
+        rows,
+        logger,
+        repeat=repeat,
+        download_workers=download_workers,
+        convert_workers=convert_workers,
+        transform_workers=transform_workers,
+        latency=latency_ms / 1000,
+        bandwidth=None if bandwidth_mbps is None else bandwidth_mbps * 1e6,
+        failure_rate=failure_rate,
+        seed=seed,
+        scratch_dir=scratch_dir,
+    )
+    for r in results:
+        rss = 'n/a' if r.peak_rss_increase is None else f'{r.peak_rss_increase / 2**20:.1f} MiB'
+        typer.echo(
+            f'{r.name:<24}{r.seconds:>10.3f} s{r.rows_per_second:>16,.0f} rows/s'
+            f'{r.bytes_per_second / 1e6:>10.1f} MB/s  peak +{rss}'
+        )
+
+    if output is not None:
+        benchmark.write_results(results, output)
+
+    if baseline is not None:
+        regressions = benchmark.compare(
+            results, benchmark.read_results(baseline), threshold)
+        for r, b in regressions:
+            typer.echo(
+                f'REGRESSION {r.name} at {r.rows:,} rows: '
+                f'{r.seconds:.3f} s vs {b.seconds:.3f} s',
+                err=True,
+            )
+        if len(regressions) > 0:
+            raise typer.Exit(1)
+
+
+@app.command()
+def sync_mirror(
+    mirror: Annotated[
+        pathlib.Path,
+        typer.Argument(help='Directory the zips and their manifest are written to.', show_default=False),
+    ],
+    years: Annotated[
+        List[int],
+        typer.Option(
+            min=1999,
+            max=datetime.datetime.now().year,
+            help='a list of the report years desired.',
+        ),
+    ] = const.DEFAULT_YEARS,
+    url_config: Annotated[
+        Optional[typer.FileText],
+        typer.Option(
+            help='YAML Configuration file used to change url arguments.',
+            show_default=False,
+        ),
+    ] = None,
+    workers: Annotated[
+        int,
+        typer.Option(min=1, help='Number of years downloaded at the same time.'),
+    ] = 4,
+    log_level: enum.LogLevel = enum.LogLevel.INFO,
+    log_dir: pathlib.Path = default_dir / 'production-summaries/logs',
+):
+    """
+    Downloads ECMC Production Summaries into a mirror that scrapes on other
+    hosts can read from instead of ECMC.
+    """
+    from . import scrape_production_summaries as scrape_prod
+
+    url_config_data = dict(const.DEFAULT_URL_CONFIG)
+    if url_config is not None:
+        url_config_data.update(yaml.safe_load(url_config))
+
+    logger = lgr.get_logger('sync_mirror', log_level, log_dir)
+    changed = scrape_prod.sync_mirror(
+        years,
+        cfg.ProductionSummariesUrlConfig.from_dict(url_config_data),
+        mirror,
+        logger,
+        workers=workers,
+    )
+    print(f'{sum(changed.values())} of {len(changed)} years changed in {mirror}')
+
+
+@app.command()
+def well_history(
+    api_num: Annotated[
+        str,
+        typer.Argument(
+            help='API number like 05-123-45678-00. Leave out the sidetrack to get every sidetrack.',
+            show_default=False,
+        ),
+    ],
+    table: enum.LookupTable = enum.LookupTable.production,
+    catalog_file: Annotated[
+        pathlib.Path,
+        typer.Option(help='SQLite catalog of every downloaded, converted and exported file.'),
+    ] = default_dir / 'production-summaries/catalog.sqlite',
+    output: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Write the rows to this CSV file instead of printing them.', show_default=False),
+    ] = None,
+):
+    """
+    Looks up every converted year of one well.
+    """
+    from . import catalog as ctlg
+    from . import query
+
+    try:
+        df = query.well_history(ctlg.Catalog(catalog_file), api_num, table)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
+    if output is not None:
+        df.write_csv(output)
+    else:
+        print(df)
+
+@app.command()
+def find_rows(
+    column: Annotated[
+        str,
+        typer.Argument(help='Column to filter on, e.g. Prod_days.', show_default=False),
+    ],
+    low: Annotated[
+        Optional[str],
+        typer.Option('--min', help='Lowest value to keep.', show_default=False),
+    ] = None,
+    high: Annotated[
+        Optional[str],
+        typer.Option('--max', help='Highest value to keep.', show_default=False),
+    ] = None,
+    table: enum.LookupTable = enum.LookupTable.production,
+    catalog_file: Annotated[
+        pathlib.Path,
+        typer.Option(help='SQLite catalog of every downloaded, converted and exported file.'),
+    ] = default_dir / 'production-summaries/catalog.sqlite',
+    output: Annotated[
+        Optional[pathlib.Path],
+        typer.Option(help='Write the rows to this CSV file instead of printing them.', show_default=False),
+    ] = None,
+):
+    """
+    Finds the rows of every converted year with a column from --min to
+    --max. Years whose column statistics rule out the range aren't read.
+    """
+    from . import catalog as ctlg
+    from . import query
+
+    df = query.scan(
+        ctlg.Catalog(catalog_file), table, column, cli_value(low), cli_value(high),
+    ).collect()
+
+    if output is not None:
+        df.write_csv(output)
+    else:
+        print(df)
+
+
+@app.command()
+def lineage(
+    file_or_hash: Annotated[
+        str,
+        typer.Argument(
+            help='A downloaded, converted or exported file, or the sha256 of one.',
+            show_default=False,
+        ),
+    ],
+    catalog_file: Annotated[
+        pathlib.Path,
+        typer.Option(help='SQLite catalog of every downloaded, converted and exported file.'),
+    ] = default_dir / 'production-summaries/catalog.sqlite',
+):
+    """
+    Shows what a file was made from, back to the zip downloaded from ECMC.
+    """
+    from . import catalog as ctlg
+
+    catalog = ctlg.Catalog(catalog_file)
+    path = pathlib.Path(file_or_hash)
+    artifact = catalog.find_path(path) or catalog.find_path(path.resolve())
+    if artifact is None:
+        found = catalog.find_hash(file_or_hash.lower())
+        artifact = found[-1] if len(found) > 0 else None
+    if artifact is None:
+        raise typer.BadParameter(f'{file_or_hash} is not in {catalog_file}')
+
+    for a in catalog.lineage(artifact):
+        print(
+            f'{a.stage} {a.year}, generation {a.generation}'
+            f'{"" if a.current else " (not current)"}: {a.hash[:12]} {a.timestamp}'
+        )
+        for key, f in a.files.items():
+            print(f'    {key}: {f}')
+
+
+@app.command()
+def what_changed(
+    year: Annotated[int, typer.Argument(help='Year to compare.', show_default=False)],
+    generation: Annotated[
+        Optional[int],
+        typer.Option(help='Generation to compare with the one before it. Defaults to the current generation.', show_default=False),
+    ] = None,
+    catalog_file: Annotated[
+        pathlib.Path,
+        typer.Option(help='SQLite catalog of every downloaded, converted and exported file.'),
+    ] = default_dir / 'production-summaries/catalog.sqlite',
+):
+    """
+    Summarizes how a year's converted tables changed between two generations,
+    from the column statistics in the catalog.
+    """
+    from . import catalog as ctlg
+    from . import query
+    from . import stats
+
+    catalog = ctlg.Catalog(catalog_file)
+    if generation is None:
+        new = catalog.current(enum.CatalogStage.parquet, year)
+    else:
+        new = catalog.generation(enum.CatalogStage.parquet, year, generation)
+    if new is None:
+        raise typer.BadParameter(f'no converted files for {year}')
+    old = catalog.generation(enum.CatalogStage.parquet, year, new.generation - 1)
+    if old is None:
+        print(f'generation {new.generation} is the first for {year}')
+        return
+
+    for table, file_key in query.table_keys.items():
+        old_stats = catalog.column_stats(old, file_key)
+        new_stats = catalog.column_stats(new, file_key)
+        if len(old_stats) == 0 or len(new_stats) == 0:
+            print(f'{table}: no statistics recorded')
+            continue
+        changes = stats.compare(old_stats, new_stats)
+        print(f'{table} {year}, generation {old.generation} -> {new.generation}: '
+            f'{len(changes)} changes')
+        for line in changes:
+            print(f'    {line}')
+
+
+@app.command()
+def watch(
+    config_file: Annotated[
+        Optional[typer.FileText],
+        typer.Option(
+            '--config',
+            '-c',
+            help='YAML configuration file of production-summaries, e.g. one written by --write-config-to-file.',
+            show_default=False,
+        ),
+    ] = None,
+    years: Annotated[
+        Optional[List[int]],
+        typer.Option(
+            min=1999,
+            max=datetime.datetime.now().year,
+            help='Years to watch, instead of the ones in the configuration file.',
+            show_default=False,
+        ),
+    ] = None,
+    interval_minutes: Annotated[
+        float,
+        typer.Option(min=0.1, help='Minutes between checks of the ECMC website, give or take some jitter.'),
+    ] = const.WATCH_INTERVAL_SECONDS / 60,
+    port: Annotated[
+        int,
+        typer.Option(min=0, max=65535, help='Port of the health endpoint on localhost. 0 picks a free port.'),
+    ] = const.WATCH_HEALTH_PORT,
+    once: Annotated[
+        bool,
+        typer.Option(help='Check once, run the years that changed and exit.'),
+    ] = False,
+):
+    """
+    Keeps the exports up to date, checking ECMC for new zips every interval
+    and running only the years that changed.
+    """
+    import signal
+
+    from . import production_summaries as prod
+    from . import watch as wtch
+
+    conf = {} if config_file is None else yaml.safe_load(config_file) or {}
+    for key, default in (
+        ('url_config', const.DEFAULT_URL_CONFIG),
+        ('transform_config', const.DEFAULT_TRANSFORM_CONFIG),
+    ):
+        conf[key] = {**default, **(conf.get(key) or {})}
+    conf = {
+        k: v
+        for k, v in conf.items()
+        if k not in const.NON_CONFIG_OPTIONS or k in ('url_config', 'transform_config')
+    }
+    if years is not None:
+        conf['years'] = years
+    config = prod.default_config(**conf)
+
+    logger = lgr.get_logger('watch', config.log_level, config.log_dir)
+    watcher = wtch.Watcher(config, logger, interval=interval_minutes * 60)
+    if once:
+        watcher.step()
+        if watcher.failures > 0:
+            raise typer.Exit(1)
+        return
+
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+    try:
+        watcher.run(port)
+    except KeyboardInterrupt:
+        watcher.stop()
@@ -0,0 +1,113 @@
+'''
+Process memory measurements that work without optional dependencies on Linux,
+macOS and Windows.
+'''
+
+
+import ctypes
+import os
+import sys
+import threading
+from typing import Optional
+
+
+def current_rss() -> Optional[int]:
+    '''
+    Resident set size of this process in bytes, or None if it can't be read.
+    '''
+    if sys.platform == 'win32':
+        counters = _windows_memory_counters()
+        return None if counters is None else counters.WorkingSetSize
+
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> Optional[int]:
+    '''
+    Highest resident set size this process has reached, in bytes.
+    '''
+    if sys.platform == 'win32':
+        counters = _windows_memory_counters()
+        return None if counters is None else counters.PeakWorkingSetSize
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class PeakRss:
+    '''
+    Samples the resident set size in a background thread to find the peak
+    reached inside a with block, since the process-wide peak can't be reset.
+    '''
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start: Optional[int] = None
+        self.peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> 'PeakRss':
+        self.start = current_rss()
+        self.peak = self.start
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._update()
+
+    @property
+    def increase(self) -> Optional[int]:
+        if self.start is None or self.peak is None:
+            return None
+        return self.peak - self.start
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._update()
+
+    def _update(self) -> None:
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [
+        ('cb', ctypes.c_ulong),
+        ('PageFaultCount', ctypes.c_ulong),
+        ('PeakWorkingSetSize', ctypes.c_size_t),
+        ('WorkingSetSize', ctypes.c_size_t),
+        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+        ('PagefileUsage', ctypes.c_size_t),
+        ('PeakPagefileUsage', ctypes.c_size_t),
+    ]
+
+
+def _windows_memory_counters() -> Optional[_ProcessMemoryCounters]:
+    counters = _ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    try:
+        ok = ctypes.windll.psapi.GetProcessMemoryInfo( # type: ignore
+            ctypes.windll.kernel32.GetCurrentProcess(), # type: ignore
+            ctypes.byref(counters),
+            counters.cb,
+        )
+    except (AttributeError, OSError):
+        return None
+    return counters if ok else None
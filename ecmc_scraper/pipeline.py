@@ -0,0 +1,708 @@
+'''
+Runs the production summaries stages as a per-year pipeline. Each stage has
+its own pool of worker threads and a bounded queue feeding it, so one year can
+be converted while the next is downloading and the previous is transformed.
+A scheduler holds back years whose estimated memory doesn't fit in the
+memory budget next to the years already running.
+
+Every (stage, year) the pipeline finishes is checkpointed in the catalog, and
+every file is written to a temporary file that only replaces its final path
+once it is complete. Resuming a run that failed or was interrupted skips the
+units it finished and redoes the rest. Units are locked while they run (see
+locks.py), and each invocation downloads into its own temporary directory, so
+invocations working on the same data can run at the same time.
+
+With a queue directory, each (stage, year) is instead a task in a work queue
+on a shared filesystem (see workqueue.py), so several hosts can work through
+the years together.
+'''
+
+
+import contextlib
+from dataclasses import dataclass, replace
+import datetime
+import logging
+import pathlib
+import queue
+import shutil
+import socket
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional
+import uuid
+
+from . import catalog as ctlg
+from . import config as cfg
+from . import const
+from . import convert_production_summaries_access_to_parquet as convert_prod
+from . import enum
+from . import locks as lck
+from . import profiling
+from . import scheduler as sched
+from . import scrape_production_summaries as scrape_prod
+from . import telemetry
+from . import transform_production_summaries as transform_prod
+from . import utils
+from . import workqueue
+
+
+_DONE = object()
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    # returns the year of an item and the bytes of input it reads, for the
+    # scheduler
+    size: Optional[Callable[[Any], tuple[int, int]]] = None
+
+
+class Pipeline:
+
+    def __init__(
+        self,
+        stages: list[Stage],
+        logger: logging.Logger,
+        queue_size: Optional[int] = None,
+        scheduler: Optional[sched.Scheduler] = None,
+    ):
+        self.stages = stages
+        self.logger = logger
+        self.scheduler = scheduler
+        self._queues = [
+            queue.Queue(
+                maxsize=queue_size if queue_size is not None else 2 * s.workers)
+            for s in stages
+        ]
+        self._remaining = [s.workers for s in stages]
+        self._results = []
+        self._errors: list[BaseException] = []
+        self._failed = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self, items: Iterable) -> list:
+        threads = [
+            threading.Thread(
+                target=self._work,
+                args=(i,),
+                name=f'{stage.name}-{n}',
+                daemon=True,
+            )
+            for i, stage in enumerate(self.stages)
+            for n in range(stage.workers)
+        ]
+        for t in threads:
+            t.start()
+
+        for item in items:
+            if self._failed.is_set():
+                break
+            self._queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self._queues[0].put(_DONE)
+
+        for t in threads:
+            t.join()
+
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+        return self._results
+
+    def _work(self, i: int) -> None:
+        with contextlib.ExitStack() as stack:
+            _profile_thread(stack, self.logger)
+            self._work_stage(i)
+
+    def _work_stage(self, i: int) -> None:
+        stage = self.stages[i]
+        while (item := self._queues[i].get()) is not _DONE:
+            if self._failed.is_set():
+                continue
+            try:
+                self.logger.debug('%s started %s', stage.name, item)
+                with self._schedule(stage, item), \
+                        telemetry.span(f'stage.{stage.name}', self.logger):
+                    result = stage.func(item)
+            except BaseException as e:
+                self.logger.error(f'{stage.name} failed on {item}: {e!r}')
+                with self._lock:
+                    self._errors.append(e)
+                self._failed.set()
+                continue
+
+            if i + 1 < len(self.stages):
+                self._queues[i + 1].put(result)
+            else:
+                with self._lock:
+                    self._results.append(result)
+
+        with self._lock:
+            self._remaining[i] -= 1
+            finished = self._remaining[i] == 0
+        if finished and i + 1 < len(self.stages):
+            for _ in range(self.stages[i + 1].workers):
+                self._queues[i + 1].put(_DONE)
+
+    def _schedule(self, stage: Stage, item):
+        if self.scheduler is None or stage.size is None:
+            return contextlib.nullcontext()
+        return self.scheduler.run(stage.name, *stage.size(item))
+
+
+class Checkpoints:
+    '''
+    The (stage, year) units a run has finished, each with the artifact it
+    produced. With locks, a unit is locked while it runs, and a unit another
+    invocation finished while this one waited for its lock isn't run again.
+    '''
+
+    def __init__(
+        self,
+        catalog: ctlg.Catalog,
+        run: ctlg.Run,
+        logger: logging.Logger,
+        locks: Optional[lck.Locks] = None,
+    ):
+        self.catalog = catalog
+        self.run = run
+        self.logger = logger
+        self.locks = locks
+        self._finished = catalog.checkpoints(run)
+
+    def finished(self, stage: str, year: int) -> Optional[ctlg.Artifact]:
+        '''
+        The artifact of a unit the run finished, if it is still current and
+        its files are all there.
+        '''
+        artifact_id = self._finished.get((stage, year))
+        artifact = None if artifact_id is None else self.catalog.get(artifact_id)
+        if artifact is None or not artifact.current or not artifact.exists():
+            return None
+        return artifact
+
+    def record(self, stage: str, artifact: ctlg.Artifact) -> None:
+        self.catalog.checkpoint(self.run, stage, artifact)
+
+    def resumable(
+        self,
+        stage: str,
+        func: Callable[[Any], ctlg.Artifact],
+    ) -> Callable[[Any], ctlg.Artifact]:
+        '''
+        func for a stage whose items are years or artifacts, skipping the
+        years the run already finished.
+        '''
+        def run(item) -> ctlg.Artifact:
+            year = item if isinstance(item, int) else item.year
+            artifact = self.finished(stage, year)
+            if artifact is not None:
+                self.logger.info(
+                    f'skipped {stage} for {year}, run {self.run.id} finished it')
+                return artifact
+
+            since = datetime.datetime.now().isoformat()
+            with self._hold(stage, year) as waited:
+                artifact = self._finished_elsewhere(stage, year, since) \
+                    if waited else None
+                if artifact is None:
+                    artifact = func(item)
+                # before the lock is released, for whoever waits for it
+                self.record(stage, artifact)
+            return artifact
+
+        return run
+
+    def _hold(self, stage: str, year: int) -> contextlib.AbstractContextManager[bool]:
+        if self.locks is None:
+            return contextlib.nullcontext(False)
+        return self.locks.unit(stage, year, self.logger)
+
+    def _finished_elsewhere(
+        self,
+        stage: str,
+        year: int,
+        since: str,
+    ) -> Optional[ctlg.Artifact]:
+        artifact_id = self.catalog.finished_since(
+            stage, year, since, self.run.config_fingerprint)
+        artifact = None if artifact_id is None else self.catalog.get(artifact_id)
+        if artifact is None or not artifact.current or not artifact.exists():
+            return None
+        self.logger.info(
+            f'skipped {stage} for {year}, another run finished it while this '
+            'one waited'
+        )
+        return artifact
+
+
+def production_summaries(
+    config: cfg.ProductionSummariesConfig,
+    logger: logging.Logger,
+    catalog: Optional[ctlg.Catalog] = None,
+    read_table: Optional[convert_prod.ReadTable] = None,
+) -> list[ctlg.Artifact]:
+    '''
+    Runs the pipeline for config.years. A long-running caller can pass the
+    catalog it keeps open instead of opening it again, and the bench passes
+    a read_table that reads its synthetic Access databases.
+    '''
+    if config.queue_dir is not None:
+        return _production_summaries_queue(config, logger, read_table)
+
+    telemetry.reset()
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    access_db_backup_path = config.access_db_dir / 'previous_versions' / timestamp
+    parquet_backup_path = config.parquet_dir / 'previous_versions' / timestamp
+    export_backup_path = config.export_dir / 'previous_versions' / timestamp
+
+    config.access_db_dir.mkdir(parents=True, exist_ok=True)
+
+    catalog = catalog or open_catalog(config, logger)
+    locks = open_locks(config)
+    scheduler = sched.Scheduler(
+        catalog,
+        None if config.memory_budget is None else config.memory_budget * 2**20,
+        logger,
+    )
+    zip_sizes = {a.year: a.size for a in catalog.artifacts(enum.CatalogStage.zip)}
+    checkpoints = _start_run(config, catalog, logger, locks)
+
+    with private_temp_dir(config, locks, logger) as temp_dir:
+        stages = [
+            Stage(
+                'scrape',
+                checkpoints.resumable('scrape', lambda year: scrape_prod.scrape_year(
+                    year, config, catalog, access_db_backup_path, logger, temp_dir)),
+                workers=config.download_workers,
+                # years that were never downloaded are assumed to be the largest
+                size=lambda year: (
+                    year, zip_sizes.get(year, max(zip_sizes.values(), default=0))),
+            ),
+            Stage(
+                'convert',
+                checkpoints.resumable('convert', lambda artifact: convert_prod.convert_year(
+                    artifact, config, catalog, parquet_backup_path, logger, read_table)),
+                workers=config.convert_workers,
+                size=_artifact_size,
+            ),
+        ]
+
+        exporter = None
+        if config.transform:
+            # an export that is current is never written again, so the
+            # transform needs no skipping of its own, and the exporter locks
+            # each year as it writes it
+            exporter = _get_exporter(
+                config, catalog, export_backup_path, logger,
+                on_export=lambda artifact: checkpoints.record('transform', artifact),
+                locks=locks,
+            )
+            stages.append(Stage(
+                'transform',
+                lambda artifact: transform_prod.transform_year(
+                    artifact, config, exporter, logger), # type: ignore
+                workers=config.transform_workers,
+                size=_artifact_size,
+            ))
+
+        try:
+            with telemetry.span('production_summaries', logger):
+                results = Pipeline(stages, logger, scheduler=scheduler).run(
+                    _order_years(config, catalog))
+
+                if exporter is not None:
+                    exporter.close()
+        except BaseException:
+            catalog.finish_run(checkpoints.run, enum.RunStatus.failed)
+            logger.error(
+                f'run {checkpoints.run.id} failed, rerun with --resume to redo '
+                'only the years and stages it did not finish'
+            )
+            raise
+        catalog.finish_run(checkpoints.run, enum.RunStatus.finished)
+
+    telemetry.log_summary(logger)
+
+    return results
+
+
+def export_years(
+    config: cfg.ProductionSummariesConfig,
+    logger: logging.Logger,
+    catalog: Optional[ctlg.Catalog] = None,
+) -> list[ctlg.Artifact]:
+    '''
+    Runs only the transform stage on the current parquet files of
+    config.years, e.g. to join years that didn't change with new completions.
+    Exports that are already current are left alone.
+    '''
+    catalog = catalog or open_catalog(config, logger)
+    parquet_artifacts = [
+        a for a in catalog.artifacts(enum.CatalogStage.parquet)
+        if a.year in config.years
+    ]
+    if len(parquet_artifacts) == 0:
+        return []
+
+    config = replace(config, years=[a.year for a in parquet_artifacts])
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    exporter = _get_exporter(
+        config, catalog, config.export_dir / 'previous_versions' / timestamp, logger,
+        locks=open_locks(config),
+    )
+    stages = [Stage(
+        'transform',
+        lambda artifact: transform_prod.transform_year(
+            artifact, config, exporter, logger),
+        workers=config.transform_workers,
+    )]
+    with telemetry.span('export_years', logger):
+        # the completions year goes first, as in a full run
+        results = Pipeline(stages, logger).run(sorted(
+            parquet_artifacts,
+            key=lambda a: a.year != exporter.completions_year,
+        ))
+        exporter.close()
+    return results
+
+
+def _start_run(
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    logger: logging.Logger,
+    locks: Optional[lck.Locks] = None,
+) -> Checkpoints:
+    '''
+    Resumes the last run if config.resume is set and that run didn't finish,
+    otherwise starts a new one.
+    '''
+    fingerprint = _run_fingerprint(config)
+    if config.resume:
+        run = catalog.last_run()
+        if run is None or run.status == enum.RunStatus.finished:
+            logger.info('no failed or interrupted run to resume, starting a new one')
+        elif run.config_fingerprint != fingerprint:
+            logger.warning(
+                f'run {run.id} used a different configuration, '
+                'starting a new run instead of resuming it'
+            )
+        else:
+            checkpoints = Checkpoints(catalog, run, logger, locks)
+            _report_resume(config, checkpoints, logger)
+            return checkpoints
+
+    return Checkpoints(
+        catalog, catalog.start_run(config.years, fingerprint), logger, locks)
+
+
+def _report_resume(
+    config: cfg.ProductionSummariesConfig,
+    checkpoints: Checkpoints,
+    logger: logging.Logger,
+) -> None:
+    run = checkpoints.run
+    logger.info(f'resuming run {run.id}, {run.status} since {run.started}')
+    stages = ['scrape', 'convert'] + (['transform'] if config.transform else [])
+    for stage in stages:
+        skipped = [
+            year for year in sorted(config.years)
+            if checkpoints.finished(stage, year) is not None
+        ]
+        redone = sorted(set(config.years) - set(skipped))
+        logger.info(
+            f'{stage}: skipping {_years(skipped)}, redoing {_years(redone)}',
+            extra={'stage': stage, 'skipped': skipped, 'redone': redone},
+        )
+
+
+def _years(years: list[int]) -> str:
+    return ', '.join(map(str, years)) if len(years) > 0 else 'none'
+
+
+def _run_fingerprint(config: cfg.ProductionSummariesConfig) -> str:
+    # the options that change what the units produce
+    return ctlg.fingerprint({
+        'access_driver': config.access_driver,
+        'export_changes': config.export_changes,
+        'intermediate_format': config.intermediate_format,
+        'quality_policy': config.quality_policy,
+        'transform': config.transform,
+        'transform_config': ctlg.fingerprint(config.transform_config),
+        'url_config': ctlg.fingerprint(config.url_config),
+    })
+
+
+def _production_summaries_queue(
+    config: cfg.ProductionSummariesConfig,
+    logger: logging.Logger,
+    read_table: Optional[convert_prod.ReadTable] = None,
+) -> list[ctlg.Artifact]:
+    '''
+    Works on the tasks in config.queue_dir until none are left, after
+    submitting the years as tasks if this host is the coordinator.
+    '''
+    telemetry.reset()
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    access_db_backup_path = config.access_db_dir / 'previous_versions' / timestamp
+    parquet_backup_path = config.parquet_dir / 'previous_versions' / timestamp
+    export_backup_path = config.export_dir / 'previous_versions' / timestamp
+    config.access_db_dir.mkdir(parents=True, exist_ok=True)
+
+    catalog = open_catalog(config, logger)
+    locks = open_locks(config)
+    work_queue = workqueue.WorkQueue(
+        config.queue_dir, lease_seconds=const.QUEUE_LEASE_SECONDS) # type: ignore
+    if config.queue_role == enum.QueueRole.coordinator:
+        _submit(config, catalog, work_queue, logger)
+
+    with private_temp_dir(config, locks, logger) as temp_dir:
+        exporters: dict[int, transform_prod.Exporter] = {}
+        exporter_lock = threading.Lock()
+
+        def get_exporter(completions_year: int) -> transform_prod.Exporter:
+            # the completions are converted before any transform task runs
+            with exporter_lock:
+                if completions_year not in exporters:
+                    exporters[completions_year] = transform_prod.Exporter(
+                        config, catalog, completions_year, export_backup_path, logger)
+                    transform_prod.load_completions(
+                        catalog.current(enum.CatalogStage.parquet, completions_year), # type: ignore
+                        config,
+                        exporters[completions_year],
+                        logger,
+                    )
+                return exporters[completions_year]
+
+        def run(task: workqueue.Task, job: dict) -> ctlg.Artifact:
+            if task.stage == 'scrape':
+                return scrape_prod.scrape_year(
+                    task.year, config, catalog, access_db_backup_path, logger, temp_dir)
+            if task.stage == 'convert':
+                return convert_prod.convert_year(
+                    catalog.current(enum.CatalogStage.access_db, task.year), # type: ignore
+                    config, catalog, parquet_backup_path, logger, read_table,
+                )
+            return transform_prod.transform_year(
+                catalog.current(enum.CatalogStage.parquet, task.year), # type: ignore
+                config, get_exporter(job['completions_year']), logger,
+            )
+
+        results = []
+        results_lock = threading.Lock()
+
+        def work() -> None:
+            with contextlib.ExitStack() as stack:
+                _profile_thread(stack, logger)
+                for result in _work_queue(work_queue, run, logger):
+                    with results_lock:
+                        results.append(result)
+
+        with telemetry.span('production_summaries', logger), work_queue.heartbeat():
+            threads = [
+                threading.Thread(target=work, name=f'queue-{n}', daemon=True)
+                for n in range(config.queue_workers)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+    telemetry.log_summary(logger)
+
+    failed = work_queue.failed()
+    if len(failed) > 0:
+        raise RuntimeError(
+            f'{len(failed)} tasks failed, see {config.queue_dir / "failed"}: '
+            f'{", ".join(failed)}'
+        )
+    return results
+
+
+def _submit(
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    work_queue: workqueue.WorkQueue,
+    logger: logging.Logger,
+) -> None:
+    years = _order_years(config, catalog)
+    parquet_years = [a.year for a in catalog.artifacts(enum.CatalogStage.parquet)]
+    completions_year = max([*config.years, *parquet_years])
+    stages = ['scrape', 'convert'] + (['transform'] if config.transform else [])
+
+    tasks = []
+    for i, stage in enumerate(stages):
+        for n, year in enumerate(years):
+            after = [] if i == 0 else [f'{stages[i - 1]}-{year}']
+            if stage == 'transform' and completions_year in config.years \
+                    and completions_year != year:
+                after.append(f'convert-{completions_year}')
+            tasks.append(workqueue.Task(
+                stage,
+                year,
+                after,
+                # later stages first, so years finish as early as possible
+                order=(len(stages) - 1 - i) * len(years) + n,
+            ))
+
+    work_queue.submit(tasks, {'years': years, 'completions_year': completions_year})
+    logger.info(f'submitted {len(tasks)} tasks to {work_queue.path}')
+
+
+def _work_queue(
+    work_queue: workqueue.WorkQueue,
+    run: Callable[[workqueue.Task, dict], Any],
+    logger: logging.Logger,
+) -> Iterator[Any]:
+    '''
+    Runs tasks from the queue until none are left, waiting for a job to be
+    submitted if there is none yet.
+    '''
+    while True:
+        job = work_queue.job()
+        task = None if job is None else work_queue.claim(logger)
+        if task is None:
+            if job is not None and work_queue.unfinished() == 0:
+                return
+            time.sleep(const.QUEUE_POLL_SECONDS)
+            continue
+
+        try:
+            with telemetry.span(f'stage.{task.stage}', logger, year=task.year):
+                result = run(task, job) # type: ignore
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            # a download that can't succeed exits, and a Polars panic isn't an
+            # Exception either, but either would leave the task claimed, and
+            # its lease renewed, with nothing working on it
+            work_queue.fail(task, repr(e), logger)
+            continue
+        if work_queue.complete(task, logger):
+            yield result
+
+
+def _order_years(
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+) -> list[int]:
+    '''
+    The newest year first, so the completions every export is joined with are
+    available as early as possible, then the largest years, so the run
+    doesn't end waiting on one big year. Years that were never converted are
+    assumed to be large, newest first.
+    '''
+    sizes = {a.year: a.size for a in catalog.artifacts(enum.CatalogStage.parquet)}
+    newest = max(config.years)
+    return sorted(
+        config.years,
+        key=lambda year: (
+            year != newest, year in sizes, -sizes.get(year, 0), -year),
+    )
+
+
+def _profile_thread(stack: contextlib.ExitStack, logger: logging.Logger) -> None:
+    # a worker whose profiler fails still works, or the stages after it would
+    # wait forever for it to finish
+    try:
+        stack.enter_context(profiling.thread())
+    except Exception as e:
+        logger.warning(f'not profiling {threading.current_thread().name}: {e!r}')
+
+
+def _artifact_size(artifact: ctlg.Artifact) -> tuple[int, int]:
+    return artifact.year, artifact.size
+
+
+def open_catalog(
+    config: cfg.ProductionSummariesConfig,
+    logger: logging.Logger,
+) -> ctlg.Catalog:
+    catalog = ctlg.Catalog(
+        config.catalog_file,
+        journal_mode='WAL' if config.queue_dir is None else 'DELETE',
+    )
+
+    # carry over the metadata.json files written before the catalog existed,
+    # one invocation at a time so they aren't imported twice
+    with open_locks(config).hold('metadata', logger):
+        for stage, metadata_dir, path_keys in [
+            (enum.CatalogStage.zip, config.zip_dir, ['path']),
+            (enum.CatalogStage.access_db, config.access_db_dir, ['path']),
+            (enum.CatalogStage.parquet, config.parquet_dir,
+                ['production_path', 'completions_path']),
+            (enum.CatalogStage.export, config.export_dir, ['path']),
+        ]:
+            catalog.import_metadata(
+                stage, metadata_dir / 'metadata.json', path_keys, logger=logger)
+
+    return catalog
+
+
+def open_locks(config: cfg.ProductionSummariesConfig) -> lck.Locks:
+    '''
+    The locks shared by every invocation using the same catalog.
+    '''
+    return lck.Locks(config.catalog_file.parent / 'locks')
+
+
+@contextlib.contextmanager
+def private_temp_dir(
+    config: cfg.ProductionSummariesConfig,
+    locks: lck.Locks,
+    logger: logging.Logger,
+) -> Iterator[pathlib.Path]:
+    '''
+    A directory in zip_dir/temp that only this invocation downloads into,
+    removed when the block ends. It is locked while it exists, so the
+    directories of invocations that crashed, the only ones whose lock can be
+    taken, are removed by the next invocation.
+    '''
+    temp_root = config.zip_dir / 'temp'
+    temp_root.mkdir(parents=True, exist_ok=True)
+    # files left by versions that downloaded into zip_dir/temp itself
+    utils.remove_files(temp_root, ['zip', 'json'], logger=logger)
+    # only this host's directories, as locks may not reach other hosts
+    host = socket.gethostname()
+    for d in temp_root.glob(f'{host}-*'):
+        stale = locks.lock(f'temp-{d.name}')
+        if d.is_dir() and stale.acquire(blocking=False):
+            shutil.rmtree(d, ignore_errors=True)
+            stale.release(remove=True)
+            logger.info(f'removed {d}, left by an invocation that stopped')
+
+    name = f'{host}-{datetime.datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}'
+    lock = locks.lock(f'temp-{name}')
+    # locked before the directory exists, so no other invocation sees it
+    # unlocked
+    lock.acquire()
+    temp_dir = temp_root / name
+    temp_dir.mkdir()
+    try:
+        yield temp_dir
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        lock.release(remove=True)
+
+
+def _get_exporter(
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    backup_path: pathlib.Path,
+    logger: logging.Logger,
+    on_export: Optional[Callable[[ctlg.Artifact], None]] = None,
+    locks: Optional[lck.Locks] = None,
+) -> transform_prod.Exporter:
+    parquet_artifacts = {
+        a.year: a for a in catalog.artifacts(enum.CatalogStage.parquet)}
+    completions_year = max([*config.years, *parquet_artifacts])
+    exporter = transform_prod.Exporter(
+        config, catalog, completions_year, backup_path, logger, on_export, locks)
+
+    if completions_year not in config.years:
+        transform_prod.load_completions(
+            parquet_artifacts[completions_year], config, exporter, logger)
+
+    return exporter
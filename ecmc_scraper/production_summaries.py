@@ -0,0 +1,196 @@
+'''
+Library API for the production summaries, for notebooks and schedulers that
+want the exported data as Polars frames instead of CSV files.
+
+    from ecmc_scraper import production_summaries
+
+    frames = production_summaries.load([2022, 2023])
+    df = frames[2023].filter(pl.col('county') == 'WELD').collect()
+
+load runs the same scrape, convert and transform code as the CLI. Without
+materialize, the Access tables are kept in memory and the transform is
+returned as one LazyFrame per year, so nothing after the download is written
+to disk or read back. Years whose converted parquet files in the catalog are
+still current are scanned from those files instead of read from the Access
+database again. With materialize, the pipeline runs as it does from the CLI,
+writing and cataloging every file, and the frames scan the parquet files.
+'''
+
+
+import dataclasses
+import datetime
+import logging
+import pathlib
+from typing import Any, Optional
+
+import polars as pl
+
+from . import catalog as ctlg
+from . import config as cfg
+from . import const
+from . import convert_production_summaries_access_to_parquet as convert_prod
+from . import enum
+from . import pipeline
+from . import scrape_production_summaries as scrape_prod
+from . import transform_production_summaries as transform_prod
+
+
+def default_config(**overrides: Any) -> cfg.ProductionSummariesConfig:
+    '''
+    The CLI's default configuration, with any field replaced by a keyword
+    argument, e.g. default_config(years=[2023], zip_dir=pathlib.Path('zips')).
+    '''
+    data_dir = const.DEFAULT_DATA_DIR / 'production-summaries'
+    config = {
+        'access_db_dir': data_dir / 'access-db',
+        'access_driver': enum.MsAccessDriver.x64,
+        'catalog_file': data_dir / 'catalog.sqlite',
+        'convert_workers': 2,
+        'download_workers': 4,
+        'export_changes': False,
+        'export_type': enum.OutputType.csv,
+        'export_dir': data_dir / 'export',
+        'intermediate_format': enum.IntermediateFormat.parquet,
+        'log_dir': data_dir / 'logs',
+        'log_level': enum.LogLevel.INFO,
+        'memory_budget': None,
+        'parquet_dir': data_dir / 'parquet',
+        'profile': False,
+        'quality_policy': enum.QualityPolicy.report,
+        'queue_dir': None,
+        'queue_role': enum.QueueRole.coordinator,
+        'queue_workers': 2,
+        'quiet': True,
+        'resume': False,
+        'show_config': False,
+        'transform': True,
+        'transform_config': dict(const.DEFAULT_TRANSFORM_CONFIG),
+        'transform_workers': 2,
+        'url_config': dict(const.DEFAULT_URL_CONFIG),
+        'write_config_to_file': None,
+        'years': list(const.DEFAULT_YEARS),
+        'zip_dir': data_dir / 'zip',
+    }
+    config.update(overrides)
+    return cfg.ProductionSummariesConfig.from_dict(config)
+
+
+def load(
+    years: Optional[list[int]] = None,
+    config: Optional[cfg.ProductionSummariesConfig] = None,
+    materialize: bool = False,
+    logger: Optional[logging.Logger] = None,
+    read_table: Optional[convert_prod.ReadTable] = None,
+) -> dict[int, pl.LazyFrame]:
+    '''
+    The export of each year, joined with the completions of the latest year,
+    as LazyFrames. read_table reads each Access table, over ODBC unless
+    another reader is given, e.g. synthetic.read_standin_table.
+    '''
+    config = config or default_config()
+    if years is not None:
+        config = dataclasses.replace(config, years=years)
+    logger = logger or logging.getLogger('production_summaries')
+
+    if materialize:
+        pipeline.production_summaries(config, logger, read_table=read_table)
+
+    catalog = pipeline.open_catalog(config, logger)
+    tables = _load_tables(config, catalog, materialize, logger, read_table)
+
+    completions_year = max([
+        *config.years,
+        *[a.year for a in catalog.artifacts(enum.CatalogStage.parquet)],
+    ])
+    if completions_year not in tables:
+        tables[completions_year] = _scan_parquet(
+            catalog.current(enum.CatalogStage.parquet, completions_year)) # type: ignore
+
+    transform_config = config.transform_config
+    completions = transform_prod.completions_frame(
+        tables[completions_year]['completions'],
+        transform_config.completions_columns_to_keep,
+        transform_config.completions_columns_to_fill_null_with_zero,
+    )
+    return {
+        year: transform_prod.output_frame(
+            transform_prod.production_frame(
+                tables[year]['production'],
+                transform_config.production_columns_to_keep,
+                transform_config.production_columns_to_fill_null_with_zero,
+            ),
+            completions,
+            transform_config.remove_CO2_wells,
+        )
+        for year in sorted(config.years)
+    }
+
+
+def _load_tables(
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    materialize: bool,
+    logger: logging.Logger,
+    read_table: Optional[convert_prod.ReadTable] = None,
+) -> dict[int, dict[str, pl.LazyFrame]]:
+    if materialize:
+        return {
+            year: _scan_parquet(catalog.current(enum.CatalogStage.parquet, year)) # type: ignore
+            for year in config.years
+        }
+
+    access_db_backup_path = config.access_db_dir / 'previous_versions' \
+        / datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    config.access_db_dir.mkdir(parents=True, exist_ok=True)
+    locks = pipeline.open_locks(config)
+
+    def scrape_year(year: int, temp_dir: pathlib.Path) -> ctlg.Artifact:
+        with locks.unit('scrape', year, logger):
+            return scrape_prod.scrape_year(
+                year, config, catalog, access_db_backup_path, logger, temp_dir)
+
+    with pipeline.private_temp_dir(config, locks, logger) as temp_dir:
+        stages = [
+            pipeline.Stage(
+                'scrape',
+                lambda year: scrape_year(year, temp_dir),
+                workers=config.download_workers,
+            ),
+            pipeline.Stage(
+                'read',
+                lambda artifact: (
+                    artifact.year,
+                    _read_tables(artifact, config, catalog, logger, read_table),
+                ),
+                workers=config.convert_workers,
+            ),
+        ]
+        return dict(pipeline.Pipeline(stages, logger).run(config.years))
+
+
+def _read_tables(
+    db_artifact: ctlg.Artifact,
+    config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    logger: logging.Logger,
+    read_table: Optional[convert_prod.ReadTable] = None,
+) -> dict[str, pl.LazyFrame]:
+    previous = catalog.current(enum.CatalogStage.parquet, db_artifact.year)
+    if (
+        previous is not None
+        and previous.hash == db_artifact.hash
+        and previous.exists()
+        and convert_prod.applied_policy(previous) == config.quality_policy
+    ):
+        logger.info(f'reading {db_artifact.year} from its parquet files')
+        return _scan_parquet(previous)
+
+    read = convert_prod.read_year(db_artifact, config, logger, read_table)
+    return {key: df.lazy() for key, df in read.frames.items()}
+
+
+def _scan_parquet(parquet_artifact: ctlg.Artifact) -> dict[str, pl.LazyFrame]:
+    return {
+        key: transform_prod.scan_table(transform_prod.table_path(parquet_artifact, key))
+        for key in ('production', 'completions')
+    }
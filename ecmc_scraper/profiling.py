@@ -0,0 +1,124 @@
+'''
+Profiling for --profile runs. A session collects cProfile data from the main
+thread and every pipeline worker thread into one pstats dump, and records the
+optimized plan and per-node timings of each Polars query that is collected.
+Everything is written to a timestamped directory under the log directory.
+'''
+
+
+import contextlib
+import cProfile
+import datetime
+import io
+import logging
+import pathlib
+import pstats
+import re
+import sys
+import threading
+from typing import Iterator, Optional
+
+import polars as pl
+
+
+# before Python 3.12 a profiler only sees the thread that enabled it, so each
+# worker thread needs its own; from 3.12 on cProfile is built on
+# sys.monitoring, which sees every thread but allows one profiler per process
+_PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+
+class Session:
+
+    def __init__(self, out_dir: pathlib.Path, logger: logging.Logger):
+        self.out_dir = out_dir
+        self.logger = logger
+        self._profiles: list[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def thread(self) -> Iterator[None]:
+        '''
+        Profiles the calling thread, unless the session's profiler already
+        sees it. A profiler that can't be started is logged and skipped, so
+        profiling never stops the work being profiled.
+        '''
+        with self._lock:
+            covered = not _PROFILE_PER_THREAD and len(self._profiles) > 0
+        if covered:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # another profiler, e.g. a debugger's, is active
+            self.logger.warning(
+                f'not profiling {threading.current_thread().name}: {e}')
+            yield
+            return
+
+        with self._lock:
+            self._profiles.append(profile)
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def collect(self, lf: pl.LazyFrame, name: str) -> pl.DataFrame:
+        stem = re.sub(r'\W+', '_', name)
+        (self.out_dir / f'{stem}.plan.txt').write_text(lf.explain(optimized=True))
+        df, timings = lf.profile()
+        timings.write_csv(self.out_dir / f'{stem}.timings.csv')
+        self.logger.info(f'wrote query plan and timings for {name} to {self.out_dir}')
+        return df
+
+    def write(self) -> None:
+        with self._lock:
+            profiles = list(self._profiles)
+        if len(profiles) == 0:
+            return
+
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.out_dir / 'run.pstats')
+
+        text = io.StringIO()
+        pstats.Stats(str(self.out_dir / 'run.pstats'), stream=text) \
+            .sort_stats('cumulative').print_stats(50)
+        (self.out_dir / 'run.txt').write_text(text.getvalue())
+        self.logger.info(f'wrote profile to {self.out_dir}')
+
+
+_session: Optional[Session] = None
+
+
+def active() -> Optional[Session]:
+    return _session
+
+
+@contextlib.contextmanager
+def session(log_dir: pathlib.Path, logger: logging.Logger) -> Iterator[Session]:
+    global _session
+    out_dir = log_dir / 'profiles' / datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    out_dir.mkdir(parents=True, exist_ok=True)
+    _session = Session(out_dir, logger)
+    try:
+        with _session.thread():
+            yield _session
+    finally:
+        _session.write()
+        _session = None
+
+
+@contextlib.contextmanager
+def thread() -> Iterator[None]:
+    '''
+    Profiles the calling thread if a session is active.
+    '''
+    if _session is None:
+        yield
+        return
+    with _session.thread():
+        yield
@@ -0,0 +1,290 @@
+'''
+Data quality rules for the tables read from the Access databases.
+
+Each rule is a Polars expression that is true for the rows breaking it, so
+new rules are one line in RULES. All the rules for a table are evaluated
+together in one select, a single vectorized pass over the table however many
+rules there are. The convert step checks every year it reads, writes a
+quality report with the number of rows breaking each rule and a few of them,
+and applies the quality policy (see enum.QualityPolicy):
+
+- report keeps the rows and logs a warning for each broken rule
+- quarantine moves the rows breaking any rule out of the table into a
+  parquet file next to the report
+- fail fails the year, leaving its previous parquet files current
+'''
+
+
+from dataclasses import dataclass, field
+import json
+import logging
+import pathlib
+
+import polars as pl
+
+from . import catalog as ctlg
+from . import const
+from . import enum
+from . import telemetry
+from . import utils
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    table: enum.MsAccessTable
+    description: str
+    # true for the rows breaking the rule
+    violation: pl.Expr
+
+    @property
+    def columns(self) -> list[str]:
+        return self.violation.meta.root_names()
+
+
+@dataclass(frozen=True)
+class Report:
+    year: int
+    policy: enum.QualityPolicy
+    # table key -> rows checked and, for each broken rule, its description,
+    # count and sample rows
+    tables: dict[str, dict] = field(default_factory=dict)
+    # table key -> rows moved out of the table by the quarantine policy
+    quarantined: dict[str, pl.DataFrame] = field(default_factory=dict)
+
+    @property
+    def violations(self) -> int:
+        return sum(
+            r['violations']
+            for t in self.tables.values() for r in t['rules'].values()
+        )
+
+
+_volumes = [pl.col(c) for c in ('oil_prod', 'gas_prod', 'water_prod')]
+
+
+def _not_number(column: str) -> pl.Expr:
+    # missing parts and parts that aren't numbers cast to null; a cast is
+    # about twice as fast as matching a pattern
+    return pl.col(column).cast(pl.UInt32, strict=False).is_null()
+
+
+RULES = [
+    Rule(
+        'prod_days_negative',
+        enum.MsAccessTable.production,
+        'Prod_days is negative',
+        pl.col('Prod_days') < 0,
+    ),
+    Rule(
+        'prod_days_over_366',
+        enum.MsAccessTable.production,
+        'Prod_days is more than the days in a year',
+        pl.col('Prod_days') > 366,
+    ),
+    Rule(
+        'production_without_days',
+        enum.MsAccessTable.production,
+        'oil or gas was produced on no days, which makes BOEd infinite',
+        ((pl.col('oil_prod') > 0) | (pl.col('gas_prod') > 0))
+        & (pl.col('Prod_days') == 0),
+    ),
+    Rule(
+        'volume_negative',
+        enum.MsAccessTable.production,
+        'oil_prod, gas_prod or water_prod is negative',
+        pl.any_horizontal([v < 0 for v in _volumes]),
+    ),
+    Rule(
+        'gas_with_missing_oil',
+        enum.MsAccessTable.production,
+        'gas was produced but oil_prod is missing, so the well is typed as '
+        'coal bed methane',
+        (pl.col('gas_prod') > 0) & pl.col('oil_prod').is_null(),
+    ),
+    Rule(
+        'api_not_numeric',
+        enum.MsAccessTable.production,
+        'a part of the API number is missing or not a number',
+        pl.any_horizontal([
+            _not_number(c)
+            for c in ('api_county_code', 'api_seq_num', 'sidetrack_num')
+        ]),
+    ),
+    Rule(
+        'api_num_malformed',
+        enum.MsAccessTable.completions,
+        'API_num is not 05-CCC-SSSSS-DD',
+        ~pl.col('API_num').str.contains(r'^05-\d{3}-\d{5}-\d{2}$').fill_null(False),
+    ),
+    Rule(
+        'location_outside_colorado',
+        enum.MsAccessTable.completions,
+        'lat or long is outside Colorado',
+        ~pl.col('lat').is_between(*const.COLORADO_LAT)
+        | ~pl.col('long').is_between(*const.COLORADO_LONG),
+    ),
+]
+
+
+def rules(table: enum.MsAccessTable, columns: list[str]) -> list[Rule]:
+    '''
+    The rules for table that only use the given columns.
+    '''
+    return [
+        r for r in RULES
+        if r.table == table and all(c in columns for c in r.columns)
+    ]
+
+
+def check(df: pl.DataFrame, table: enum.MsAccessTable) -> pl.DataFrame:
+    '''
+    One boolean column per rule for table, true for the rows of df that break
+    it.
+    '''
+    return df.select([
+        r.violation.fill_null(False).alias(r.name)
+        for r in rules(table, df.columns)
+    ])
+
+
+def check_year(
+    data: dict[enum.MsAccessTable, dict[int, pl.DataFrame]],
+    year: int,
+    policy: enum.QualityPolicy,
+    logger: logging.Logger,
+    table_keys: dict[enum.MsAccessTable, str],
+) -> Report:
+    '''
+    Checks every table of a year. With the quarantine policy, the rows
+    breaking any rule are removed from data and kept in the report.
+    '''
+    report = Report(year, policy)
+    for table, key in table_keys.items():
+        df = data[table][year]
+        with telemetry.span('quality', logger, year=year, table=table) as s:
+            flags = check(df, table)
+            counts = flags.sum().row(0, named=True) if flags.width > 0 else {}
+            s.record(rows=df.height)
+
+        broken = {name: n for name, n in counts.items() if n > 0}
+        report.tables[key] = {
+            'rows': df.height,
+            'rules': {
+                r.name: {
+                    'description': r.description,
+                    'violations': broken[r.name],
+                    'samples': _samples(df, flags[r.name]),
+                }
+                for r in rules(table, df.columns) if r.name in broken
+            },
+        }
+        for name, n in broken.items():
+            logger.warning(
+                f'{n} rows of {table} {year} break {name}',
+                extra={'year': year, 'table': table, 'rule': name, 'violations': n},
+            )
+
+        if policy == enum.QualityPolicy.quarantine and len(broken) > 0:
+            bad = flags.select(pl.any_horizontal(list(broken))).to_series()
+            # the rows are filtered before the rule names are added, and
+            # rechunked, as a frame read in batches is chunked unlike flags
+            report.quarantined[key] = df.filter(bad).rechunk().with_columns(
+                flags.filter(bad).select(_broken_rules(list(broken))).to_series())
+            data[table][year] = df.filter(~bad)
+            logger.warning(
+                f'quarantined {report.quarantined[key].height} rows of {table} {year}',
+                extra={'year': year, 'table': table},
+            )
+
+    return report
+
+
+def write(
+    report: Report,
+    out_dir: pathlib.Path,
+    logger: logging.Logger,
+) -> dict[str, pathlib.Path]:
+    '''
+    Writes the report as JSON, and the quarantined rows as parquet, and
+    returns the files written.
+    '''
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = {'path': out_dir / f'{report.year}.json'}
+    for key, df in report.quarantined.items():
+        files[f'{key}_quarantine_path'] = out_dir / f'{key}_{report.year}.quarantine.parquet'
+        with utils.atomic_write(files[f'{key}_quarantine_path']) as temp_file:
+            df.write_parquet(temp_file)
+
+    with utils.atomic_write(files['path']) as temp_file:
+        temp_file.write_text(json.dumps(
+            {
+                'year': report.year,
+                'policy': str(report.policy),
+                'violations': report.violations,
+                'tables': report.tables,
+                'quarantined': {k: df.height for k, df in report.quarantined.items()},
+            },
+            indent=4,
+            default=str,
+        ))
+    logger.info(f'wrote the quality report for {report.year} to {files["path"]}')
+    return files
+
+
+def record(
+    report: Report,
+    db_artifact: ctlg.Artifact,
+    out_dir: pathlib.Path,
+    catalog: ctlg.Catalog,
+    backup_path: pathlib.Path,
+    logger: logging.Logger,
+) -> ctlg.Artifact:
+    catalog.backup(enum.CatalogStage.quality, report.year, backup_path, logger=logger)
+    return catalog.record(
+        enum.CatalogStage.quality,
+        report.year,
+        db_artifact.hash,
+        write(report, out_dir, logger),
+        source=db_artifact,
+        timestamp=db_artifact.timestamp,
+        extra={
+            'policy': report.policy,
+            'violations': {
+                key: {name: r['violations'] for name, r in t['rules'].items()}
+                for key, t in report.tables.items()
+            },
+        },
+        logger=logger,
+    )
+
+
+def is_current(
+    db_artifact: ctlg.Artifact,
+    catalog: ctlg.Catalog,
+) -> bool:
+    previous = catalog.current(enum.CatalogStage.quality, db_artifact.year)
+    return (
+        previous is not None
+        and previous.hash == db_artifact.hash
+        and previous.exists()
+    )
+
+
+def _samples(df: pl.DataFrame, flag: pl.Series) -> list[dict]:
+    # slicing out the first rows found is cheaper than filtering every row
+    # that breaks the rule, and unlike a filter doesn't need df and flag to
+    # be chunked alike
+    rows = flag.arg_true().head(const.QUALITY_SAMPLE_ROWS).to_list()
+    if len(rows) == 0:
+        return []
+    return pl.concat([df.slice(i, 1) for i in rows]).to_dicts()
+
+
+def _broken_rules(names: list[str]) -> pl.Expr:
+    # the names of the rules each row breaks, e.g. "prod_days_negative,api_not_numeric"
+    return pl.concat_str(
+        [pl.when(pl.col(n)).then(pl.lit(n)) for n in names],
+        separator=',',
+        ignore_nulls=True,
+    ).alias('quality_rules')
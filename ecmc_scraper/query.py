@@ -0,0 +1,249 @@
+'''
+Point lookups of single wells across every converted year.
+
+The convert step sorts each parquet file by API number and records, in the
+catalog, which row group of which file holds each well and where in the row
+group its rows start. A lookup reads only those row groups, so asking for the
+history of one well takes about the same time however many years are stored.
+
+API numbers are packed into integers for the index by dropping the dashes, so
+05-123-45678-00 is 51234567800.
+
+Range filters on any column go through scan, which skips the years whose
+column statistics (see stats.py) show they can't have a matching row, as
+`ecmc-scraper find-rows` does. The
+summary cubes the transform step writes are read with cube and rollup.
+'''
+
+
+import logging
+import pathlib
+from typing import Any, Optional
+
+import polars as pl
+
+from . import catalog as ctlg
+from . import const
+from . import enum
+from . import stats
+
+
+table_keys = {
+    enum.LookupTable.production: 'production_path',
+    enum.LookupTable.completions: 'completions_path',
+}
+
+
+def pack_api(api_num: str) -> tuple[int, int]:
+    '''
+    Returns the lowest and highest packed API numbers matching api_num. An
+    API number without its two sidetrack digits matches every sidetrack.
+    '''
+    digits = api_num.replace('-', '').strip()
+    if not digits.isdigit() or len(digits) not in (10, 12):
+        raise ValueError(
+            f'{api_num} is not an API number like 05-123-45678-00')
+    if len(digits) == 10:
+        return int(digits) * 100, int(digits) * 100 + 99
+    return int(digits), int(digits)
+
+
+def api_expr(table: enum.LookupTable) -> pl.Expr:
+    '''
+    The packed API number of each row of a converted table.
+    '''
+    if table == enum.LookupTable.completions:
+        return pl.col('API_num').str.replace_all('-', '').cast(pl.Int64, strict=False)
+
+    # production stores the parts of the API number unpadded
+    return (
+        5 * 10**10
+        + pl.col('api_county_code').cast(pl.Int64, strict=False) * 10**7
+        + pl.col('api_seq_num').cast(pl.Int64, strict=False) * 100
+        + pl.col('sidetrack_num').cast(pl.Int64, strict=False)
+    )
+
+
+def build_index(path: pathlib.Path, table: enum.LookupTable) -> pl.DataFrame:
+    '''
+    One row per run of rows with the same API number within a row group:
+    api, row_group, offset (within the row group) and count. A file sorted by
+    API number has one run per well per row group.
+    '''
+    # pyarrow is installed with arrow-odbc; Polars can't read row group
+    # metadata or single row groups
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_metadata(path)
+    sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    row_groups = pl.DataFrame({
+        'row_group': range(len(sizes)),
+        'begin': [sum(sizes[:i]) for i in range(len(sizes))],
+    }, schema={'row_group': pl.Int64, 'begin': pl.Int64})
+
+    return (
+        pl.scan_parquet(path)
+        .select(api_expr(table).alias('api'))
+        .with_row_index('row')
+        .with_columns(pl.col('row').cast(pl.Int64))
+        .collect()
+        .join_asof(row_groups, left_on='row', right_on='begin')
+        .with_columns((pl.col('row') - pl.col('begin')).alias('offset'))
+        .with_columns(
+            (
+                (pl.col('api') != pl.col('api').shift())
+                | (pl.col('row_group') != pl.col('row_group').shift())
+            )
+            .fill_null(True)
+            .cum_sum()
+            .alias('run'),
+        )
+        .filter(pl.col('api').is_not_null())
+        .group_by('run', maintain_order=True)
+        .agg(
+            pl.col('api').first(),
+            pl.col('row_group').first(),
+            pl.col('offset').first(),
+            pl.len().alias('count'),
+        )
+        .drop('run')
+    )
+
+
+def well_history(
+    catalog: ctlg.Catalog,
+    api_num: str,
+    table: enum.LookupTable = enum.LookupTable.production,
+    logger: Optional[logging.Logger] = None,
+) -> pl.DataFrame:
+    '''
+    Every row for a well in every converted year, with a year column.
+    '''
+    import pyarrow.parquet as pq
+
+    low, high = pack_api(api_num)
+    frames = []
+    files = {}
+    for year, path, row_group, offset, count in catalog.api_locations(
+            low, high, table_keys[table]):
+        if path not in files:
+            files[path] = pq.ParquetFile(path)
+        rows = pl.from_arrow(
+            files[path].read_row_group(row_group).slice(offset, count))
+        frames.append(rows.with_columns(pl.lit(year).alias('year'))) # type: ignore
+
+    if logger is not None:
+        logger.info(
+            f'found {sum(f.height for f in frames)} rows for {api_num} '
+            f'in {len(files)} files'
+        )
+    if len(frames) == 0:
+        return pl.DataFrame()
+
+    df = pl.concat(frames, how='diagonal_relaxed')
+    return df.select('year', pl.exclude('year'))
+
+
+def prune_years(
+    catalog: ctlg.Catalog,
+    table: enum.LookupTable,
+    column: str,
+    low: Any = None,
+    high: Any = None,
+) -> list[ctlg.Artifact]:
+    '''
+    The current parquet artifacts whose table may have rows with column from
+    low to high. Years without statistics are never skipped.
+    '''
+    artifacts = []
+    for artifact in catalog.artifacts(enum.CatalogStage.parquet):
+        column_stats = catalog.column_stats(artifact, table_keys[table])
+        if column in column_stats and not stats.may_contain(
+                column_stats[column], low, high):
+            continue
+        artifacts.append(artifact)
+    return artifacts
+
+
+def scan(
+    catalog: ctlg.Catalog,
+    table: enum.LookupTable,
+    column: Optional[str] = None,
+    low: Any = None,
+    high: Any = None,
+    logger: Optional[logging.Logger] = None,
+) -> pl.LazyFrame:
+    '''
+    Every current year of a table with a year column, keeping only the rows
+    with column from low to high if a column is given. Years that can't have
+    such rows are not opened.
+    '''
+    if column is None:
+        artifacts = catalog.artifacts(enum.CatalogStage.parquet)
+    else:
+        artifacts = prune_years(catalog, table, column, low, high)
+    if logger is not None:
+        logger.info(f'scanning {len(artifacts)} years of {table}')
+    if len(artifacts) == 0:
+        return pl.LazyFrame()
+
+    lf = pl.concat(
+        [
+            pl.scan_parquet(a.files[table_keys[table]])
+            .with_columns(pl.lit(a.year).alias('year'))
+            for a in artifacts
+        ],
+        how='diagonal_relaxed',
+    )
+    # the bounds are cast to the column, e.g. a date given as an ISO string
+    if column is not None and low is not None:
+        lf = lf.filter(pl.col(column) >= pl.lit(low).cast(lf.schema[column]))
+    if column is not None and high is not None:
+        lf = lf.filter(pl.col(column) <= pl.lit(high).cast(lf.schema[column]))
+    return lf.select('year', pl.exclude('year'))
+
+
+def cube(
+    catalog: ctlg.Catalog,
+    years: Optional[list[int]] = None,
+) -> pl.LazyFrame:
+    '''
+    The summary cubes of the current exports: totals by year, county,
+    operator and well type.
+    '''
+    files = [
+        a.files['cube_path']
+        for a in catalog.artifacts(enum.CatalogStage.export)
+        if 'cube_path' in a.files and (years is None or a.year in years)
+    ]
+    if len(files) == 0:
+        return pl.LazyFrame()
+    return pl.concat([pl.scan_parquet(f) for f in files], how='diagonal_relaxed')
+
+
+def rollup(
+    catalog: ctlg.Catalog,
+    by: list[str],
+    years: Optional[list[int]] = None,
+) -> pl.LazyFrame:
+    '''
+    The cubes totalled over the dimensions not in by, e.g. by=['year',
+    'county'] for the totals of each county in each year.
+    '''
+    unknown = set(by) - set(const.CUBE_DIMENSIONS)
+    if len(unknown) > 0:
+        raise ValueError(
+            f'{", ".join(sorted(unknown))} not in {", ".join(const.CUBE_DIMENSIONS)}')
+
+    return (
+        cube(catalog, years)
+        .group_by(by)
+        .agg(
+            *([pl.col('operator_name').first()] if 'operator_num' in by else []),
+            pl.col('wells').sum(),
+            *[pl.col(c).sum() for c in const.CUBE_SUM_COLUMNS],
+            pl.col('BOEd_sum').sum(),
+        )
+        .with_columns((pl.col('BOEd_sum') / pl.col('wells')).alias('BOEd_mean'))
+        .sort(by, nulls_last=True)
+    )
@@ -0,0 +1,106 @@
+'''
+Keeps the pipeline's memory use under a budget. Every item a stage works on
+reserves an estimate of the memory it will need, and waits while the items
+already running have reserved too much of the budget for it to fit. An item
+that doesn't fit on its own still runs, once nothing else is running.
+
+An estimate is the largest peak memory increase recently seen for the same
+stage, year and input size, or else the input size times the largest ratio of
+memory to input size seen for the stage in recent runs. DEFAULT_RATIOS are used
+until a stage has been seen. Every item's peak memory increase is recorded in
+the catalog for later runs. It is measured for the whole process, so it is only
+approximate: items running alongside make it larger, and memory the process
+kept from earlier items makes it smaller, which is why the largest recent
+observation is used.
+'''
+
+
+import contextlib
+import logging
+import threading
+from typing import Iterator, Optional
+
+from . import catalog as ctlg
+from . import memory
+
+
+DEFAULT_RATIOS = {
+    'scrape': 2.0,
+    'convert': 4.0,
+    'transform': 12.0,
+}
+
+
+class Scheduler:
+
+    def __init__(
+        self,
+        catalog: ctlg.Catalog,
+        budget: Optional[int],
+        logger: logging.Logger,
+    ):
+        self.catalog = catalog
+        self.budget = budget
+        self.logger = logger
+        self.reserved = 0
+        self._ratios: dict[str, float] = {}
+        self._condition = threading.Condition()
+
+    def estimate(self, stage: str, year: int, input_size: int) -> int:
+        peaks = [
+            peak
+            for _, size, peak in self.catalog.memory_usage(stage, year, limit=5)
+            if size == input_size
+        ]
+        if peaks:
+            return max(peaks)
+        return int(input_size * self._ratio(stage))
+
+    @contextlib.contextmanager
+    def run(self, stage: str, year: int, input_size: int) -> Iterator[None]:
+        estimate = self.estimate(stage, year, input_size)
+        with self._reserve(estimate, f'{stage} {year}'):
+            with memory.PeakRss() as rss:
+                yield
+        if rss.increase is not None:
+            self.catalog.record_memory(
+                stage, year, input_size, max(rss.increase, 0))
+            self.logger.debug(
+                f'{stage} {year} estimated {estimate} bytes, '
+                f'used {rss.increase} bytes'
+            )
+
+    @contextlib.contextmanager
+    def _reserve(self, n_bytes: int, name: str) -> Iterator[None]:
+        if self.budget is None:
+            yield
+            return
+
+        with self._condition:
+            if self._over_budget(n_bytes):
+                self.logger.info(
+                    f'{name} is waiting for memory: needs {n_bytes} bytes, '
+                    f'{self.reserved} of {self.budget} reserved'
+                )
+            while self._over_budget(n_bytes):
+                self._condition.wait()
+            self.reserved += n_bytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved -= n_bytes
+                self._condition.notify_all()
+
+    def _over_budget(self, n_bytes: int) -> bool:
+        return self.reserved > 0 and self.reserved + n_bytes > self.budget # type: ignore
+
+    def _ratio(self, stage: str) -> float:
+        if stage not in self._ratios:
+            ratios = [
+                peak / size
+                for _, size, peak in self.catalog.memory_usage(stage)
+                if size > 0
+            ]
+            self._ratios[stage] = max(ratios) if ratios else DEFAULT_RATIOS.get(stage, 1.0)
+        return self._ratios[stage]
@@ -4,133 +4,287 @@ extracts them for use with the included convert_access_to_parquet.py script.
 
 filename_template must include "YYYY", which will be converted to the year for
 each Production Summary file.
+
+If the url config names a mirror, zips are copied from it when its manifest
+has them and their hashes match, and downloaded from ECMC otherwise.
+sync_mirror fills a mirror so that other hosts, or hosts without internet
+access, can read from it.
 '''
 
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
 import logging
+import os
 import pathlib
+import tempfile
+import threading
+import time
+from typing import Optional
 import zipfile
 
 import requests
 
+from . import catalog as ctlg
 from . import config as cfg
+from . import const
+from . import enum
+from . import telemetry
 from . import utils
 
 
-def scrape(
+def scrape_year(
+    year: int,
     config: cfg.ProductionSummariesConfig,
+    catalog: ctlg.Catalog,
+    backup_path: pathlib.Path,
     logger: logging.Logger,
-) -> None:
-    zip_temp_path = config.zip_dir / 'temp'
-    zip_temp_path.mkdir(parents=True, exist_ok=True)
+    temp_dir: Optional[pathlib.Path] = None,
+) -> ctlg.Artifact:
+    '''
+    Downloads a year into temp_dir, which defaults to zip_dir/temp but should
+    be private to the invocation if others may be running (see
+    pipeline.private_temp_dir), and extracts it if it changed.
+    '''
+    temp_dir = temp_dir or config.zip_dir / 'temp'
+    temp_dir.mkdir(parents=True, exist_ok=True)
+
+    downloaded_file, zip_hash = _download_file(
+        year, config.url_config, temp_dir, logger)
+    zip_path = config.zip_dir / downloaded_file.name
 
-    access_db_path = config.access_db_dir
-    access_db_previous_versions_path = access_db_path / 'previous_versions'
-    access_db_previous_versions_path.mkdir(parents=True, exist_ok=True)
+    previous_zip = catalog.current(enum.CatalogStage.zip, year)
+    previous_db = catalog.current(enum.CatalogStage.access_db, year)
 
-    utils.remove_files(zip_temp_path, ['zip', 'json'], logger=logger)
+    if (
+        previous_zip is not None
+        and previous_zip.hash == zip_hash
+        and previous_db is not None
+        and previous_db.source_id == previous_zip.id
+        and previous_db.exists()
+        and catalog.hash_file(previous_db.path, logger=logger) == previous_db.hash
+    ):
+        downloaded_file.unlink()
+        logger.info(f'no changes to {zip_path}')
+        return previous_db
 
-    downloaded_files = _download_files(
-        config.years,
-        config.url_config,
-        zip_temp_path,
-        logger,
+    if previous_zip is not None:
+        previous_zip.path.unlink(missing_ok=True)
+    downloaded_file.replace(zip_path)
+    logger.info(f'moved {downloaded_file} to {zip_path}')
+    catalog.remember_hash(zip_path, zip_hash)
+    zip_artifact = catalog.record(
+        enum.CatalogStage.zip,
+        year,
+        zip_hash,
+        {'path': zip_path},
+        config_fingerprint=ctlg.fingerprint(config.url_config),
+        logger=logger,
     )
 
-    zip_metadata = _get_zip_metadata(downloaded_files, config.zip_dir, logger) # type: ignore
+    catalog.backup(
+        enum.CatalogStage.access_db, year, backup_path, logger=logger)
 
-    with (zip_temp_path / 'metadata.json').open('w') as f:
-        json.dump(utils.to_json(zip_metadata, logger=logger), f)
+    db_path, db_hash = _unzip_file(zip_path, config.access_db_dir, logger)
+    catalog.remember_hash(db_path, db_hash)
+    return catalog.record(
+        enum.CatalogStage.access_db,
+        year,
+        db_hash,
+        {'path': db_path},
+        source=zip_artifact,
+        timestamp=zip_artifact.timestamp,
+        logger=logger,
+    )
 
-    if utils.new_hashes(
-            zip_metadata, config.zip_dir / 'metadata.json', logger=logger):
-        utils.remove_files(config.zip_dir, ['zip', 'json'], logger=logger)
-        utils.move_files(
-            zip_temp_path, config.zip_dir, ['zip', 'json'], logger=logger)
 
-        utils.backup(
-            access_db_path,
-            access_db_previous_versions_path,
-            'mdb',
-            logger=logger,
-        )
+def sync_mirror(
+    years: list[int],
+    url_config: cfg.ProductionSummariesUrlConfig,
+    mirror_dir: pathlib.Path,
+    logger: logging.Logger,
+    workers: int = 4,
+) -> dict[int, bool]:
+    '''
+    Downloads each year into mirror_dir and records its hash in the mirror's
+    manifest. Returns whether each year's zip changed. The manifest is
+    rewritten after each year, so an interrupted sync leaves a usable mirror.
+    '''
+    mirror_dir.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(mirror_dir)
+    lock = threading.Lock()
 
-        _unzip_pulled_files(config.zip_dir, access_db_path, logger)
+    def sync_year(year: int) -> bool:
+        downloaded_file, zip_hash = _download_upstream(
+            year, url_config, temp_dir, logger)
+        name = downloaded_file.name
+        if manifest.get(name, {}).get('sha256') == zip_hash \
+                and (mirror_dir / name).exists():
+            downloaded_file.unlink()
+            logger.info(f'no changes to {name} in {mirror_dir}')
+            return False
 
-        with (access_db_path / 'metadata.json').open('w') as f:
-            json.dump(
-                utils.to_json(
-                    _get_db_metadata(access_db_path, zip_metadata, logger)),
-                f,
-            )
+        downloaded_file.replace(mirror_dir / name)
+        with lock:
+            manifest[name] = {
+                'year': year,
+                'sha256': zip_hash,
+                'size': (mirror_dir / name).stat().st_size,
+                'url': url_config.url(year),
+                'synced': datetime.datetime.now().isoformat(),
+            }
+            _write_manifest(mirror_dir, manifest)
+        logger.info(f'synced {name} to {mirror_dir}')
+        return True
 
+    # each sync downloads into its own directory, removed with whatever a
+    # failed download left in it
+    with tempfile.TemporaryDirectory(prefix='temp-', dir=mirror_dir) as temp:
+        temp_dir = pathlib.Path(temp)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(years, pool.map(sync_year, years)))
 
-def _download_files(
-    years: list[int],
+
+def read_manifest(mirror_dir: pathlib.Path) -> dict[str, dict]:
+    '''
+    File name -> year, sha256, size, url and sync time of each zip in a
+    mirror.
+    '''
+    manifest_file = mirror_dir / const.MIRROR_MANIFEST
+    if not manifest_file.exists():
+        return {}
+    with manifest_file.open('r') as f:
+        return json.load(f)
+
+
+def _write_manifest(mirror_dir: pathlib.Path, manifest: dict[str, dict]) -> None:
+    # hosts reading the mirror never see a half written manifest
+    temp_file = mirror_dir / f'{const.MIRROR_MANIFEST}.{os.getpid()}.tmp'
+    with temp_file.open('w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    temp_file.replace(mirror_dir / const.MIRROR_MANIFEST)
+
+
+def _download_file(
+    year: int,
     url_config: cfg.ProductionSummariesUrlConfig,
     out_dir: pathlib.Path,
     logger: logging.Logger,
-) -> dict[int, pathlib.Path]:
-    to_return = {}
-    for year in years:
-        try:
-            url = url_config.url(year)
-            response = requests.get(url)
-            response.raise_for_status()
+) -> tuple[pathlib.Path, str]:
+    mirror_dir = url_config.mirror_dir()
+    if mirror_dir is not None:
+        copied = _copy_from_mirror(year, url_config, mirror_dir, out_dir, logger)
+        if copied is not None:
+            return copied
+    return _download_upstream(year, url_config, out_dir, logger)
+
+
+def _copy_from_mirror(
+    year: int,
+    url_config: cfg.ProductionSummariesUrlConfig,
+    mirror_dir: pathlib.Path,
+    out_dir: pathlib.Path,
+    logger: logging.Logger,
+) -> Optional[tuple[pathlib.Path, str]]:
+    name = url_config.zip_file_name(year)
+    entry = read_manifest(mirror_dir).get(name)
+    mirror_file = mirror_dir / name
+    if entry is None or not mirror_file.exists():
+        logger.info(f'{name} is not in the mirror {mirror_dir}')
+        return None
 
-        except requests.exceptions.HTTPError as e:
-            logger.error(e)
-            raise SystemExit(e)
+    out_file = out_dir / name
+    with telemetry.span('mirror_copy', logger, year=year) as s:
+        with mirror_file.open('rb') as f_in:
+            zip_hash = utils.write_hashed(
+                iter(lambda: f_in.read(const.HASH_CHUNK_SIZE), b''), out_file)
+        s.record(bytes=out_file.stat().st_size)
 
-        to_return[year] = out_dir / url_config.zip_file_name(year)
-        to_return[year].write_bytes(response.content)
-        logger.info(f'downloaded {url} to {to_return[year]}')
+    if zip_hash != entry['sha256']:
+        logger.warning(
+            f'{mirror_file} does not match the mirror manifest, '
+            'downloading it from ECMC instead'
+        )
+        out_file.unlink()
+        return None
 
-    return to_return
+    logger.info(f'copied {mirror_file} to {out_file}')
+    return out_file, zip_hash
 
 
-def _get_zip_metadata(
-    downloaded_files: dict[int, str],
-    zip_dir:pathlib.Path,
-    logger: logging.Logger,
-) -> dict[str, dict]:
-    return {
-        utils.hash_file(f, logger=logger): { # type: ignore
-            'path': zip_dir / f.name, # type: ignore
-            'year': year,
-            'timestamp': datetime.datetime.now().isoformat(),
-        }
-        for year, f in downloaded_files.items()
-    }
-
-
-def _get_db_metadata(
-    access_db_path: pathlib.Path,
-    zip_metadata: dict[str, dict],
+def _download_upstream(
+    year: int,
+    url_config: cfg.ProductionSummariesUrlConfig,
+    out_dir: pathlib.Path,
     logger: logging.Logger,
-) -> dict[int, dict]:
-    to_return = {}
-    for _, metadata in zip_metadata.items():
-        f = access_db_path / f'{metadata["path"].stem}.mdb'
-        to_return[utils.hash_file(f, logger=logger)] = {
-            'year': metadata['year'],
-            'timestamp': metadata['timestamp'],
-            'path': f,
-        }
-    return to_return
-
-
-def _unzip_pulled_files(
-    pull_dir: pathlib.Path,
+) -> tuple[pathlib.Path, str]:
+    with telemetry.span('download', logger, year=year) as s:
+        url = url_config.url(year)
+        response = _get(url, logger)
+
+        out_file = out_dir / url_config.zip_file_name(year)
+        with response:
+            zip_hash = utils.write_hashed(
+                response.iter_content(const.HASH_CHUNK_SIZE), out_file)
+        s.record(bytes=out_file.stat().st_size)
+    logger.info(f'downloaded {url} to {out_file}')
+
+    return out_file, zip_hash
+
+
+def _get(url: str, logger: logging.Logger) -> requests.Response:
+    attempt = 1
+    while True:
+        try:
+            response = requests.get(
+                url, stream=True, timeout=const.DOWNLOAD_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            return response
+
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.HTTPError,
+        ) as e:
+            http_error = isinstance(e, requests.exceptions.HTTPError)
+            if attempt == const.DOWNLOAD_ATTEMPTS or (
+                http_error
+                and e.response.status_code not in const.DOWNLOAD_RETRY_STATUSES
+            ):
+                logger.error(e)
+                if http_error:
+                    raise SystemExit(e)
+                raise
+            wait = const.DOWNLOAD_BACKOFF_SECONDS * 2**(attempt - 1)
+            logger.warning(f'retrying {url} in {wait:.0f}s: {e}')
+            time.sleep(wait)
+            attempt += 1
+
+
+def _unzip_file(
+    zip_path: pathlib.Path,
     db_dir: pathlib.Path,
     logger: logging.Logger,
-) -> None:
-    zip_files = [f for f in pull_dir.iterdir() if f.suffix == '.zip']
-
-    for f in zip_files:
-        if (db_dir / f'{f.stem}.mdb').exists():
-            continue
-        with zipfile.ZipFile(pull_dir / f.name, 'r') as z:
-            z.extractall(db_dir)
\ No newline at end of file
+) -> tuple[pathlib.Path, str]:
+    db_name = f'{zip_path.stem}.mdb'
+    db_path = db_dir / db_name
+    db_dir.mkdir(parents=True, exist_ok=True)
+    with telemetry.span('unzip', logger, file=zip_path) as s:
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            if db_name not in z.namelist():
+                raise FileNotFoundError(f'{db_name} is not in {zip_path}')
+            for info in z.infolist():
+                if info.filename != db_name:
+                    z.extract(info, db_dir)
+                    continue
+                # the database is hashed as it is extracted
+                with z.open(info) as f_in:
+                    db_hash = utils.write_hashed(
+                        iter(lambda: f_in.read(const.HASH_CHUNK_SIZE), b''),
+                        db_path,
+                    )
+            s.record(bytes=sum(i.file_size for i in z.infolist()))
+    logger.info(f'extracted {zip_path} to {db_dir}')
+
+    return db_path, db_hash
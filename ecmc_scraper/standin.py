@@ -0,0 +1,134 @@
+'''
+A local stand-in for the ECMC download page, for benchmarks and for running
+the scrape step without internet access.
+
+StandinServer serves the files in a directory over HTTP on localhost, with a
+fixed latency before each response, an optional bandwidth limit and a
+fraction of requests that fail with 503 Service Unavailable. Failures are
+drawn from a seeded random generator, so a run can be repeated exactly.
+Requests with a matching If-None-Match get 304 Not Modified.
+'''
+
+
+import email.utils
+import hashlib
+import http.server
+import logging
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+from typing import Optional
+
+
+class StandinServer:
+
+    def __init__(
+        self,
+        root: pathlib.Path,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.root = root
+        self.latency = latency
+        # bytes per second
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.logger = logger
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[http.server.ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        if self._server is None:
+            raise RuntimeError('the server is not running')
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def __enter__(self) -> 'StandinServer':
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.standin = self # type: ignore
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='standin-server', daemon=True)
+        self._thread.start()
+        if self.logger is not None:
+            self.logger.info(f'serving {self.root} at {self.base_url}')
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown() # type: ignore
+        self._server.server_close() # type: ignore
+        self._thread.join() # type: ignore
+        self._server = None
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.failure_rate
+            self.failures += fail
+        return fail
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_HEAD(self) -> None:
+        self._respond(body=False)
+
+    def do_GET(self) -> None:
+        self._respond(body=True)
+
+    def log_message(self, format, *args) -> None:
+        standin: StandinServer = self.server.standin # type: ignore
+        if standin.logger is not None:
+            standin.logger.debug(format % args)
+
+    def _respond(self, body: bool) -> None:
+        standin: StandinServer = self.server.standin # type: ignore
+        time.sleep(standin.latency)
+        if standin._should_fail():
+            self.send_error(503, 'injected failure')
+            return
+
+        name = urllib.parse.unquote(urllib.parse.urlparse(self.path).path).lstrip('/')
+        f = standin.root / name
+        if '/' in name or not f.is_file():
+            self.send_error(404)
+            return
+
+        stat = f.stat()
+        etag = f'"{_etag(f, stat.st_mtime_ns)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(stat.st_size))
+        self.send_header(
+            'Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not body:
+            return
+
+        chunk_size = 64 * 1024
+        with f.open('rb') as f_in:
+            while chunk := f_in.read(chunk_size):
+                self.wfile.write(chunk)
+                if standin.bandwidth is not None:
+                    time.sleep(len(chunk) / standin.bandwidth)
+
+
+def _etag(f: pathlib.Path, mtime_ns: int) -> str:
+    return hashlib.sha256(f'{f.name}:{mtime_ns}'.encode()).hexdigest()[:16]
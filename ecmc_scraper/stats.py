@@ -0,0 +1,146 @@
+'''
+Per-column statistics of the converted tables.
+
+The convert step computes, in one pass over each parquet file, the row count
+and the null count, minimum and maximum of every column, an approximate
+distinct count of the columns in const.STATS_DISTINCT_COLUMNS and the sum of
+the columns in const.STATS_SUM_COLUMNS, and keeps them in the catalog. The
+distinct counts are kept as numbers rather than sketches, so the counts of
+several years can't be combined into one. Every
+generation keeps its statistics, so a new generation can be compared with the
+one it replaced without reading either file, and a filter on a column can
+skip the years whose minimum and maximum rule it out.
+'''
+
+
+import datetime
+import pathlib
+from typing import Any, Optional
+
+import polars as pl
+
+from . import catalog as ctlg
+from . import const
+
+
+def compute(path: pathlib.Path) -> list[ctlg.ColumnStats]:
+    lf = pl.scan_parquet(path)
+    schema = lf.schema
+    exprs = [pl.len().alias('rows')]
+    for c, dtype in schema.items():
+        exprs.append(pl.col(c).null_count().alias(f'{c}\0null_count'))
+        if _orderable(dtype):
+            exprs.append(pl.col(c).min().alias(f'{c}\0min'))
+            exprs.append(pl.col(c).max().alias(f'{c}\0max'))
+        if c in const.STATS_DISTINCT_COLUMNS:
+            # HyperLogLog, so it is cheap however many distinct values there are
+            exprs.append(pl.col(c).approx_n_unique().alias(f'{c}\0distinct'))
+        if c in const.STATS_SUM_COLUMNS and dtype.is_numeric():
+            exprs.append(pl.col(c).sum().cast(pl.Float64).alias(f'{c}\0sum'))
+    row = lf.select(exprs).collect().row(0, named=True)
+
+    return [
+        ctlg.ColumnStats(
+            column=c,
+            rows=row['rows'],
+            null_count=row[f'{c}\0null_count'],
+            min=to_stat_value(row.get(f'{c}\0min')),
+            max=to_stat_value(row.get(f'{c}\0max')),
+            distinct=row.get(f'{c}\0distinct'),
+            sum=row.get(f'{c}\0sum'),
+        )
+        for c in schema
+    ]
+
+
+def to_stat_value(value: Any) -> Any:
+    '''
+    Values the catalog can store and compare: dates and times become ISO
+    strings, which sort the same way.
+    '''
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def may_contain(
+    column_stats: ctlg.ColumnStats,
+    low: Any = None,
+    high: Any = None,
+) -> bool:
+    '''
+    False only if no value of the column can be from low to high.
+    '''
+    if column_stats.rows == column_stats.null_count:
+        return False
+    if column_stats.min is None or column_stats.max is None:
+        return True
+    low, high = to_stat_value(low), to_stat_value(high)
+    try:
+        return (
+            (low is None or column_stats.max >= low)
+            and (high is None or column_stats.min <= high)
+        )
+    except TypeError:
+        # e.g. a number compared with a column of strings
+        return True
+
+
+def compare(
+    old: dict[str, ctlg.ColumnStats],
+    new: dict[str, ctlg.ColumnStats],
+) -> list[str]:
+    '''
+    One line for each difference between the statistics of two generations
+    of a file.
+    '''
+    lines = []
+    old_rows = next(iter(old.values())).rows if len(old) > 0 else 0
+    new_rows = next(iter(new.values())).rows if len(new) > 0 else 0
+    if old_rows != new_rows:
+        lines.append(f'rows: {old_rows} -> {new_rows} ({new_rows - old_rows:+})')
+
+    for c in old:
+        if c not in new:
+            lines.append(f'{c}: column removed')
+    for c, s in new.items():
+        if c not in old:
+            lines.append(f'{c}: column added')
+            continue
+        o = old[c]
+        if o.null_count != s.null_count:
+            lines.append(
+                f'{c}: nulls {o.null_count} -> {s.null_count} '
+                f'({s.null_count - o.null_count:+})'
+            )
+        if (o.min, o.max) != (s.min, s.max):
+            lines.append(f'{c}: range {o.min}..{o.max} -> {s.min}..{s.max}')
+        if o.distinct != s.distinct:
+            lines.append(f'{c}: about {o.distinct} -> {s.distinct} distinct values')
+        if o.sum != s.sum:
+            lines.append(
+                f'{c}: sum {_format_sum(o.sum)} -> {_format_sum(s.sum)}'
+                f'{_format_change(o.sum, s.sum)}'
+            )
+
+    return lines
+
+
+def _orderable(dtype: pl.DataType) -> bool:
+    return (
+        dtype.is_numeric()
+        or dtype.is_temporal()
+        or dtype in (pl.Utf8, pl.Boolean)
+    )
+
+
+def _format_sum(value: Optional[float]) -> str:
+    return 'none' if value is None else f'{value:,.2f}'
+
+
+def _format_change(old: Optional[float], new: Optional[float]) -> str:
+    if old is None or new is None or old == 0:
+        return ''
+    return f' ({(new - old) / abs(old):+.2%})'
@@ -0,0 +1,237 @@
+'''
+Deterministic synthetic data shaped like the ECMC Annual Production Summaries,
+for benchmarking and exercising the pipeline without the ECMC website or the
+Microsoft Access driver.
+
+Tables have the columns the transform step expects, several formations per
+well, duplicated rows and nulls in the columns that get filled with zero. The
+same arguments always produce the same data.
+'''
+
+
+import datetime
+import json
+import logging
+import pathlib
+import zipfile
+from typing import Optional
+
+import polars as pl
+
+from . import catalog as ctlg
+from . import config as cfg
+from . import const
+from . import enum
+
+
+DUPLICATE_FRACTION = 0.02
+NULL_FRACTION = 0.05
+FORMATIONS_PER_WELL = 3
+STANDIN_MDB_HEADER = b'ECMC-SCRAPER-SYNTHETIC\n'
+
+
+def production_table(year: int, rows: int, seed: int = 0) -> pl.DataFrame:
+    unique_rows = rows - int(rows * DUPLICATE_FRACTION)
+    wells = max(unique_rows // FORMATIONS_PER_WELL, 1)
+    fill_null_columns = const.DEFAULT_TRANSFORM_CONFIG[
+        'production_columns_to_fill_null_with_zero']
+
+    df = (
+        _rows(unique_rows)
+        .with_columns(_random('row', seed, 1, wells).alias('well'))
+        .with_columns(
+            pl.lit(year).alias('report_year'),
+            *_api_columns('well'),
+            pl.format('F{}', _random('row', seed, 2, 40)).alias('formation_code'),
+            _random('well', seed, 3, 400).alias('operator_num'),
+            pl.when(_random('row', seed, 4, 10) == 0)
+            .then(pl.lit('SI'))
+            .otherwise(pl.lit('PR'))
+            .alias('well_status'),
+            _random('row', seed, 5, 367).cast(pl.Int32).alias('Prod_days'),
+            *[
+                _nullable(
+                    _random('row', seed, 10 + i, 1_000_000).cast(pl.Float64) / 100,
+                    seed,
+                    100 + i,
+                ).alias(c)
+                for i, c in enumerate(fill_null_columns)
+            ],
+        )
+        .with_columns(pl.format('Operator {}', 'operator_num').alias('name'))
+        .drop('row', 'well')
+    )
+
+    return _with_duplicates(df, rows, seed)
+
+
+def completions_table(year: int, rows: int, seed: int = 0) -> pl.DataFrame:
+    unique_rows = rows - int(rows * DUPLICATE_FRACTION)
+
+    df = (
+        _rows(unique_rows)
+        .with_columns(
+            pl.concat_str(
+                [
+                    pl.lit('05'),
+                    *[c.cast(pl.Utf8).str.zfill(w) for c, w in zip(
+                        _api_columns('row'), (3, 5, 2))],
+                ],
+                separator='-',
+            ).alias('API_num'),
+            pl.format('Facility {}', _random('row', seed, 21, 5_000)).alias('facility_name'),
+            _random('row', seed, 22, 100_000).alias('facility_num'),
+            pl.format('Well {}', 'row').alias('well_name'),
+            pl.when(_random('row', seed, 23, 8) == 0)
+            .then(pl.lit('SI'))
+            .otherwise(pl.lit('PR'))
+            .alias('well_bore_status'),
+            pl.format('COUNTY {}', _random('row', seed, 24, 64)).alias('county'),
+            (37 + _random('row', seed, 25, 4_000_000).cast(pl.Float64) / 1_000_000)
+            .alias('lat'),
+            (-109 + _random('row', seed, 26, 7_000_000).cast(pl.Float64) / 1_000_000)
+            .alias('long'),
+            (
+                pl.lit(datetime.datetime(year, 1, 1))
+                - pl.duration(days=_random('row', seed, 27, 365 * 40))
+            ).alias('first_prod_date'),
+            _nullable(_random('row', seed, 28, 4).cast(pl.Int32), seed, 29)
+            .alias('gas_type'),
+        )
+        .drop('row')
+    )
+
+    return _with_duplicates(df, rows, seed)
+
+
+def write_parquet(
+    parquet_dir: pathlib.Path,
+    years: list[int],
+    rows: int,
+    seed: int = 0,
+    catalog: Optional[ctlg.Catalog] = None,
+) -> dict[int, dict[str, pathlib.Path]]:
+    '''
+    Writes parquet files named the way the convert step names them, and
+    catalogs them if a catalog is given, so the transform step can run on them
+    directly.
+    '''
+    parquet_dir.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for year in years:
+        files[year] = {
+            'production_path': parquet_dir \
+                / f'{enum.MsAccessTable.production}_{year}.parquet',
+            'completions_path': parquet_dir \
+                / f'{enum.MsAccessTable.completions}_{year}.parquet',
+        }
+        production_table(year, rows, seed).write_parquet(
+            files[year]['production_path'])
+        completions_table(year, rows // 4, seed).write_parquet(
+            files[year]['completions_path'])
+
+    if catalog is not None:
+        for year, year_files in files.items():
+            catalog.record(
+                enum.CatalogStage.parquet,
+                year,
+                catalog.hash_file(year_files['production_path']),
+                year_files,
+            )
+
+    return files
+
+
+def write_zip(
+    zip_dir: pathlib.Path,
+    year: int,
+    rows: int,
+    url_config: Optional[cfg.ProductionSummariesUrlConfig] = None,
+    seed: int = 0,
+    mdb_size: int = 0,
+) -> pathlib.Path:
+    '''
+    Writes a zip named the way ECMC names it. The zipped .mdb file is not a
+    real Access database; it holds the arguments needed to regenerate its
+    tables with read_standin_mdb, padded to mdb_size bytes.
+    '''
+    if url_config is None:
+        url_config = cfg.ProductionSummariesUrlConfig.from_dict(
+            const.DEFAULT_URL_CONFIG)
+    zip_dir.mkdir(parents=True, exist_ok=True)
+    zip_path = zip_dir / url_config.zip_file_name(year)
+
+    content = STANDIN_MDB_HEADER \
+        + json.dumps({'year': year, 'rows': rows, 'seed': seed}).encode()
+    content += b'\0' * max(mdb_size - len(content), 0)
+
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        # a fixed timestamp keeps the zip, and so its hash, deterministic
+        z.writestr(
+            zipfile.ZipInfo(f'{zip_path.stem}.mdb', (1999, 1, 1, 0, 0, 0)),
+            content,
+        )
+
+    return zip_path
+
+
+def read_standin_mdb(
+    mdb_path: pathlib.Path,
+    table: enum.MsAccessTable,
+) -> pl.DataFrame:
+    with mdb_path.open('rb') as f:
+        if f.readline() != STANDIN_MDB_HEADER:
+            raise ValueError(f'{mdb_path} was not written by write_zip')
+        args = json.loads(f.readline().rstrip(b'\0'))
+
+    if table == enum.MsAccessTable.production:
+        return production_table(args['year'], args['rows'], args['seed'])
+    return completions_table(args['year'], args['rows'] // 4, args['seed'])
+
+
+def read_standin_table(
+    table: enum.MsAccessTable,
+    connection: dict[enum.ODBCKey, str],
+    logger: logging.Logger,
+) -> pl.DataFrame:
+    '''
+    Reads a table of a database written by write_zip in place of the Access
+    driver, e.g. convert_year(..., read_table=read_standin_table).
+    '''
+    logger.info(f'loading stand-in data for {table} from {connection[enum.ODBCKey.dbq]}')
+    return read_standin_mdb(pathlib.Path(connection[enum.ODBCKey.dbq]), table)
+
+
+def _rows(rows: int) -> pl.DataFrame:
+    return pl.DataFrame({'row': pl.int_range(0, rows, dtype=pl.UInt64, eager=True)})
+
+
+def _random(column: str, seed: int, salt: int, high: int) -> pl.Expr:
+    return (pl.col(column).hash(seed=seed * 1_000 + salt) % high).cast(pl.Int64)
+
+
+def _nullable(expr: pl.Expr, seed: int, salt: int) -> pl.Expr:
+    return (
+        pl.when(_random('row', seed, salt, int(1 / NULL_FRACTION)) == 0)
+        .then(None)
+        .otherwise(expr)
+    )
+
+
+def _api_columns(column: str) -> list[pl.Expr]:
+    # unpadded strings, the way the Access tables store them
+    return [
+        (pl.col(column) % 63 * 2 + 1).cast(pl.Utf8).alias('api_county_code'),
+        (pl.col(column) // 63 % 100_000).cast(pl.Utf8).alias('api_seq_num'),
+        (pl.col(column) // 6_300_000 % 100).cast(pl.Utf8).alias('sidetrack_num'),
+    ]
+
+
+def _with_duplicates(df: pl.DataFrame, rows: int, seed: int) -> pl.DataFrame:
+    duplicates = rows - df.height
+    if duplicates <= 0:
+        return df
+    return pl.concat([
+        df,
+        df.sample(n=min(duplicates, df.height), seed=seed),
+    ])
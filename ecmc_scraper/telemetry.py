@@ -0,0 +1,140 @@
+'''
+Timing spans for the pipeline stages. Each span logs one record with its wall
+time, bytes, rows, throughput and the process peak RSS as extra fields, which
+MyJSONFormatter writes into the JSONL log. Spans are also totalled by name for
+an end-of-run summary.
+'''
+
+
+import collections
+import contextlib
+from dataclasses import dataclass, field
+import logging
+import threading
+import time
+from typing import Iterator, Optional
+
+from . import memory
+
+
+@dataclass
+class Span:
+    name: str
+    fields: dict = field(default_factory=dict)
+    bytes: Optional[int] = None
+    rows: Optional[int] = None
+
+    def record(
+        self,
+        bytes: Optional[int] = None,
+        rows: Optional[int] = None,
+        **fields,
+    ) -> None:
+        if bytes is not None:
+            self.bytes = (self.bytes or 0) + bytes
+        if rows is not None:
+            self.rows = (self.rows or 0) + rows
+        self.fields.update(fields)
+
+
+@dataclass
+class SpanTotal:
+    count: int = 0
+    wall_seconds: float = 0.0
+    bytes: int = 0
+    rows: int = 0
+    peak_rss: int = 0
+    # perf_counter() when the first span started and the last one ended
+    first_start: Optional[float] = None
+    last_end: Optional[float] = None
+
+    @property
+    def elapsed_seconds(self) -> float:
+        '''
+        The time from the start of the first span to the end of the last one,
+        which unlike wall_seconds counts spans running at once only once.
+        '''
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+
+_totals: dict[str, SpanTotal] = collections.defaultdict(SpanTotal)
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(
+    name: str,
+    logger: Optional[logging.Logger] = None,
+    level: int = logging.INFO,
+    **fields,
+) -> Iterator[Span]:
+    s = Span(name, fields)
+    start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        end = time.perf_counter()
+        wall = end - start
+        peak = memory.peak_rss()
+        with _lock:
+            total = _totals[name]
+            total.count += 1
+            total.wall_seconds += wall
+            total.bytes += s.bytes or 0
+            total.rows += s.rows or 0
+            total.peak_rss = max(total.peak_rss, peak or 0)
+            if total.first_start is None or start < total.first_start:
+                total.first_start = start
+            if total.last_end is None or end > total.last_end:
+                total.last_end = end
+
+        if logger is not None and logger.isEnabledFor(level):
+            logger.log(
+                level,
+                f'{name} took {wall:.3f}s',
+                extra={
+                    **s.fields,
+                    'span': name,
+                    'wall_seconds': wall,
+                    'bytes': s.bytes,
+                    'rows': s.rows,
+                    'rows_per_second': _rate(s.rows, wall),
+                    'bytes_per_second': _rate(s.bytes, wall),
+                    'peak_rss': peak,
+                },
+            )
+
+
+def summary() -> dict[str, SpanTotal]:
+    with _lock:
+        return {name: SpanTotal(**vars(total)) for name, total in _totals.items()}
+
+
+def reset() -> None:
+    with _lock:
+        _totals.clear()
+
+
+def log_summary(logger: logging.Logger) -> list[dict]:
+    rows = [
+        {
+            'span': name,
+            'count': total.count,
+            'wall_seconds': round(total.wall_seconds, 3),
+            'bytes': total.bytes,
+            'rows': total.rows,
+            'rows_per_second': _rate(total.rows, total.wall_seconds),
+            'peak_rss': total.peak_rss,
+        }
+        for name, total in sorted(summary().items())
+    ]
+    logger.info('run summary', extra={'summary': rows})
+    return rows
+
+
+def _rate(amount: Optional[int], seconds: float) -> Optional[float]:
+    if not amount or seconds <= 0:
+        return None
+    return amount / seconds
@@ -5,72 +5,292 @@ that Ben Hmiel used at the start of this project.
 '''
 
 
-import json
 import logging
 import pathlib
+import threading
+from typing import Callable, Optional, TypeVar
 
 import polars as pl
 
+from . import catalog as ctlg
 from . import config as cfg
+from . import const
+from . import enum
+from . import locks as lck
+from . import profiling
+from . import telemetry
 from . import utils
 
 
-def transform(
+Frame = TypeVar('Frame', pl.DataFrame, pl.LazyFrame)
+
+
+class Exporter:
+    '''
+    Joins each year of transformed production with the completions of the
+    latest year and writes the result. Years that arrive before the latest
+    completions are held until those completions are available. With locks,
+    each year is locked while it is checked and written, so another invocation
+    exporting the same year is waited for.
+    '''
+
+    def __init__(
+        self,
+        config: cfg.ProductionSummariesConfig,
+        catalog: ctlg.Catalog,
+        completions_year: int,
+        backup_path: pathlib.Path,
+        logger: logging.Logger,
+        on_export: Optional[Callable[[ctlg.Artifact], None]] = None,
+        locks: Optional[lck.Locks] = None,
+    ):
+        self.config = config
+        self.catalog = catalog
+        self.completions_year = completions_year
+        self.backup_path = backup_path
+        self.logger = logger
+        # called with each year's export once it is written or found current
+        self.on_export = on_export
+        self.locks = locks
+        self.config_fingerprint = ctlg.fingerprint(config.transform_config)
+        self._completions: Optional[tuple[ctlg.Artifact, pl.DataFrame]] = None
+        self._pending: list[tuple[ctlg.Artifact, Optional[pl.DataFrame]]] = []
+        self._lock = threading.Lock()
+        config.export_dir.mkdir(parents=True, exist_ok=True)
+
+    def is_current(self, parquet_artifact: ctlg.Artifact) -> bool:
+        previous = self.catalog.current(
+            enum.CatalogStage.export, parquet_artifact.year)
+        return (
+            previous is not None
+            and previous.hash == parquet_artifact.hash
+            and previous.config_fingerprint == self.config_fingerprint
+            # exports written before the cubes existed are redone once
+            and 'cube_path' in previous.files
+            # as are exports without the row hashes that change sets are
+            # made from, once change sets are asked for
+            and (
+                not self.config.export_changes
+                or 'row_hashes_path' in previous.files
+            )
+            and previous.exists()
+        )
+
+    def set_completions(
+        self,
+        parquet_artifact: ctlg.Artifact,
+        df: pl.DataFrame,
+    ) -> None:
+        with self._lock:
+            self._completions = (parquet_artifact, df)
+            pending, self._pending = self._pending, []
+        for args in pending:
+            self._write(*args)
+
+    def submit(
+        self,
+        parquet_artifact: ctlg.Artifact,
+        production: Optional[pl.DataFrame],
+    ) -> None:
+        with self._lock:
+            if self._completions is None:
+                self._pending.append((parquet_artifact, production))
+                return
+        self._write(parquet_artifact, production)
+
+    def close(self) -> None:
+        with self._lock:
+            pending = len(self._pending)
+        if pending > 0:
+            raise RuntimeError(
+                f'completions for {self.completions_year} were never loaded; '
+                f'{pending} years were not exported'
+            )
+
+    def _write(
+        self,
+        parquet_artifact: ctlg.Artifact,
+        production: Optional[pl.DataFrame],
+    ) -> None:
+        if self.locks is None:
+            self._write_export(parquet_artifact, production)
+            return
+        with self.locks.unit('transform', parquet_artifact.year, self.logger):
+            self._write_export(parquet_artifact, production)
+
+    def _write_export(
+        self,
+        parquet_artifact: ctlg.Artifact,
+        production: Optional[pl.DataFrame],
+    ) -> None:
+        completions_artifact, completions = self._completions # type: ignore
+        year = parquet_artifact.year
+
+        previous = self.catalog.current(enum.CatalogStage.export, year)
+        if (
+            self.is_current(parquet_artifact)
+            and previous.extra.get('completions_hash') == completions_artifact.hash # type: ignore
+        ):
+            self.logger.info(f'no changes to export for {year}')
+            if self.on_export is not None:
+                self.on_export(previous) # type: ignore
+            return
+
+        if production is None:
+            production = _transform_production(
+                table_path(parquet_artifact, 'production'),
+                self.config.transform_config.production_columns_to_keep,
+                self.config.transform_config.production_columns_to_fill_null_with_zero,
+                self.logger,
+            )
+
+        self.catalog.backup(
+            enum.CatalogStage.export, year, self.backup_path, logger=self.logger)
+        df_out = _write_output_data(
+            {
+                'production': {year: production},
+                'completions': {self.completions_year: completions},
+            },
+            self.config.export_dir,
+            self.config.transform_config.remove_CO2_wells,
+            self.logger,
+        )[year]
+
+        files = {
+            'path': self.config.export_dir / f'{year}.csv',
+            'cube_path': self.config.export_dir / 'cubes' / f'{year}.parquet',
+        }
+        _write_cube(df_out, year, files['cube_path'], self.logger)
+        extra = {
+            'completions_id': completions_artifact.id,
+            'completions_hash': completions_artifact.hash,
+        }
+        if self.config.export_changes:
+            extra['row_hash'] = _ROW_HASH
+            # the previous generation's files have been moved by the backup
+            previous = None if previous is None else self.catalog.get(previous.id)
+            change_files, extra['changes'] = _write_changes(
+                df_out,
+                year,
+                previous,
+                self.config.export_dir / 'changes',
+                self.logger,
+            )
+            files.update(change_files)
+
+        artifact = self.catalog.record(
+            enum.CatalogStage.export,
+            year,
+            parquet_artifact.hash,
+            files,
+            source=parquet_artifact,
+            config_fingerprint=self.config_fingerprint,
+            timestamp=parquet_artifact.timestamp,
+            extra=extra,
+            logger=self.logger,
+        )
+        if self.on_export is not None:
+            self.on_export(artifact)
+
+
+# the last transformed completions, kept for the next run of a long-running
+# process such as `watch`, keyed by the file they were read from and the
+# transform config
+_completions_cache: dict[tuple, pl.DataFrame] = {}
+_completions_lock = threading.Lock()
+
+# how the rows of the exports are hashed for change sets, recorded with each
+# export
+_ROW_HASH_SEEDS = (0, 1, 2, 3)
+_ROW_HASH = f'polars {pl.__version__} hash_rows'
+
+
+def load_completions(
+    parquet_artifact: ctlg.Artifact,
     config: cfg.ProductionSummariesConfig,
+    exporter: Exporter,
     logger: logging.Logger,
 ) -> None:
-    with (config.parquet_dir / 'metadata.json').open('r') as f:
-        parquet_metadata = json.load(f)
-
-    output_previous_versions_path = config.export_dir / 'previous_versions'
-    output_previous_versions_path.mkdir(parents=True, exist_ok=True)
-        
-    output_metadata = _get_output_metadata(parquet_metadata, config.export_dir, logger)
-    output_metadata_path = config.export_dir / 'metadata.json'
-
-    if utils.new_hashes(output_metadata, output_metadata_path, logger=logger):
-        utils.backup(
-            config.export_dir, output_previous_versions_path, 'csv', logger=logger)
-
-        with output_metadata_path.open('w') as f:
-            json.dump(utils.to_json(output_metadata, logger=logger), f)
-
-        data = {'production': {}, 'completions': {}}
-        for _, hash_dict in parquet_metadata.items():
-            data['production'][hash_dict['year']] = _transform_production(
-                pathlib.Path(hash_dict['production_path']),
-                config.transform_config.production_columns_to_keep,
-                config.transform_config.production_columns_to_fill_null_with_zero,
-                logger,
-            )
-            data['completions'][hash_dict['year']] = _transform_completions(
-                pathlib.Path(hash_dict['completions_path']),
-                config.transform_config.completions_columns_to_keep,
-                config.transform_config.completions_columns_to_fill_null_with_zero,
-                logger,
-            )
+    path = table_path(parquet_artifact, 'completions')
+    stat = path.stat()
+    key = (
+        path,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ino,
+        ctlg.fingerprint(config.transform_config),
+    )
+    with _completions_lock:
+        completions = _completions_cache.get(key)
 
-        _write_output_data(
-            data,
-            config.export_dir,
-            config.transform_config.remove_CO2_wells,
+    if completions is not None:
+        logger.info(f'reused the transformed completions of {parquet_artifact.year}')
+    else:
+        completions = _transform_completions(
+            path,
+            config.transform_config.completions_columns_to_keep,
+            config.transform_config.completions_columns_to_fill_null_with_zero,
             logger,
         )
+        with _completions_lock:
+            _completions_cache.clear()
+            _completions_cache[key] = completions
 
+    exporter.set_completions(parquet_artifact, completions)
 
-def _get_output_metadata(
-    parquet_metadata: dict,
-    output_path: pathlib.Path,
+
+def transform_year(
+    parquet_artifact: ctlg.Artifact,
+    config: cfg.ProductionSummariesConfig,
+    exporter: Exporter,
     logger: logging.Logger,
-) -> dict:
-    return {
-        sha_hash: {
-            'year': hash_dict['year'],
-            'path': output_path / f'{hash_dict["year"]}.csv',
-            'timestamp': hash_dict['timestamp'],
-        }
-        for sha_hash, hash_dict in parquet_metadata.items()
-    }
+) -> ctlg.Artifact:
+    if parquet_artifact.year == exporter.completions_year:
+        load_completions(parquet_artifact, config, exporter, logger)
+
+    production = None
+    if not exporter.is_current(parquet_artifact):
+        production = _transform_production(
+            table_path(parquet_artifact, 'production'),
+            config.transform_config.production_columns_to_keep,
+            config.transform_config.production_columns_to_fill_null_with_zero,
+            logger,
+        )
+
+    exporter.submit(parquet_artifact, production)
+
+    return parquet_artifact
+
+
+def table_path(parquet_artifact: ctlg.Artifact, table: str) -> pathlib.Path:
+    '''
+    The Arrow IPC file for table if the artifact has one, otherwise the
+    parquet file.
+    '''
+    return parquet_artifact.files.get(
+        f'{table}_ipc_path', parquet_artifact.files[f'{table}_path'])
+
+
+def scan_table(path: pathlib.Path) -> pl.LazyFrame:
+    if path.suffix == '.arrow':
+        # uncompressed IPC files are read zero-copy from the page cache
+        return pl.scan_ipc(path, memory_map=True)
+    if path.suffixes[-2:] == ['.arrow', '.lz4']:
+        return pl.scan_ipc(path, memory_map=False)
+    return pl.scan_parquet(path)
+
+
+def output_frame(production: Frame, completions: Frame, remove_co2_wells: bool) -> Frame:
+    '''
+    The export of one year: its transformed production joined with the
+    transformed completions. Takes and returns DataFrames or LazyFrames.
+    '''
+    out = production.join(completions, on='API_num', how='outer')
+    if remove_co2_wells:
+        # without fill_null, Polars pushes the filter into the production side
+        # of a lazy outer join and keeps the wells with no production
+        out = out.filter((pl.col('Prod_days') != 0).fill_null(False))
+    return out
 
 
 def _write_output_data(
@@ -78,16 +298,163 @@ def _write_output_data(
     output_path: pathlib.Path,
     remove_co2_wells: bool,
     logger: logging.Logger,
-) -> None:
+) -> dict[int, pl.DataFrame]:
+    out = {}
     for year, df in data['production'].items():
-        df_out = df.join(
-            data['completions'][max(data['completions'])],
-            on='API_num',
-            how='outer',
+        df_out = output_frame(
+            df, data['completions'][max(data['completions'])], remove_co2_wells)
+        out_file = output_path / f'{year}.csv'
+        with telemetry.span('csv_write', logger, year=year) as s:
+            with utils.atomic_write(out_file) as temp_file:
+                df_out.write_csv(temp_file, date_format='%F', time_format='%F')
+            s.record(rows=df_out.height, bytes=out_file.stat().st_size)
+        out[year] = df_out
+
+    return out
+
+
+def _write_cube(
+    df_out: pl.DataFrame,
+    year: int,
+    out_file: pathlib.Path,
+    logger: logging.Logger,
+) -> None:
+    '''
+    Totals of the exported wells by county, operator and well type, so
+    dashboards don't have to aggregate the per-well export. BOEd_sum is kept
+    next to BOEd_mean so cubes can be rolled up further (see query.rollup).
+    '''
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with telemetry.span('cube', logger, year=year) as s:
+        cube = (
+            df_out.lazy()
+            # wells with completions but no production this year
+            .filter(pl.col('well_type').is_not_null())
+            .group_by('county', 'operator_num', 'well_type')
+            .agg(
+                pl.col('name').first().alias('operator_name'),
+                pl.len().alias('wells'),
+                *[pl.col(c).sum() for c in const.CUBE_SUM_COLUMNS],
+                pl.col('BOEd').sum().alias('BOEd_sum'),
+            )
+            .with_columns(
+                pl.lit(year).alias('year'),
+                (pl.col('BOEd_sum') / pl.col('wells')).alias('BOEd_mean'),
+            )
+            .select(*const.CUBE_DIMENSIONS, pl.exclude(const.CUBE_DIMENSIONS))
+            .sort('county', 'operator_num', 'well_type', nulls_last=True)
+            .collect()
         )
-        if remove_co2_wells:
-            df_out = df_out.filter(pl.col('Prod_days') != 0)
-        df_out.write_csv(output_path / f'{year}.csv', date_format='%F', time_format='%F')
+        with utils.atomic_write(out_file) as temp_file:
+            cube.write_parquet(temp_file)
+        s.record(rows=cube.height, bytes=out_file.stat().st_size)
+
+
+def _write_changes(
+    df_out: pl.DataFrame,
+    year: int,
+    previous: Optional[ctlg.Artifact],
+    out_dir: pathlib.Path,
+    logger: logging.Logger,
+) -> tuple[dict[str, pathlib.Path], Optional[dict]]:
+    '''
+    Writes the rows of the wells inserted and updated since the previous
+    export, and the API numbers of the wells deleted since then. Updated wells
+    are written whole, so applying a change set is a delete and insert by
+    API_num and applying it twice does no harm.
+
+    The row hashes are written too, to compare the next export against. If
+    the previous export has none, or they were made by another version of
+    Polars, only the row hashes are written.
+    '''
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files = {'row_hashes_path': out_dir / f'{year}.row_hashes.parquet'}
+
+    with telemetry.span('changes', logger, year=year) as s:
+        hashes = _row_hashes(df_out)
+        with utils.atomic_write(files['row_hashes_path']) as temp_file:
+            hashes.write_parquet(temp_file)
+
+        if previous is None:
+            previous_hashes = hashes.clear()
+        elif (
+            'row_hashes_path' not in previous.files
+            or not previous.exists()
+        ):
+            logger.warning(
+                f'previous export for {year} has no row hashes, '
+                'so no changes were written'
+            )
+            return files, None
+        elif previous.extra.get('row_hash') != _ROW_HASH:
+            logger.warning(
+                f'previous export for {year} was hashed with '
+                f'{previous.extra.get("row_hash", "another hash")}, not '
+                f'{_ROW_HASH}, so no changes were written'
+            )
+            return files, None
+        else:
+            previous_hashes = pl.read_parquet(previous.files['row_hashes_path'])
+
+        keys = _changed_keys(previous_hashes, hashes)
+        api_num = pl.coalesce(_key_columns(df_out))
+        for kind in ('inserts', 'updates'):
+            files[f'{kind}_path'] = out_dir / f'{year}.{kind}.csv'
+            with utils.atomic_write(files[f'{kind}_path']) as temp_file:
+                df_out.filter(api_num.is_in(keys[kind])).write_csv(
+                    temp_file, date_format='%F', time_format='%F')
+        files['deletes_path'] = out_dir / f'{year}.deletes.csv'
+        with utils.atomic_write(files['deletes_path']) as temp_file:
+            keys['deletes'].to_frame().write_csv(temp_file)
+
+        counts = {kind: len(k) for kind, k in keys.items()}
+        s.record(rows=sum(counts.values()), **counts)
+
+    logger.info(
+        f'{counts["inserts"]} wells inserted, {counts["updates"]} updated '
+        f'and {counts["deletes"]} deleted in {year}',
+        extra={'year': year, **counts},
+    )
+    return files, {
+        'previous_id': None if previous is None else previous.id,
+        **counts,
+    }
+
+
+def _row_hashes(df: pl.DataFrame) -> pl.DataFrame:
+    '''
+    One hash of each row, keyed by API_num. Polars' hashes are only stable
+    within a version of Polars, so the hashes are only compared with ones made
+    by the same _ROW_HASH.
+    '''
+    return pl.DataFrame({
+        'API_num': df.select(pl.coalesce(_key_columns(df))).to_series(),
+        'row_hash': df.hash_rows(*_ROW_HASH_SEEDS),
+    })
+
+
+def _changed_keys(
+    previous_hashes: pl.DataFrame,
+    hashes: pl.DataFrame,
+) -> dict[str, pl.Series]:
+    # a well can have several rows, so wells are compared by all their hashes
+    def by_well(df: pl.DataFrame) -> pl.DataFrame:
+        return df.group_by('API_num').agg(
+            pl.col('row_hash').sort().cast(pl.Utf8).str.concat(',').alias('rows'))
+
+    previous_wells = by_well(previous_hashes)
+    wells = by_well(hashes)
+    return {
+        'inserts': wells.join(previous_wells, on='API_num', how='anti')['API_num'],
+        'updates': wells.join(previous_wells, on='API_num', how='inner')
+            .filter(pl.col('rows') != pl.col('rows_right'))['API_num'],
+        'deletes': previous_wells.join(wells, on='API_num', how='anti')['API_num'],
+    }
+
+
+def _key_columns(df: pl.DataFrame) -> list[str]:
+    # the outer join keeps the completions API_num as API_num_right
+    return [c for c in ('API_num', 'API_num_right') if c in df.columns]
 
 
 def _transform_production(
@@ -96,8 +463,21 @@ def _transform_production(
     production_fillnull: list[str],
     logger: logging.Logger,
 ) -> pl.DataFrame:
+    lf = production_frame(
+        scan_table(parquet_path), production_keep, production_fillnull)
+    return _collect(lf, 'transform_production', parquet_path, logger)
+
+
+def production_frame(
+    lf: pl.LazyFrame,
+    production_keep: list[str],
+    production_fillnull: list[str],
+) -> pl.LazyFrame:
+    '''
+    The transform of a converted production table, one row per well.
+    '''
     return (
-        pl.scan_parquet(parquet_path)
+        lf
         # build API_num column
         .with_columns(
             pl.concat_str(
@@ -113,7 +493,7 @@ def _transform_production(
         # keep only wanted columns
         .select(pl.col(*production_keep))
         # drop duplicates
-        .unique()
+        .pipe(_unique)
         # replace null with 0
         .with_columns(*[
             pl.col(col).fill_null(strategy='zero')
@@ -168,7 +548,7 @@ def _transform_production(
             .otherwise(pl.lit('Dry Gas'))
             .alias('well_type')
         )
-    ).collect()
+    )
 
 
 def _transform_completions(
@@ -177,15 +557,70 @@ def _transform_completions(
     completions_fillnull: list[str],
     logger: logging.Logger,
 ) -> pl.DataFrame:
+    lf = completions_frame(
+        scan_table(parquet_path), completions_keep, completions_fillnull)
+    return _collect(lf, 'transform_completions', parquet_path, logger)
+
+
+def completions_frame(
+    lf: pl.LazyFrame,
+    completions_keep: list[str],
+    completions_fillnull: list[str],
+) -> pl.LazyFrame:
+    '''
+    The transform of a converted completions table.
+    '''
     return (
-        pl.scan_parquet(parquet_path)
+        lf
         # remove unneeded columns
         .select(pl.col(*completions_keep))
         # drop duplicates
-        .unique()
+        .pipe(_unique)
         # replace null with 0
         .with_columns(*[
             pl.col(col).fill_null(strategy='zero')
             for col in completions_fillnull
         ])
-    ).collect()
\ No newline at end of file
+    )
+
+
+def _unique(lf: pl.LazyFrame) -> pl.LazyFrame:
+    '''
+    Keeps the first of each set of duplicate rows. A 64-bit hash of each row
+    finds the rows that may be duplicates, and only those are compared column
+    by column.
+
+    The convert step already dropped rows that are duplicated in the Access
+    tables, but rows that only differ in columns that aren't kept, like the
+    formation of a well, become duplicates here.
+    '''
+    columns = lf.columns
+    lf = (
+        lf
+        .with_columns(pl.struct(pl.all()).hash().alias('_hash'))
+        .with_row_index('_row')
+    )
+    later = (
+        lf
+        .filter(pl.col('_hash').is_duplicated())
+        .filter(~pl.struct(columns).is_first_distinct())
+        .select('_row')
+    )
+    # an anti join keeps the order of the rows
+    return lf.join(later, on='_row', how='anti').drop('_row', '_hash')
+
+
+def _collect(
+    lf: pl.LazyFrame,
+    name: str,
+    parquet_path: pathlib.Path,
+    logger: logging.Logger,
+) -> pl.DataFrame:
+    session = profiling.active()
+    with telemetry.span(name, logger, file=parquet_path) as s:
+        if session is None:
+            df = lf.collect()
+        else:
+            df = session.collect(lf, f'{name}_{parquet_path.stem}')
+        s.record(rows=df.height, bytes=df.estimated_size())
+    return df
\ No newline at end of file
@@ -1,10 +1,13 @@
-import datetime
+import contextlib
 import hashlib
 import json
 import logging
 import pathlib
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional
+import uuid
 
+from . import const
+from . import telemetry
 from .enum import StrEnum
 
 
@@ -45,62 +48,42 @@ def move_files(
 
 
 def hash_file(f: pathlib.Path, logger: Optional[logging.Logger] = None) -> str:
-    return hashlib.sha256(f.read_bytes()).hexdigest()
-
-
-def new_hashes(
-    metadata: dict,
-    prev_metadata_file: pathlib.Path,
-    logger: Optional[logging.Logger] = None
-) -> bool:
-    if not prev_metadata_file.exists():
-        if logger is not None:
-            logger.info('no previous metadata exists')
-        return True
-    with prev_metadata_file.open('r') as f:
-        return not set(metadata.keys()) == set(json.load(f).keys())
-    
-
-def update_metadata(
-    metadata_file: pathlib.Path,
-    backup_path: pathlib.Path,
-    path_keys: list[str],
-    keys_to_delete: Optional[list[str]],
-    logger: Optional[logging.Logger] = None,
-) -> None:
-    if logger is not None:
-        logger.info(f'updating for backup: {metadata_file}')
-    with metadata_file.open('r') as f:
-        metadata = json.load(f)
-    for _, hash_dict in metadata.items():
-        if keys_to_delete is not None:
-            for k in keys_to_delete:
-                del hash_dict[k]
-        for path in path_keys:
-            hash_dict[path] = backup_path / pathlib.Path(hash_dict[path]).name
-    with metadata_file.open('w') as f:
-        json.dump(to_json(metadata), f)
-
-
-def backup(
-    path: pathlib.Path,
-    backup_path: pathlib.Path,
-    filetype: str,
-    path_keys: list[str] = ['path'],
-    keys_to_delete: Optional[list[str]] = None,
-    logger: Optional[logging.Logger] = None,
-) -> None:
-    metadata_path = path / 'metadata.json'
-    if metadata_path.exists():
-        backup_path = backup_path \
-            / datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
-        update_metadata(
-            metadata_path, backup_path, path_keys, keys_to_delete)
-        move_files(path, backup_path, ['json', filetype])
-    else:
-        if logger is not None:
-            logger.info(f'metadata does not exist. wiping {path}')
-        remove_files(path, ['json', filetype])
+    with telemetry.span('hash', logger, level=logging.DEBUG, file=f) as s:
+        sha = hashlib.sha256()
+        view = memoryview(bytearray(const.HASH_CHUNK_SIZE))
+        with f.open('rb', buffering=0) as f_in:
+            while n := f_in.readinto(view):
+                sha.update(view[:n])
+                s.record(bytes=n)
+        return sha.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_write(out_file: pathlib.Path) -> Iterator[pathlib.Path]:
+    '''
+    A temporary file next to out_file to write to. It replaces out_file if the
+    block succeeds and is removed if it doesn't, so a failed or interrupted
+    write never leaves a partial out_file.
+    '''
+    temp_file = out_file.with_name(f'.{out_file.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        yield temp_file
+        temp_file.replace(out_file)
+    finally:
+        temp_file.unlink(missing_ok=True)
+
+
+def write_hashed(chunks: Iterable[bytes], out_file: pathlib.Path) -> str:
+    '''
+    Writes chunks to out_file and returns their sha256, so a file that is
+    being written anyway doesn't have to be read back to hash it.
+    '''
+    sha = hashlib.sha256()
+    with atomic_write(out_file) as temp_file, temp_file.open('wb') as f_out:
+        for chunk in chunks:
+            f_out.write(chunk)
+            sha.update(chunk)
+    return sha.hexdigest()
 
 
 def to_json(non_json, logger: Optional[logging.Logger] = None):
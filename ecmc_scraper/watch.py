@@ -0,0 +1,273 @@
+'''
+A long-running process that keeps the exports up to date, run by
+`ecmc-scraper watch`, instead of a cron job that starts the pipeline from
+scratch every time.
+
+Every interval, give or take some jitter so that watchers started together
+don't poll ECMC in step, each year's zip is checked with a HEAD request
+carrying the ETag and Last-Modified ECMC sent the last time. Only the years
+whose zip changed go through the pipeline, in this process, so the imports,
+the open catalog and the transformed completions of the last run are reused.
+The other years are then exported again only if the completions they are
+joined with changed. Failed checks and failed runs back off exponentially,
+and a failed run is resumed by the next attempt.
+
+A health endpoint on localhost reports the last check of each year, the years
+waiting to run and the last run:
+
+    curl http://127.0.0.1:8787/health
+'''
+
+
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import replace
+import datetime
+import http.server
+import json
+import logging
+import random
+import threading
+from typing import Iterator, Optional
+
+import requests
+
+from . import catalog as ctlg
+from . import config as cfg
+from . import const
+from . import pipeline
+
+
+class Watcher:
+
+    def __init__(
+        self,
+        config: cfg.ProductionSummariesConfig,
+        logger: logging.Logger,
+        interval: float = const.WATCH_INTERVAL_SECONDS,
+        jitter: float = const.WATCH_JITTER,
+        max_backoff: float = const.WATCH_MAX_BACKOFF_SECONDS,
+        seed: Optional[int] = None,
+    ):
+        self.config = config
+        self.logger = logger
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.catalog = pipeline.open_catalog(config, logger)
+        self.started = datetime.datetime.now()
+        self.failures = 0
+        self.next_poll: Optional[datetime.datetime] = None
+        self.running = False
+        self.last_run: Optional[dict] = None
+        # year -> when it was last checked and what was found
+        self.checks: dict[int, dict] = {}
+        # years whose zip changed, with what ECMC reported for it, recorded
+        # in the catalog once the year has been run
+        self.pending: dict[int, ctlg.Upstream] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self, port: Optional[int] = None) -> None:
+        '''
+        Polls and runs the years that changed until stop() is called.
+        '''
+        with self._serve(port):
+            while not self._stop.is_set():
+                delay = self.step()
+                self.next_poll = datetime.datetime.now() \
+                    + datetime.timedelta(seconds=delay)
+                self.logger.info(f'next check in {delay:.0f}s')
+                self._stop.wait(delay)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def step(self) -> float:
+        '''
+        Checks every year and runs the ones that changed. Returns the seconds
+        to wait until the next step.
+        '''
+        ok = self.poll()
+        if len(self.pending) > 0:
+            ok = self.run_pending() and ok
+        self.failures = 0 if ok else self.failures + 1
+        return self._delay()
+
+    def poll(self) -> bool:
+        '''
+        Checks every year, adding the ones that changed to pending. Returns
+        False if any check failed.
+        '''
+        with ThreadPoolExecutor(max_workers=self.config.download_workers) as pool:
+            return all(pool.map(self._check, self.config.years))
+
+    def run_pending(self) -> bool:
+        with self._lock:
+            years = sorted(self.pending)
+            self.running = True
+        # a run that failed is picked up where it stopped
+        config = replace(self.config, years=years, resume=self.failures > 0)
+        run = {'years': years, 'started': datetime.datetime.now().isoformat()}
+        self.logger.info(f'running {", ".join(map(str, years))}')
+        try:
+            pipeline.production_summaries(config, self.logger, catalog=self.catalog)
+            if self.config.transform:
+                # years that didn't change are joined with the new completions
+                # if those changed, and left alone otherwise
+                pipeline.export_years(
+                    replace(self.config, years=[
+                        y for y in self.config.years if y not in years]),
+                    self.logger,
+                    catalog=self.catalog,
+                )
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            # a download that can't succeed exits, and a Polars panic isn't an
+            # Exception either, but neither should stop the watcher
+            self.logger.error(f'run of {years} failed: {e!r}')
+            self.last_run = {
+                **run,
+                'finished': datetime.datetime.now().isoformat(),
+                'status': 'failed',
+                'error': repr(e),
+            }
+            return False
+        finally:
+            with self._lock:
+                self.running = False
+
+        with self._lock:
+            for year in years:
+                self.catalog.record_upstream(self.pending.pop(year))
+        self.last_run = {
+            **run,
+            'finished': datetime.datetime.now().isoformat(),
+            'status': 'finished',
+        }
+        return True
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'status': 'ok' if self.failures == 0 else 'backing off',
+                'started': self.started.isoformat(),
+                'consecutive_failures': self.failures,
+                'next_check': None if self.next_poll is None
+                    else self.next_poll.isoformat(),
+                'running': self.running,
+                'queue_depth': len(self.pending),
+                'pending_years': sorted(self.pending),
+                'years': {str(y): c for y, c in sorted(self.checks.items())},
+                'last_run': self.last_run,
+            }
+
+    def _check(self, year: int) -> bool:
+        url = self.config.url_config.url(year)
+        previous = self.catalog.upstream(url)
+        headers = {}
+        if previous is not None and previous.etag is not None:
+            headers['If-None-Match'] = previous.etag
+        if previous is not None and previous.last_modified is not None:
+            headers['If-Modified-Since'] = previous.last_modified
+
+        checked = datetime.datetime.now().isoformat()
+        try:
+            response = requests.head(
+                url,
+                headers=headers,
+                timeout=const.DOWNLOAD_TIMEOUT_SECONDS,
+                allow_redirects=True,
+            )
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f'checking {url} failed: {e}')
+            self._record_check(year, checked, f'failed: {e}')
+            return False
+
+        if response.status_code == 404:
+            # not published yet
+            self._record_check(year, checked, 'not found')
+            return True
+        if response.status_code != 304 and not response.ok:
+            self.logger.warning(f'checking {url} failed: {response.status_code}')
+            self._record_check(year, checked, f'failed: {response.status_code}')
+            return False
+
+        size = response.headers.get('Content-Length')
+        current = ctlg.Upstream(
+            url=url,
+            year=year,
+            etag=response.headers.get('ETag', None if previous is None else previous.etag),
+            last_modified=response.headers.get(
+                'Last-Modified', None if previous is None else previous.last_modified),
+            size=int(size) if size is not None and response.status_code != 304
+                else None if previous is None else previous.size,
+            checked=checked,
+        )
+        changed = response.status_code != 304 and (
+            previous is None or not previous.same_file(current))
+
+        if changed:
+            self.logger.info(f'{year} changed upstream', extra={'year': year})
+            with self._lock:
+                self.pending[year] = current
+        elif year not in self.pending:
+            self.catalog.record_upstream(current)
+        self._record_check(year, checked, 'changed' if changed else 'unchanged')
+        return True
+
+    def _record_check(self, year: int, checked: str, result: str) -> None:
+        with self._lock:
+            check = self.checks.setdefault(year, {})
+            check['checked'] = checked
+            check['result'] = result
+            if result == 'changed':
+                check['last_changed'] = checked
+
+    def _delay(self) -> float:
+        delay = min(self.interval * 2**self.failures, self.max_backoff)
+        return delay * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    @contextlib.contextmanager
+    def _serve(self, port: Optional[int]) -> Iterator[None]:
+        if port is None:
+            yield
+            return
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        server.watcher = self # type: ignore
+        server.daemon_threads = True
+        thread = threading.Thread(
+            target=server.serve_forever, name='health', daemon=True)
+        thread.start()
+        host, port = server.server_address[:2]
+        self.logger.info(f'health endpoint at http://{host}:{port}/health')
+        try:
+            yield
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        watcher: Watcher = self.server.watcher # type: ignore
+        if self.path.rstrip('/') != '/health':
+            self.send_error(404)
+            return
+
+        status = watcher.status()
+        body = json.dumps(status, indent=2).encode()
+        self.send_response(200 if status['consecutive_failures'] == 0 else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        watcher: Watcher = self.server.watcher # type: ignore
+        watcher.logger.debug(format % args)
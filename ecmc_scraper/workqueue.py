@@ -0,0 +1,242 @@
+'''
+A work queue kept in a directory on a filesystem shared by several hosts, such
+as NFS, with no broker.
+
+A coordinator writes one task file per (stage, year) into pending/ and then
+job.json. Workers claim a task by renaming it from pending/ to claimed/, which
+only one of them can do, and renaming it into done/ or failed/ when it is
+finished. A task is only claimed once the tasks it comes after are done.
+
+While a worker holds a task it touches the task file every lease_seconds / 3
+seconds. A claimed task that hasn't been touched for lease_seconds belongs to
+a worker that died or lost the filesystem, so any worker renames it back into
+pending/ for another attempt. A worker that finishes a task it lost finds the
+task file gone and discards its result; the stages skip work that is already
+done, so running a task twice does no harm. Leases are compared with the local
+clock, so the hosts' clocks have to agree to well within lease_seconds.
+'''
+
+
+import contextlib
+from dataclasses import dataclass, field
+import datetime
+import json
+import logging
+import os
+import pathlib
+import socket
+import threading
+import time
+import uuid
+from typing import Iterator, Optional
+
+
+@dataclass(frozen=True)
+class Task:
+    stage: str
+    year: int
+    after: list[str] = field(default_factory=list)
+    order: int = 0
+
+    @property
+    def id(self) -> str:
+        return f'{self.stage}-{self.year}'
+
+
+class WorkQueue:
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        lease_seconds: float = 60,
+        max_attempts: int = 3,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
+        self._held: set[pathlib.Path] = set()
+        self._lock = threading.Lock()
+        for d in ('pending', 'claimed', 'done', 'failed', 'attempts'):
+            (path / d).mkdir(parents=True, exist_ok=True)
+
+    def submit(self, tasks: list[Task], job: dict) -> None:
+        '''
+        Replaces a finished job with a new one.
+        '''
+        if self.unfinished() > 0:
+            raise RuntimeError(f'{self.path} still has unfinished tasks')
+
+        (self.path / 'job.json').unlink(missing_ok=True)
+        for d in ('done', 'failed', 'attempts'):
+            for f in (self.path / d).iterdir():
+                f.unlink()
+        for task in tasks:
+            _write_json(self.path / 'pending' / f'{task.id}.json', {
+                'stage': task.stage,
+                'year': task.year,
+                'after': task.after,
+                'order': task.order,
+            })
+        _write_json(self.path / 'job.json', {
+            **job,
+            'submitted': datetime.datetime.now().isoformat(),
+        })
+
+    def job(self) -> Optional[dict]:
+        try:
+            with (self.path / 'job.json').open('r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def unfinished(self) -> int:
+        return sum(
+            1 for d in ('pending', 'claimed')
+            for f in (self.path / d).iterdir() if f.suffix == '.json'
+        )
+
+    def failed(self) -> list[str]:
+        return sorted(f.stem for f in (self.path / 'failed').glob('*.json'))
+
+    def claim(self, logger: logging.Logger) -> Optional[Task]:
+        '''
+        Claims the runnable task with the lowest order, or returns None if no
+        task can run yet.
+        '''
+        self.requeue_expired(logger)
+
+        tasks = []
+        for f in (self.path / 'pending').glob('*.json'):
+            task = _read_task(f)
+            if task is not None:
+                tasks.append(task)
+        tasks.sort(key=lambda t: t.order)
+
+        for task in tasks:
+            if any((self.path / 'failed' / f'{a}.json').exists() for a in task.after):
+                self._fail_pending(task, 'a task it comes after failed', logger)
+                continue
+            if not all((self.path / 'done' / f'{a}.json').exists() for a in task.after):
+                continue
+
+            pending = self.path / 'pending' / f'{task.id}.json'
+            claimed = self.path / 'claimed' / f'{task.id}.json'
+            try:
+                # the rename keeps the mtime, which must not look like an
+                # expired lease
+                os.utime(pending)
+                pending.rename(claimed)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            with self._lock:
+                self._held.add(claimed)
+
+            attempts = self._attempt(task)
+            if attempts > self.max_attempts:
+                self.fail(task, f'gave up after {self.max_attempts} attempts', logger)
+                continue
+
+            logger.info(
+                f'{self.worker_id} claimed {task.id} (attempt {attempts})',
+                extra={'task': task.id, 'attempt': attempts},
+            )
+            return task
+
+        return None
+
+    def complete(self, task: Task, logger: logging.Logger) -> bool:
+        return self._finish(task, 'done', logger)
+
+    def fail(self, task: Task, error: str, logger: logging.Logger) -> bool:
+        (self.path / 'failed' / f'{task.id}.error').write_text(
+            f'{self.worker_id}: {error}\n')
+        finished = self._finish(task, 'failed', logger)
+        if finished:
+            logger.error(f'{task.id} failed: {error}', extra={'task': task.id})
+        return finished
+
+    def requeue_expired(self, logger: logging.Logger) -> None:
+        now = time.time()
+        for f in (self.path / 'claimed').glob('*.json'):
+            try:
+                expired = now - f.stat().st_mtime > self.lease_seconds
+                if expired:
+                    f.rename(self.path / 'pending' / f.name)
+            except FileNotFoundError:
+                continue
+            if expired:
+                logger.warning(
+                    f'requeued {f.stem}, its lease expired', extra={'task': f.stem})
+
+    @contextlib.contextmanager
+    def heartbeat(self) -> Iterator[None]:
+        '''
+        Renews the leases of the tasks this process holds until the block
+        exits.
+        '''
+        stop = threading.Event()
+
+        def renew() -> None:
+            while not stop.wait(self.lease_seconds / 3):
+                with self._lock:
+                    held = list(self._held)
+                for f in held:
+                    try:
+                        os.utime(f)
+                    except FileNotFoundError:
+                        # requeued by another worker; finishing it will fail
+                        pass
+
+        thread = threading.Thread(target=renew, name='heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _finish(self, task: Task, outcome: str, logger: logging.Logger) -> bool:
+        claimed = self.path / 'claimed' / f'{task.id}.json'
+        with self._lock:
+            self._held.discard(claimed)
+        try:
+            claimed.rename(self.path / outcome / claimed.name)
+        except FileNotFoundError:
+            logger.warning(
+                f'{self.worker_id} lost the lease on {task.id} before it finished',
+                extra={'task': task.id},
+            )
+            return False
+        return True
+
+    def _fail_pending(self, task: Task, error: str, logger: logging.Logger) -> None:
+        try:
+            (self.path / 'pending' / f'{task.id}.json').rename(
+                self.path / 'failed' / f'{task.id}.json')
+        except FileNotFoundError:
+            return
+        (self.path / 'failed' / f'{task.id}.error').write_text(f'{error}\n')
+        logger.error(f'{task.id} failed: {error}', extra={'task': task.id})
+
+    def _attempt(self, task: Task) -> int:
+        # one file per attempt, so workers counting at the same time can't
+        # overwrite each other's counts
+        (self.path / 'attempts' / f'{task.id}.{uuid.uuid4().hex}').touch()
+        return len(list((self.path / 'attempts').glob(f'{task.id}.*')))
+
+
+def _read_task(f: pathlib.Path) -> Optional[Task]:
+    try:
+        with f.open('r') as f_in:
+            return Task(**json.load(f_in))
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(f: pathlib.Path, data: dict) -> None:
+    temp_file = f.with_name(f'.{f.name}.{uuid.uuid4().hex}.tmp')
+    with temp_file.open('w') as f_out:
+        json.dump(data, f_out, indent=4)
+    temp_file.replace(f)
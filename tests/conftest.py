@@ -0,0 +1,58 @@
+import logging
+import pathlib
+from typing import Iterator
+
+import pytest
+
+from ecmc_scraper import config as cfg
+from ecmc_scraper import const
+from ecmc_scraper import production_summaries
+from ecmc_scraper import standin
+from ecmc_scraper import synthetic
+
+
+YEARS = [2021, 2022]
+ROWS = 3000
+
+
+@pytest.fixture
+def logger() -> logging.Logger:
+    return logging.getLogger('tests')
+
+
+@pytest.fixture
+def url_config() -> cfg.ProductionSummariesUrlConfig:
+    return cfg.ProductionSummariesUrlConfig.from_dict(const.DEFAULT_URL_CONFIG)
+
+
+@pytest.fixture
+def server_dir(
+    tmp_path: pathlib.Path,
+    url_config: cfg.ProductionSummariesUrlConfig,
+) -> pathlib.Path:
+    for year in YEARS:
+        synthetic.write_zip(tmp_path / 'server', year, ROWS, url_config)
+    return tmp_path / 'server'
+
+
+@pytest.fixture
+def server(server_dir: pathlib.Path) -> Iterator[standin.StandinServer]:
+    with standin.StandinServer(server_dir) as s:
+        yield s
+
+
+@pytest.fixture
+def config(
+    tmp_path: pathlib.Path,
+    server: standin.StandinServer,
+) -> cfg.ProductionSummariesConfig:
+    return production_summaries.default_config(
+        access_db_dir=tmp_path / 'access-db',
+        catalog_file=tmp_path / 'catalog.sqlite',
+        export_dir=tmp_path / 'export',
+        log_dir=tmp_path / 'logs',
+        parquet_dir=tmp_path / 'parquet',
+        url_config={**const.DEFAULT_URL_CONFIG, 'base_url': server.base_url},
+        years=YEARS,
+        zip_dir=tmp_path / 'zip',
+    )
@@ -0,0 +1,46 @@
+import polars as pl
+
+from ecmc_scraper import convert_production_summaries_access_to_parquet as convert_prod
+from ecmc_scraper import enum
+from ecmc_scraper import synthetic
+from ecmc_scraper import transform_production_summaries as transform_prod
+
+
+def _batches(df: pl.DataFrame, size: int) -> pl.DataFrame:
+    # a frame read from ODBC in batches has one chunk per batch
+    return pl.concat(
+        [df.slice(o, size) for o in range(0, df.height, size)], rechunk=False)
+
+
+def test_convert_keeps_first_of_duplicates(logger):
+    df = _batches(synthetic.production_table(2022, 5000), 700)
+    data = {enum.MsAccessTable.production: {2022: df}}
+    duplicates = convert_prod._deduplicate(data, logger)
+
+    deduplicated = data[enum.MsAccessTable.production][2022]
+    assert deduplicated.equals(df.unique(maintain_order=True))
+    assert duplicates[enum.MsAccessTable.production][2022] == df.height - deduplicated.height
+    assert duplicates[enum.MsAccessTable.production][2022] > 0
+    # later selects work on the chunks that are left
+    assert deduplicated.select(pl.all().last()).height == 1
+
+
+def test_transform_keeps_first_of_duplicates():
+    # rows that only differ in a column that isn't kept become duplicates
+    lf = synthetic.production_table(2022, 5000).lazy().drop('operator_num', 'name')
+    assert transform_prod._unique(lf).collect().equals(
+        lf.unique(maintain_order=True).collect())
+
+
+def test_rows_with_the_same_hash_are_compared(monkeypatch):
+    # a constant hash makes every row look like a duplicate of every other
+    df = pl.DataFrame({'a': [1, 2, 1, 3], 'b': ['x', 'y', 'x', 'z']})
+    monkeypatch.setattr(
+        pl.Expr, 'hash', lambda self, *args, **kwargs: pl.lit(0, pl.UInt64))
+    monkeypatch.setattr(
+        pl.DataFrame, 'hash_rows',
+        lambda self, *args, **kwargs: pl.Series([0] * self.height, dtype=pl.UInt64))
+
+    assert transform_prod._unique(df.lazy()).collect().equals(
+        df.unique(maintain_order=True))
+    assert convert_prod._first_distinct(df).equals(df.unique(maintain_order=True))
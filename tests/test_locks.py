@@ -0,0 +1,71 @@
+import threading
+import time
+
+from ecmc_scraper import locks as lck
+
+
+def test_held_lock_is_not_taken(tmp_path):
+    locks = lck.Locks(tmp_path)
+    first = locks.lock('convert-2022')
+    second = locks.lock('convert-2022')
+
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    assert 'pid' in second.holder()
+
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+def test_hold_waits_for_holder(tmp_path, logger):
+    locks = lck.Locks(tmp_path)
+    holder = locks.lock('convert-2022')
+    holder.acquire()
+    order = []
+
+    def wait() -> None:
+        with locks.unit('convert', 2022, logger) as waited:
+            order.append(('waiter', waited))
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    time.sleep(0.2)
+    order.append(('holder', None))
+    holder.release()
+    thread.join()
+
+    assert order == [('holder', None), ('waiter', True)]
+
+
+def test_hold_removes_its_lock_file(tmp_path, logger):
+    locks = lck.Locks(tmp_path)
+    with locks.hold('metadata', logger) as waited:
+        assert not waited
+        assert (tmp_path / 'metadata.lock').exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_removed_lock_file_is_not_shared(tmp_path):
+    # a waiter that locks a file its holder removed must not end up holding
+    # the lock at the same time as whoever locks the new file
+    locks = lck.Locks(tmp_path)
+    holder = locks.lock('temp')
+    holder.acquire()
+    waiter = locks.lock('temp')
+    acquired = threading.Event()
+
+    def wait() -> None:
+        waiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    time.sleep(0.2)
+    holder.release(remove=True)
+    thread.join()
+
+    assert acquired.is_set()
+    assert not locks.lock('temp').acquire(blocking=False)
+    waiter.release(remove=True)
+    assert list(tmp_path.iterdir()) == []
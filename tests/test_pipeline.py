@@ -0,0 +1,305 @@
+import dataclasses
+import logging
+
+import polars as pl
+import pytest
+
+from ecmc_scraper import catalog as ctlg
+from ecmc_scraper import config as cfg
+from ecmc_scraper import enum
+from ecmc_scraper import pipeline
+from ecmc_scraper import production_summaries
+from ecmc_scraper import synthetic
+from ecmc_scraper import transform_production_summaries as transform_prod
+
+from .conftest import ROWS, YEARS
+
+
+def _sorted(df: pl.DataFrame) -> pl.DataFrame:
+    return df.sort(df.columns, nulls_last=True)
+
+
+def _export(config: cfg.ProductionSummariesConfig, year: int) -> pl.DataFrame:
+    return pl.read_csv(config.export_dir / f'{year}.csv', infer_schema_length=0)
+
+
+def _key(df: pl.DataFrame) -> pl.Expr:
+    # the outer join keeps the completions API_num as API_num_right
+    return pl.coalesce([c for c in ('API_num', 'API_num_right') if c in df.columns])
+
+
+def test_convert_round_trip(config, logger):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    catalog = ctlg.Catalog(config.catalog_file)
+    for year in YEARS:
+        artifact = catalog.current(enum.CatalogStage.parquet, year)
+        production = synthetic.production_table(year, ROWS)
+        assert artifact.extra['duplicates']['production'] \
+            == production.height - production.unique().height
+        assert _sorted(pl.read_parquet(artifact.files['production_path'])).equals(
+            _sorted(production.unique()))
+        assert _sorted(pl.read_parquet(artifact.files['completions_path'])).equals(
+            _sorted(synthetic.completions_table(year, ROWS // 4).unique()))
+
+
+def test_transform_round_trip(config, logger):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    transform_config = config.transform_config
+    completions = transform_prod.completions_frame(
+        synthetic.completions_table(max(YEARS), ROWS // 4).lazy(),
+        transform_config.completions_columns_to_keep,
+        transform_config.completions_columns_to_fill_null_with_zero,
+    )
+    for year in YEARS:
+        expected = transform_prod.output_frame(
+            transform_prod.production_frame(
+                synthetic.production_table(year, ROWS).lazy(),
+                transform_config.production_columns_to_keep,
+                transform_config.production_columns_to_fill_null_with_zero,
+            ),
+            completions,
+            transform_config.remove_CO2_wells,
+        ).collect()
+        assert _sorted(_export(config, year)).equals(_sorted(_as_export(expected)))
+
+
+def _as_export(df: pl.DataFrame) -> pl.DataFrame:
+    # the CSV is compared as text, the way it is read downstream
+    return pl.read_csv(
+        df.write_csv(date_format='%F', time_format='%F').encode(),
+        infer_schema_length=0,
+    )
+
+
+def test_load_matches_export(config, logger):
+    frames = production_summaries.load(
+        config=config, logger=logger, read_table=synthetic.read_standin_table)
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    for year in YEARS:
+        assert _sorted(_as_export(frames[year].collect())).equals(
+            _sorted(_export(config, year)))
+
+
+def test_resume_skips_finished_years(config, logger, caplog):
+    # one worker per stage, so 2022, the newest year, is converted before
+    # 2021 fails
+    config = dataclasses.replace(config, download_workers=1, convert_workers=1)
+
+    def read_table(table, connection, logger):
+        if '2021' in str(connection[enum.ODBCKey.dbq]):
+            raise RuntimeError('injected ODBC failure')
+        return synthetic.read_standin_table(table, connection, logger)
+
+    with pytest.raises(RuntimeError, match='injected'):
+        pipeline.production_summaries(config, logger, read_table=read_table)
+    catalog = ctlg.Catalog(config.catalog_file)
+    failed = catalog.last_run()
+    assert failed.status == enum.RunStatus.failed
+    assert catalog.current(enum.CatalogStage.parquet, 2021) is None
+    assert catalog.current(enum.CatalogStage.parquet, 2022) is not None
+
+    read = []
+
+    def counting_read_table(table, connection, logger):
+        read.append(str(connection[enum.ODBCKey.dbq]))
+        return synthetic.read_standin_table(table, connection, logger)
+
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        pipeline.production_summaries(
+            dataclasses.replace(config, resume=True),
+            logger,
+            read_table=counting_read_table,
+        )
+
+    assert catalog.last_run().status == enum.RunStatus.finished
+    assert f'skipped convert for 2022, run {failed.id} finished it' in caplog.messages
+    assert len(read) > 0 and all('2021' in path for path in read)
+    for year in YEARS:
+        assert (config.export_dir / f'{year}.csv').exists()
+
+
+def test_change_set(config, logger, server_dir, url_config):
+    config = dataclasses.replace(config, export_changes=True)
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+    before = {year: _export(config, year) for year in YEARS}
+
+    # ECMC republishes 2022 with different wells; 2021 is exported again
+    # because it is joined with the completions of 2022
+    synthetic.write_zip(server_dir, 2022, ROWS, url_config, seed=1)
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    catalog = ctlg.Catalog(config.catalog_file)
+    for year in YEARS:
+        export = catalog.current(enum.CatalogStage.export, year)
+        changes = export.extra['changes']
+        assert changes['previous_id'] is not None
+        assert changes['inserts'] + changes['updates'] + changes['deletes'] > 0
+
+        def read(kind: str) -> pl.DataFrame:
+            return pl.read_csv(export.files[f'{kind}_path'], infer_schema_length=0)
+
+        inserts, updates, deletes = read('inserts'), read('updates'), read('deletes')
+        assert (inserts.height, deletes.height) \
+            == (changes['inserts'], changes['deletes'])
+
+        # applying the change set to the previous export gives the new one
+        removed = pl.concat([
+            deletes['API_num'], updates.select(_key(updates)).to_series()])
+        applied = pl.concat([
+            before[year].filter(~_key(before[year]).is_in(removed)),
+            inserts,
+            updates,
+        ])
+        assert _sorted(applied).equals(_sorted(_export(config, year)))
+
+
+def _negative_days(df: pl.DataFrame) -> pl.DataFrame:
+    return df.with_columns(pl.lit(-1).cast(df['Prod_days'].dtype).alias('Prod_days'))
+
+
+def _read_negative_days(table, connection, logger):
+    df = synthetic.read_standin_table(table, connection, logger)
+    return _negative_days(df) if table == enum.MsAccessTable.production else df
+
+
+def test_quality_policy_fail_keeps_previous_year(config, logger):
+    pipeline.production_summaries(config, logger, read_table=_read_negative_days)
+    catalog = ctlg.Catalog(config.catalog_file)
+    previous = catalog.current(enum.CatalogStage.parquet, 2022)
+
+    # a new policy converts the year again, and keeps failing it until the
+    # Access database changes
+    config = dataclasses.replace(
+        config, years=[2022], quality_policy=enum.QualityPolicy.fail)
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match='break data quality rules'):
+            pipeline.production_summaries(
+                config, logger, read_table=_read_negative_days)
+
+    assert catalog.current(enum.CatalogStage.parquet, 2022).id == previous.id
+    report = catalog.current(enum.CatalogStage.quality, 2022)
+    assert report.extra['policy'] == enum.QualityPolicy.fail
+    assert report.extra['violations']['production']['prod_days_negative'] \
+        == _negative_days(synthetic.production_table(2022, ROWS)).unique().height
+
+    # going back to the report policy reuses the parquet files and reports on
+    # them again
+    pipeline.production_summaries(
+        dataclasses.replace(config, quality_policy=enum.QualityPolicy.report),
+        logger,
+        read_table=_read_negative_days,
+    )
+    assert catalog.current(enum.CatalogStage.parquet, 2022).id == previous.id
+    report = catalog.current(enum.CatalogStage.quality, 2022)
+    assert report.extra['policy'] == enum.QualityPolicy.report
+
+
+def test_quality_policy_quarantine_converts_again(config, logger):
+    pipeline.production_summaries(config, logger, read_table=_read_negative_days)
+
+    config = dataclasses.replace(config, quality_policy=enum.QualityPolicy.quarantine)
+    pipeline.production_summaries(config, logger, read_table=_read_negative_days)
+
+    catalog = ctlg.Catalog(config.catalog_file)
+    for year in YEARS:
+        artifact = catalog.current(enum.CatalogStage.parquet, year)
+        assert artifact.extra['quality_policy'] == enum.QualityPolicy.quarantine
+        assert pl.read_parquet(artifact.files['production_path']).height == 0
+
+
+def test_resume_with_another_quality_policy(config, logger):
+    config = dataclasses.replace(config, download_workers=1, convert_workers=1)
+
+    def read_table(table, connection, logger):
+        if '2021' in str(connection[enum.ODBCKey.dbq]):
+            raise RuntimeError('injected ODBC failure')
+        return _read_negative_days(table, connection, logger)
+
+    with pytest.raises(RuntimeError, match='injected'):
+        pipeline.production_summaries(config, logger, read_table=read_table)
+
+    # 2022 was converted under the report policy, so it isn't reused
+    with pytest.raises(RuntimeError, match='rows of 2022 break data quality rules'):
+        pipeline.production_summaries(
+            dataclasses.replace(
+                config, resume=True, quality_policy=enum.QualityPolicy.fail),
+            logger,
+            read_table=_read_negative_days,
+        )
+
+
+def test_load_reads_parquet_of_the_same_quality_policy(config, logger):
+    pipeline.production_summaries(config, logger, read_table=_read_negative_days)
+    read = []
+
+    def counting_read_table(table, connection, logger):
+        read.append(table)
+        return _read_negative_days(table, connection, logger)
+
+    production_summaries.load(
+        config=config, logger=logger, read_table=counting_read_table)
+    assert read == []
+
+    # the parquet files kept the rows the quarantine policy moves out
+    config = dataclasses.replace(config, quality_policy=enum.QualityPolicy.quarantine)
+    frames = production_summaries.load(
+        config=config, logger=logger, read_table=counting_read_table)
+    assert len(read) == 2 * len(YEARS)
+    for year in YEARS:
+        assert frames[year].filter(pl.col('Prod_days') < 0).collect().height == 0
+
+
+def test_intermediate_format_is_changed_in_place(config, logger):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+    catalog = ctlg.Catalog(config.catalog_file)
+    previous = {y: catalog.current(enum.CatalogStage.parquet, y) for y in YEARS}
+
+    for intermediate_format in (
+        enum.IntermediateFormat.ipc_lz4, enum.IntermediateFormat.parquet,
+    ):
+        pipeline.production_summaries(
+            dataclasses.replace(config, intermediate_format=intermediate_format),
+            logger,
+            read_table=synthetic.read_standin_table,
+        )
+        for year in YEARS:
+            artifacts = [
+                a for a in catalog.artifacts(enum.CatalogStage.parquet, current=False)
+                if a.year == year
+            ]
+            artifact = catalog.current(enum.CatalogStage.parquet, year)
+            # no other generation owns the files of the current one
+            assert [a.id for a in artifacts] == [previous[year].id]
+            assert artifact.exists()
+            assert artifact.extra['intermediate_format'] == intermediate_format
+            assert _sorted(pl.read_parquet(artifact.files['production_path'])).equals(
+                _sorted(synthetic.production_table(year, ROWS).unique()))
+
+    assert list(config.parquet_dir.glob('*.arrow.lz4')) == []
+
+
+def test_change_set_once_asked_for(config, logger):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    # the exports are redone once, with the row hashes the next change set is
+    # made from
+    config = dataclasses.replace(config, export_changes=True)
+    catalog = ctlg.Catalog(config.catalog_file)
+    exports = {}
+    for _ in range(2):
+        pipeline.production_summaries(
+            config, logger, read_table=synthetic.read_standin_table)
+        for year in YEARS:
+            export = catalog.current(enum.CatalogStage.export, year)
+            assert export.files['row_hashes_path'].exists()
+            assert exports.setdefault(year, export.id) == export.id
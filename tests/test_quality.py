@@ -0,0 +1,92 @@
+import polars as pl
+
+from ecmc_scraper import convert_production_summaries_access_to_parquet as convert_prod
+from ecmc_scraper import enum
+from ecmc_scraper import quality
+from ecmc_scraper import synthetic
+
+
+def _data(production: pl.DataFrame, completions: pl.DataFrame) -> dict:
+    return {
+        enum.MsAccessTable.production: {2022: production},
+        enum.MsAccessTable.completions: {2022: completions},
+    }
+
+
+def _clean() -> tuple[pl.DataFrame, pl.DataFrame]:
+    production = synthetic.production_table(2022, 1000).with_columns(
+        pl.col('Prod_days').clip(1, 366),
+        pl.col('oil_prod').fill_null(0),
+    )
+    return production, synthetic.completions_table(2022, 250)
+
+
+def test_clean_tables_pass(logger):
+    data = _data(*_clean())
+    report = quality.check_year(
+        data, 2022, enum.QualityPolicy.report, logger, convert_prod._table_keys)
+
+    assert report.violations == 0
+    assert report.tables['production']['rows'] == 1000
+    assert report.tables['production']['rules'] == {}
+
+
+def test_broken_rules_are_counted(logger):
+    production, completions = _clean()
+    production = production.with_columns(
+        pl.when(pl.int_range(0, pl.len()) < 3)
+        .then(-1)
+        .otherwise(pl.col('Prod_days'))
+        .cast(production['Prod_days'].dtype)
+        .alias('Prod_days'),
+        pl.when(pl.int_range(0, pl.len()) == 5)
+        .then(pl.lit('x'))
+        .otherwise(pl.col('api_seq_num'))
+        .alias('api_seq_num'),
+    )
+    completions = completions.with_columns(
+        pl.when(pl.int_range(0, pl.len()) < 2)
+        .then(pl.lit(10.0))
+        .otherwise(pl.col('lat'))
+        .alias('lat'),
+    )
+    data = _data(production, completions)
+    report = quality.check_year(
+        data, 2022, enum.QualityPolicy.report, logger, convert_prod._table_keys)
+
+    production_rules = report.tables['production']['rules']
+    assert production_rules['prod_days_negative']['violations'] == 3
+    assert production_rules['api_not_numeric']['violations'] == 1
+    assert len(production_rules['prod_days_negative']['samples']) == 3
+    assert report.tables['completions']['rules'][
+        'location_outside_colorado']['violations'] == 2
+    assert report.violations == 6
+    # the report policy keeps the rows
+    assert data[enum.MsAccessTable.production][2022].height == 1000
+
+
+def test_quarantine_moves_broken_rows(tmp_path, logger):
+    production, completions = _clean()
+    production = production.with_columns(
+        pl.when(pl.int_range(0, pl.len()) % 250 == 0)
+        .then(400)
+        .otherwise(pl.col('Prod_days'))
+        .cast(production['Prod_days'].dtype)
+        .alias('Prod_days'),
+    )
+    # deduplicated as convert does, so the table is chunked unlike the rule
+    # flags
+    data = _data(production, completions)
+    convert_prod._deduplicate(data, logger)
+    height = data[enum.MsAccessTable.production][2022].height
+    report = quality.check_year(
+        data, 2022, enum.QualityPolicy.quarantine, logger, convert_prod._table_keys)
+
+    quarantined = report.quarantined['production']
+    assert quarantined.height > 0
+    assert (quarantined['Prod_days'] == 400).all()
+    assert (quarantined['quality_rules'] == 'prod_days_over_366').all()
+    quarantined.write_parquet(tmp_path / 'quarantine.parquet')
+    assert data[enum.MsAccessTable.production][2022].height \
+        == height - quarantined.height
+    assert 'completions' not in report.quarantined
@@ -0,0 +1,95 @@
+import polars as pl
+from polars.testing import assert_frame_equal
+from typer.testing import CliRunner
+
+from ecmc_scraper import catalog as ctlg
+from ecmc_scraper import const
+from ecmc_scraper import enum
+from ecmc_scraper import main
+from ecmc_scraper import pipeline
+from ecmc_scraper import query
+from ecmc_scraper import synthetic
+
+from .conftest import ROWS, YEARS
+
+
+def test_scan_skips_years_out_of_range(config, logger, monkeypatch):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+    catalog = ctlg.Catalog(config.catalog_file)
+
+    opened = []
+    scan_parquet = pl.scan_parquet
+
+    def counting_scan_parquet(source, *args, **kwargs):
+        opened.append(source)
+        return scan_parquet(source, *args, **kwargs)
+
+    monkeypatch.setattr(pl, 'scan_parquet', counting_scan_parquet)
+    df = query.scan(
+        catalog, enum.LookupTable.production, 'report_year', 2022, 2030).collect()
+
+    # 2021 only has rows for 2021, so its file is never opened
+    assert opened == [
+        catalog.current(enum.CatalogStage.parquet, 2022).files['production_path']]
+    assert df.height == synthetic.production_table(2022, ROWS).unique().height
+    assert (df['year'] == 2022).all()
+
+
+def test_find_rows(config, logger, tmp_path):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+
+    result = CliRunner().invoke(main.app, [
+        'find-rows', 'Prod_days', '--min', '300', '--max', '366',
+        '--catalog-file', str(config.catalog_file),
+        '--output', str(tmp_path / 'rows.csv'),
+    ])
+    assert result.exit_code == 0, result.output
+
+    rows = pl.read_csv(tmp_path / 'rows.csv')
+    assert rows.height > 0
+    assert rows['Prod_days'].is_between(300, 366).all()
+
+
+def _exports(config) -> pl.DataFrame:
+    return pl.concat([
+        pl.read_csv(config.export_dir / f'{year}.csv', infer_schema_length=None)
+        .with_columns(pl.lit(year).alias('year'))
+        for year in YEARS
+    ], how='diagonal_relaxed').filter(pl.col('well_type').is_not_null())
+
+
+def test_rollup_matches_exports(config, logger):
+    pipeline.production_summaries(
+        config, logger, read_table=synthetic.read_standin_table)
+    catalog = ctlg.Catalog(config.catalog_file)
+    exports = _exports(config)
+
+    by = ['year', 'county']
+    expected = (
+        exports.group_by(by)
+        .agg(
+            pl.len().alias('wells'),
+            *[pl.col(c).sum() for c in const.CUBE_SUM_COLUMNS],
+            pl.col('BOEd').sum().alias('BOEd_sum'),
+            # the mean of every well, not of the cubes' means
+            pl.col('BOEd').mean().alias('BOEd_mean'),
+        )
+        .sort(by, nulls_last=True)
+    )
+    rolled_up = query.rollup(catalog, by).collect()
+    assert_frame_equal(
+        rolled_up.select(expected.columns), expected,
+        check_dtype=False, check_exact=False,
+    )
+
+    # operators keep their name when the cubes are rolled up by operator
+    by = ['year', 'operator_num']
+    expected = exports.group_by(by).agg(pl.col('name').first().alias('operator_name'))
+    rolled_up = query.rollup(catalog, by).collect()
+    assert_frame_equal(
+        rolled_up.select(expected.columns).sort(by),
+        expected.sort(by),
+        check_dtype=False,
+    )
@@ -0,0 +1,101 @@
+import os
+import time
+
+import pytest
+
+from ecmc_scraper import workqueue
+
+
+def _tasks() -> list[workqueue.Task]:
+    return [
+        workqueue.Task('scrape', 2022, order=0),
+        workqueue.Task('scrape', 2021, order=1),
+        workqueue.Task('convert', 2022, after=['scrape-2022'], order=2),
+    ]
+
+
+def test_claims_in_order_after_dependencies(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path)
+    queue.submit(_tasks(), {'years': [2021, 2022]})
+    assert queue.job()['years'] == [2021, 2022]
+
+    first = queue.claim(logger)
+    second = queue.claim(logger)
+    assert (first.id, second.id) == ('scrape-2022', 'scrape-2021')
+    # convert-2022 waits for scrape-2022
+    assert queue.claim(logger) is None
+
+    assert queue.complete(first, logger)
+    assert queue.claim(logger).id == 'convert-2022'
+    assert queue.unfinished() == 2
+
+
+def test_claimed_once(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path)
+    other = workqueue.WorkQueue(tmp_path)
+    queue.submit([workqueue.Task('scrape', 2022)], {})
+
+    assert queue.claim(logger) is not None
+    assert other.claim(logger) is None
+
+
+def test_expired_lease_is_requeued(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path, lease_seconds=60)
+    other = workqueue.WorkQueue(tmp_path, lease_seconds=60)
+    queue.submit([workqueue.Task('scrape', 2022)], {})
+    task = queue.claim(logger)
+
+    # a lease still being renewed isn't taken
+    assert other.claim(logger) is None
+
+    # the worker holding it stopped renewing it two minutes ago
+    stale = time.time() - 120
+    os.utime(tmp_path / 'claimed' / f'{task.id}.json', (stale, stale))
+    assert other.claim(logger).id == task.id
+
+    # the first worker finds out it lost the task once the other finished it
+    assert other.complete(task, logger)
+    assert not queue.complete(task, logger)
+    assert queue.unfinished() == 0
+
+
+def test_heartbeat_renews_leases(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path, lease_seconds=0.3)
+    other = workqueue.WorkQueue(tmp_path, lease_seconds=0.3)
+    queue.submit([workqueue.Task('scrape', 2022)], {})
+    with queue.heartbeat():
+        task = queue.claim(logger)
+        time.sleep(0.6)
+        assert other.claim(logger) is None
+    assert queue.complete(task, logger)
+
+
+def test_fail_fails_dependent_tasks(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path)
+    queue.submit(_tasks(), {})
+    task = queue.claim(logger)
+    assert queue.fail(task, 'injected', logger)
+
+    assert queue.claim(logger).id == 'scrape-2021'
+    assert queue.claim(logger) is None
+    assert queue.failed() == ['convert-2022', 'scrape-2022']
+    assert 'injected' in (tmp_path / 'failed' / 'scrape-2022.error').read_text()
+
+
+def test_gives_up_after_max_attempts(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path, max_attempts=2)
+    queue.submit([workqueue.Task('scrape', 2022)], {})
+    for _ in range(2):
+        task = queue.claim(logger)
+        (tmp_path / 'claimed' / f'{task.id}.json').rename(
+            tmp_path / 'pending' / f'{task.id}.json')
+
+    assert queue.claim(logger) is None
+    assert queue.failed() == ['scrape-2022']
+
+
+def test_submit_refuses_unfinished_job(tmp_path, logger):
+    queue = workqueue.WorkQueue(tmp_path)
+    queue.submit(_tasks(), {})
+    with pytest.raises(RuntimeError, match='unfinished'):
+        queue.submit(_tasks(), {})